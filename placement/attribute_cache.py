@@ -10,7 +10,12 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+import time
+
+from oslo_concurrency import lockutils
 import sqlalchemy as sa
+from sqlalchemy import sql
 
 from placement.db.sqlalchemy import models
 from placement import db_api
@@ -21,6 +26,20 @@ _CONSUMER_TYPE_TBL = models.ConsumerType.__table__
 _RC_TBL = models.ResourceClass.__table__
 _TRAIT_TBL = models.Trait.__table__
 
+_SharedCache = collections.namedtuple(
+    '_SharedCache', 'watermark id_cache str_cache all_cache')
+
+# A dict, keyed by table name, of _SharedCache holding the contents of that
+# table as last loaded by any request in this process.
+_SHARED_CACHES = {}
+
+# A dict, keyed by table name, of OrderedDicts, keyed by the names and ids
+# recently looked up but not found in that table, of the time.monotonic()
+# value at which they were not found.
+_NOT_FOUND_CACHES = collections.defaultdict(collections.OrderedDict)
+# The maximum number of names and ids remembered as not found per table
+_NOT_FOUND_CACHE_SIZE = 1000
+
 
 class _AttributeCache(object):
     """A cache of integer and string lookup values for string-based attributes.
@@ -37,6 +56,17 @@ class _AttributeCache(object):
 
     Despite that requirement, any time an entity associated with a cache is
     created, updated, or deleted `clear()` should be called on the cache.
+
+    The contents of the table are shared by the caches of all the requests in
+    a process. Rather than loading the whole table, a request only checks the
+    shared copy is still current by comparing a watermark of the table (its
+    row count, highest id and latest created_at and updated_at) with the one
+    taken when the shared copy was loaded.
+
+    Once loaded, a lookup missing the cache only fetches the row it is after.
+    Names and ids found not to exist are remembered, process wide, for
+    CONF.placement.attribute_cache_not_found_ttl seconds so that repeated
+    lookups of them don't reach the database at all.
     """
     _table = None
     _not_found = None
@@ -52,12 +82,22 @@ class _AttributeCache(object):
         assert self._table is not None, "_table must be defined"
         assert self._not_found is not None, "_not_found must be defined"
         self._ctx = ctx
-        self.clear()
+        self._loaded = False
+        self._id_cache = {}
+        self._str_cache = {}
+        self._all_cache = {}
 
     def clear(self):
+        self._loaded = False
         self._id_cache = {}
         self._str_cache = {}
         self._all_cache = {}
+        # Don't let any request in this process trust the shared copy, even
+        # if the watermark of the table has not changed, nor what was not
+        # found in the table.
+        _SHARED_CACHES.pop(self._table.name, None)
+        with lockutils.lock('attribute_cache_not_found'):
+            _NOT_FOUND_CACHES.pop(self._table.name, None)
 
     def id_from_string(self, attr_str):
         """Given a string representation of an attribute -- e.g. "DISK_GB"
@@ -76,7 +116,7 @@ class _AttributeCache(object):
             return attr_id
 
         # Otherwise, check the database table
-        self._refresh_from_db(self._ctx)
+        self._load_missing(name=attr_str)
         if attr_str in self._id_cache:
             return self._id_cache[attr_str]
         raise self._not_found(name=attr_str)
@@ -97,7 +137,7 @@ class _AttributeCache(object):
             return attr_id_str
 
         # Otherwise, check the database table
-        self._refresh_from_db(self._ctx)
+        self._load_missing(name=attr_str)
         if attr_str in self._all_cache:
             return self._all_cache[attr_str]
         raise self._not_found(name=attr_str)
@@ -119,7 +159,7 @@ class _AttributeCache(object):
             return attr_str
 
         # Otherwise, check the database table
-        self._refresh_from_db(self._ctx)
+        self._load_missing(attr_id=attr_id)
         if attr_id in self._str_cache:
             return self._str_cache[attr_id]
         raise self._not_found(name=attr_id)
@@ -130,29 +170,140 @@ class _AttributeCache(object):
 
         In Python3 the return value is a generator.
         """
-        if not self._all_cache:
+        if not self._loaded:
             self._refresh_from_db(self._ctx)
         return self._all_cache.values()
 
+    def get_contents(self):
+        """Return the contents of the cache, loading them from the database
+        first if that has not been done yet, so that they can be handed to
+        another cache of the same kind with use_contents().
+        """
+        if not self._loaded:
+            self._refresh_from_db(self._ctx)
+        return self._id_cache, self._str_cache, self._all_cache
+
+    def use_contents(self, contents):
+        """Make the cache use contents returned by get_contents() rather than
+        loading them from the database. The dicts are never modified, so they
+        can be shared.
+        """
+        self._id_cache, self._str_cache, self._all_cache = contents
+        self._loaded = True
+
+    def _load_missing(self, name=None, attr_id=None):
+        """Loads the cache from the database if that has not been done yet.
+        Otherwise, looks for the single attribute with the supplied name or
+        id, which is missing from the cache, in the database, adding it to the
+        cache if it is found.
+        """
+        if not self._loaded:
+            self._refresh_from_db(self._ctx)
+            return
+
+        key = name if name is not None else attr_id
+        table_name = self._table.name
+        ttl = self._ctx.config.placement.attribute_cache_not_found_ttl
+        with lockutils.lock('attribute_cache_not_found'):
+            not_found_at = _NOT_FOUND_CACHES[table_name].get(key)
+        if not_found_at is not None and time.monotonic() - not_found_at < ttl:
+            return
+
+        row = self._get_row_from_db(self._ctx, name=name, attr_id=attr_id)
+        if row is None:
+            if ttl:
+                with lockutils.lock('attribute_cache_not_found'):
+                    not_found = _NOT_FOUND_CACHES[table_name]
+                    not_found.pop(key, None)
+                    not_found[key] = time.monotonic()
+                    while len(not_found) > _NOT_FOUND_CACHE_SIZE:
+                        not_found.popitem(last=False)
+            return
+
+        # The dicts may be shared with other requests, so copy rather than
+        # modify them.
+        self._id_cache = dict(self._id_cache)
+        self._id_cache[row.name] = row.id
+        self._str_cache = dict(self._str_cache)
+        self._str_cache[row.id] = row.name
+        self._all_cache = dict(self._all_cache)
+        self._all_cache[row.name] = row
+
+    @db_api.placement_context_manager.reader
+    def _get_row_from_db(self, ctx, name=None, attr_id=None):
+        """Returns the row of the table with the supplied name or id, or None
+        if there is no such row.
+        """
+        table = self._table
+        sel = sa.select(
+            table.c.id,
+            table.c.name,
+            table.c.updated_at,
+            table.c.created_at,
+        )
+        if name is not None:
+            sel = sel.where(table.c.name == name)
+        else:
+            sel = sel.where(table.c.id == attr_id)
+        return ctx.session.execute(sel).fetchone()
+
     @db_api.placement_context_manager.reader
     def _refresh_from_db(self, ctx):
         """Grabs all resource classes or traits from the respective DB table
         and populates the supplied cache object's internal integer and string
         identifier dicts.
 
+        The table is only read in full if it has changed since it was last
+        read by any request in this process.
+
         :param ctx: RequestContext with the the database session.
         """
         table = self._table
+        watermark = self._get_watermark(ctx)
+        shared = _SHARED_CACHES.get(table.name)
+        if shared is None or shared.watermark != watermark:
+            sel = sa.select(
+                table.c.id,
+                table.c.name,
+                table.c.updated_at,
+                table.c.created_at,
+            )
+            res = ctx.session.execute(sel).fetchall()
+            self._id_cache = {r[1]: r[0] for r in res}
+            self._str_cache = {r[0]: r[1] for r in res}
+            self._all_cache = {r[1]: r for r in res}
+            self._add_defaults()
+            # Only share the dicts once complete, they are not modified
+            # after that.
+            shared = _SharedCache(
+                watermark=watermark,
+                id_cache=self._id_cache,
+                str_cache=self._str_cache,
+                all_cache=self._all_cache)
+            _SHARED_CACHES[table.name] = shared
+        self._id_cache = shared.id_cache
+        self._str_cache = shared.str_cache
+        self._all_cache = shared.all_cache
+        self._loaded = True
+
+    def _get_watermark(self, ctx):
+        """Returns a tuple that changes whenever a row of the table is added,
+        deleted or updated.
+        """
+        table = self._table
         sel = sa.select(
-            table.c.id,
-            table.c.name,
-            table.c.updated_at,
-            table.c.created_at,
+            sql.func.count(table.c.id),
+            sql.func.max(table.c.id),
+            sql.func.max(table.c.created_at),
+            sql.func.max(table.c.updated_at),
         )
-        res = ctx.session.execute(sel).fetchall()
-        self._id_cache = {r[1]: r[0] for r in res}
-        self._str_cache = {r[0]: r[1] for r in res}
-        self._all_cache = {r[1]: r for r in res}
+        return tuple(ctx.session.execute(sel).fetchone())
+
+    def _add_defaults(self):
+        """Override this to add values to the cache that are not coming from
+        the database each time it is loaded.
+        """
+        pass
 
     def _add_attribute(self, attr_id, name, created_at, updated_at):
         """Use this to add values to the cache that are not coming from the
@@ -174,9 +325,7 @@ class ConsumerTypeCache(_AttributeCache):
     _table = _CONSUMER_TYPE_TBL
     _not_found = exception.ConsumerTypeNotFound
 
-    @db_api.placement_context_manager.reader
-    def _refresh_from_db(self, ctx):
-        super(ConsumerTypeCache, self)._refresh_from_db(ctx)
+    def _add_defaults(self):
         # The consumer_type_id is nullable and records with a NULL (None)
         # consumer_type_id are considered as 'unknown'. Also the 'unknown'
         # consumer_type is not created in the database so we need to manually
@@ -202,3 +351,40 @@ class TraitCache(_AttributeCache):
 
     _table = _TRAIT_TBL
     _not_found = exception.TraitNotFound
+
+
+class ExternalIdCache(object):
+    """A least recently used cache of the internal ids of the projects or the
+    users, by external id, shared by the requests served by this process.
+
+    Placement never changes nor deletes a project or user record once it is
+    created, so the cached ids never need to be invalidated.
+    """
+
+    def __init__(self, name):
+        self._lock_name = 'external_id_cache_%s' % name
+        self._ids = collections.OrderedDict()
+
+    def get(self, external_id):
+        """Returns the cached internal id for external_id, or None, marking
+        it as the most recently used.
+        """
+        with lockutils.lock(self._lock_name):
+            internal_id = self._ids.get(external_id)
+            if internal_id is not None:
+                self._ids.move_to_end(external_id)
+            return internal_id
+
+    def set(self, ctx, external_id, internal_id):
+        size = ctx.config.placement.external_id_cache_size
+        if not size:
+            return
+        with lockutils.lock(self._lock_name):
+            self._ids[external_id] = internal_id
+            self._ids.move_to_end(external_id)
+            while len(self._ids) > size:
+                self._ids.popitem(last=False)
+
+    def clear(self):
+        with lockutils.lock(self._lock_name):
+            self._ids.clear()
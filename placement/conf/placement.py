@@ -59,6 +59,164 @@ doesn't provide.
 The number of times to retry, server-side, writing allocations when there is
 a resource provider generation conflict. Raising this value may be useful
 when many concurrent allocations to the same resource provider are expected.
+"""),
+    cfg.BoolOpt(
+        'allocation_candidates_snapshot',
+        default=False,
+        help="""
+If True, each placement API process keeps an in-memory snapshot of resource
+providers, their inventories, usages, traits and aggregates, and uses it to
+answer ``GET /allocation_candidates`` instead of querying the database for
+every request. The snapshot is refreshed by comparing resource provider
+generations and a fingerprint of the allocations table with the database at
+most every ``allocation_candidates_snapshot_refresh_interval`` seconds, and is
+rebuilt from scratch every ``allocation_candidates_snapshot_max_age`` seconds.
+
+Candidates may therefore be up to one refresh interval out of date. If the
+snapshot yields no candidates, the request is retried against the database.
+Allocations written by clients are always checked against the database, so
+stale candidates result in a retryable conflict, not in overcommitted
+providers.
+"""),
+    cfg.IntOpt(
+        'allocation_candidates_snapshot_refresh_interval',
+        default=1,
+        min=0,
+        help="""
+The minimum number of seconds between two refreshes of the allocation
+candidates provider snapshot. Each refresh reads the generation of every
+resource provider and reloads the providers that changed, or the usages of
+all of them if allocations were written or removed. Only used if
+``allocation_candidates_snapshot`` is True.
+"""),
+    cfg.IntOpt(
+        'allocation_candidates_snapshot_max_age',
+        default=300,
+        min=0,
+        help="""
+The number of seconds after which the allocation candidates provider snapshot
+is rebuilt from scratch rather than refreshed. Only used if
+``allocation_candidates_snapshot`` is True.
+"""),
+    cfg.BoolOpt(
+        'allocation_candidates_profiling',
+        default=False,
+        help="""
+If True, the time spent, the number of SQL statements executed and the number
+of results produced by each phase of every ``GET /allocation_candidates``
+request are recorded. The phases of the requests of the last
+``allocation_candidates_profiling_report_interval`` seconds are summarized in
+a log message at INFO level once per interval and, if
+``allocation_candidates_server_timing`` is True, the phases of each request
+are returned to the client. The overhead is small enough to leave this
+enabled in production.
+"""),
+    cfg.BoolOpt(
+        'allocation_candidates_server_timing',
+        default=False,
+        help="""
+If True, responses to ``GET /allocation_candidates`` include a
+``Server-Timing`` header giving the time spent, the number of SQL statements
+executed and the number of results produced by each phase of the request.
+Only used if ``allocation_candidates_profiling`` is True.
+"""),
+    cfg.IntOpt(
+        'allocation_candidates_profiling_report_interval',
+        default=300,
+        min=0,
+        help="""
+The number of seconds over which the phases of ``GET /allocation_candidates``
+requests are aggregated, per placement API process, in a rolling histogram.
+The distribution of the times of the phases in the histogram and the average
+number of SQL statements they executed are logged at INFO level once every
+this many seconds. Older requests drop out of the histogram as time passes,
+rather than when it is logged. Set to 0 to disable the histogram. Only used if
+``allocation_candidates_profiling`` is True.
+"""),
+    cfg.IntOpt(
+        'allocation_candidates_group_workers',
+        default=0,
+        min=0,
+        help="""
+The number of threads each placement API process uses to search for the
+resource providers of the request groups of ``GET /allocation_candidates``
+requests concurrently, each thread using a database connection and
+transaction of its own. A request with several request groups then takes
+about as long as its slowest group rather than as long as all of them
+together. The threads are shared by all of the requests served by the process.
+
+As the request groups are not searched in the same transaction, allocations
+written while a request is served can be seen by some of its groups and not
+by others, so some of the candidates returned may already be out of date.
+Allocations written by clients are always checked against the database, so
+claiming such a candidate results in a retryable conflict, not in
+overcommitted providers.
+
+Set to 0 or 1 to search for the request groups one after the other, in the
+transaction of the thread serving the request. The request groups are always
+searched one after the other with an in-memory SQLite database, which can't
+serve the transactions of several threads at once.
+"""),
+    cfg.IntOpt(
+        'allocation_candidates_cache_ttl',
+        default=0,
+        min=0,
+        help="""
+The number of seconds for which each placement API process remembers the
+result of a ``GET /allocation_candidates`` request, returning it to identical
+requests, such as those made by a scheduler placing many instances of the
+same flavor, instead of searching again. A remembered result is not returned
+once the same process has changed a resource provider, its inventories,
+traits, aggregates or allocations, or once any process has created a resource
+provider or an allocation. Other changes made through other processes, such
+as allocations being removed, may take up to this many seconds to be seen.
+Results are not remembered if ``randomize_allocation_candidates`` is True.
+Set to 0 to always search.
+"""),
+    cfg.IntOpt(
+        'allocation_candidates_cache_size',
+        default=128,
+        min=1,
+        help="""
+The maximum number of ``GET /allocation_candidates`` results each placement
+API process remembers, the least recently used ones being forgotten first.
+Only used if ``allocation_candidates_cache_ttl`` is not 0.
+"""),
+    cfg.IntOpt(
+        'attribute_cache_not_found_ttl',
+        default=5,
+        min=0,
+        help="""
+The number of seconds for which each placement API process remembers that a
+resource class, trait or consumer type looked up by a request does not exist,
+answering the same lookup without querying the database. A resource class,
+trait or consumer type created through another process may therefore not be
+found by this one for up to this many seconds. Set to 0 to always query the
+database.
+"""),
+    cfg.IntOpt(
+        'external_id_cache_size',
+        default=10000,
+        min=0,
+        help="""
+The maximum number of project and of user external IDs for which each
+placement API process remembers the internal ID, the least recently used ones
+being forgotten first. This saves looking up the project and user when writing
+allocations, and joining with the projects and users tables for
+``GET /usages``. Set to 0 to always query the database.
+"""),
+    cfg.IntOpt(
+        'provider_topology_cache_ttl',
+        default=0,
+        min=0,
+        help="""
+The number of seconds for which each placement API process reuses the answer
+to whether any nested resource providers exist, and the set of resource
+providers having the ``MISC_SHARES_VIA_AGGREGATE`` trait, when searching for
+allocation candidates. Changes made through this process are seen
+immediately, but a nested or sharing resource provider created through
+another process may be left out of allocation candidates for up to this many
+seconds. Set to 0, the default, to always query the database.
 """),
 ]
 
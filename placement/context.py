@@ -26,6 +26,13 @@ class RequestContext(context.RequestContext):
         self.ct_cache = attribute_cache.ConsumerTypeCache(self)
         self.rc_cache = attribute_cache.ResourceClassCache(self)
         self.trait_cache = attribute_cache.TraitCache(self)
+        # A placement.objects.provider_snapshot.ProviderSnapshot used in
+        # place of the database while searching for allocation candidates,
+        # if that is enabled.
+        self.provider_snapshot = None
+        # A placement.objects.search_profile.SearchProfile recording the
+        # phases of the search for allocation candidates, if that is enabled.
+        self.search_profile = None
         super(RequestContext, self).__init__(*args, **kwargs)
 
     def can(self, action, target=None, fatal=True):
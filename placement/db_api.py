@@ -13,6 +13,7 @@
 
 from oslo_db.sqlalchemy import enginefacade
 from oslo_log import log as logging
+import sqlalchemy as sa
 
 from placement.util import run_once
 
@@ -40,6 +41,64 @@ def get_placement_engine():
     return placement_context_manager.writer.get_engine()
 
 
+def call_after_commit(ctx, func):
+    """Calls func() once the transaction of ctx is committed. If it is rolled
+    back instead, func() is never called.
+
+    Must be called from within a placement_context_manager.writer context.
+    """
+    sa.event.listen(
+        ctx.session, 'after_commit', lambda session: func(), once=True)
+
+
+def increment_generations(ctx, table, objs, exc_class):
+    """Increments the generations of the supplied objects, rows of table, with
+    a single compare-and-swap UPDATE, supplying their currently-known
+    generations.
+
+    Must be called from within a placement_context_manager.writer context.
+
+    :param table: A table with id and generation columns.
+    :param objs: An iterable of distinct objects with id, uuid and generation
+                 attributes, for rows of table.
+    :param exc_class: The exception to raise if any of the rows had been
+                      updated by another thread in between the time when its
+                      object was originally read and this call.
+    """
+    objs = list(objs)
+    if not objs:
+        return
+    upd_stmt = table.update().where(
+        sa.tuple_(table.c.id, table.c.generation).in_(
+            [(obj.id, obj.generation) for obj in objs])).values(
+        generation=table.c.generation + 1)
+    res = ctx.session.execute(upd_stmt)
+    if res.rowcount != len(objs):
+        LOG.debug('Concurrent update detected on %s %s', table.name,
+                  _conflicting_generations(ctx, table, objs))
+        raise exc_class()
+    for obj in objs:
+        obj.generation += 1
+
+
+def _conflicting_generations(ctx, table, objs):
+    """Returns a string describing which of the supplied objects, whose
+    generations increment_generations() just failed to all increment, had
+    been updated by another thread.
+
+    Those are the rows whose generation is now something else than the
+    incremented one. A row updated exactly once by another thread cannot be
+    told apart from one this thread updated, so it may be missing.
+    """
+    sel = sa.select(table.c.id, table.c.generation).where(
+        table.c.id.in_([obj.id for obj in objs]))
+    current = dict(ctx.session.execute(sel).fetchall())
+    return ', '.join(
+        '%s (generation %s, expected %d)' % (
+            obj.uuid, current.get(obj.id), obj.generation)
+        for obj in objs if current.get(obj.id) != obj.generation + 1)
+
+
 @enginefacade.transaction_context_provider
 class DbContext(object):
     """Stub class for db session handling outside of web requests."""
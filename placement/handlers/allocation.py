@@ -12,6 +12,7 @@
 """Placement API handlers for setting and deleting allocations."""
 
 import collections
+import itertools
 import uuid
 
 from oslo_log import log as logging
@@ -179,11 +180,15 @@ def create_allocation_list(context, data, consumers):
     """
     allocation_objects = []
 
+    # Look up the providers of all of the consumers at once.
+    rp_objs = _resource_providers_by_uuid(
+        context, itertools.chain.from_iterable(
+            data[consumer_uuid]['allocations'] for consumer_uuid in data))
+
     for consumer_uuid in data:
         allocations = data[consumer_uuid]['allocations']
         consumer = consumers[consumer_uuid]
         if allocations:
-            rp_objs = _resource_providers_by_uuid(context, allocations.keys())
             for resource_provider_uuid in allocations:
                 resource_provider = rp_objs[resource_provider_uuid]
                 resources = allocations[resource_provider_uuid]['resources']
@@ -208,12 +213,9 @@ def create_allocation_list(context, data, consumers):
 def inspect_consumers(context, data, want_version):
     """Look at consumer data in allocations and create consumers as needed.
 
-    Keep a record of the consumers that are created in case they need
-    to be removed later.
-
-    If an exception is raised by ensure_consumer, commonly HTTPConflict but
-    also anything else, the newly created consumers will be deleted and the
-    exception reraised to the caller.
+    The consumers, and their projects and users, are looked up and created
+    in bulk by ensure_consumers. If it raises, commonly HTTPConflict but also
+    anything else, no new consumer is left behind.
 
     :param context: The placement context.
     :param data: A dictionary of multiple allocations by consumer uuid.
@@ -222,38 +224,15 @@ def inspect_consumers(context, data, want_version):
                            a list of those consumer objects which are new,
                            a dict of RequestAttr objects (by consumer_uuid))
     """
-    # First, ensure that all consumers referenced in the payload actually
-    # exist. And if not, create them. Keep a record of auto-created consumers
-    # so we can clean them up if the end allocation replace_all() fails.
-    consumers = {}  # dict of Consumer objects, keyed by consumer UUID
-    new_consumers_created = []
-    # Save requested attributes in order to do an update later in the same
-    # database transaction as AllocationList.replace_all() so that rollbacks
-    # can happen properly. Consumer table updates are guarded by the
-    # generation, so we can't necessarily save all of the original attribute
-    # values and write them back into the table in the event of an exception.
-    # If the generation doesn't match, Consumer.update() is a no-op.
-    requested_attrs = {}
-    for consumer_uuid in data:
-        project_id = data[consumer_uuid]['project_id']
-        user_id = data[consumer_uuid]['user_id']
-        consumer_generation = data[consumer_uuid].get('consumer_generation')
-        consumer_type = data[consumer_uuid].get('consumer_type')
-        try:
-            consumer, new_consumer_created, request_attr = (
-                data_util.ensure_consumer(
-                    context, consumer_uuid, project_id,
-                    user_id, consumer_generation, consumer_type, want_version))
-            if new_consumer_created:
-                new_consumers_created.append(consumer)
-            consumers[consumer_uuid] = consumer
-            requested_attrs[consumer_uuid] = request_attr
-        except Exception:
-            # If any errors (for instance, a consumer generation conflict)
-            # occur when ensuring consumer records above, make sure we delete
-            # any auto-created consumers.
-            with excutils.save_and_reraise_exception():
-                delete_consumers(new_consumers_created)
+    # ensure_consumers() fetches all the existing consumers, projects and
+    # users with one query each and inserts the missing ones in one batch.
+    # Changes to the attributes of existing consumers are not written here
+    # but returned as requested_attrs, so that they can be applied in the
+    # same transaction as AllocationList.replace_all(). The new consumers
+    # are returned so that the caller can delete them if replace_all()
+    # fails.
+    consumers, new_consumers_created, requested_attrs = (
+        data_util.ensure_consumers(context, data, want_version))
     return consumers, new_consumers_created, requested_attrs
 
 
@@ -335,20 +314,14 @@ def _resource_providers_by_uuid(ctx, rp_uuids):
     :raises: `webob.exc.HTTPBadRequest` if any of the UUIDs do not refer to
              an existing resource provider.
     """
-    res = {}
-    for rp_uuid in rp_uuids:
-        # TODO(jaypipes): Clearly, this is not efficient to do one query for
-        # each resource provider UUID in the allocations instead of doing a
-        # single query for all the UUIDs. However, since
-        # rp_obj.get_all_by_filters() is way too complicated for
-        # this purpose and doesn't raise NotFound anyway, we'll do this.
-        # Perhaps consider adding a rp_obj.get_all_by_uuids() later on?
-        try:
-            res[rp_uuid] = rp_obj.ResourceProvider.get_by_uuid(ctx, rp_uuid)
-        except exception.NotFound:
-            raise webob.exc.HTTPBadRequest(
-                "Allocation for resource provider '%(rp_uuid)s' "
-                "that does not exist." % {'rp_uuid': rp_uuid})
+    rp_uuids = list(rp_uuids)
+    res, missing = rp_obj.get_all_by_uuids(ctx, rp_uuids)
+    if missing:
+        # Report the first missing provider in the order they were asked for
+        rp_uuid = next(rp_uuid for rp_uuid in rp_uuids if rp_uuid in missing)
+        raise webob.exc.HTTPBadRequest(
+            "Allocation for resource provider '%(rp_uuid)s' "
+            "that does not exist." % {'rp_uuid': rp_uuid})
     return res
 
 
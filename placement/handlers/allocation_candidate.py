@@ -23,6 +23,7 @@ from placement import exception
 from placement import lib
 from placement import microversion
 from placement.objects import allocation_candidate as ac_obj
+from placement.objects import search_profile
 from placement.policies import allocation_candidate as policies
 from placement.schemas import allocation_candidate as schema
 from placement import util
@@ -31,107 +32,98 @@ from placement import wsgi_wrapper
 # The microversions at which the schema used to validate
 # query parameters to GET /allocation_candidates differs.
 _GET_SCHEMA_MICROVERSIONS = [
-    (1, 36), (1, 35), (1, 33), (1, 31), (1, 25), (1, 21), (1, 17), (1, 16)
+    (1, 40), (1, 36), (1, 35), (1, 33), (1, 31), (1, 25), (1, 21), (1, 17),
+    (1, 16)
 ]
 
+# The number of characters of the response body to GET /allocation_candidates
+# gathered before they are handed, encoded, to the WSGI server.
+_BODY_CHUNK_SIZE = 64 * 1024
 
-def _transform_allocation_requests_dict(alloc_reqs, want_version):
-    """Turn supplied list of AllocationRequest objects into a list of
-    allocations dicts keyed by resource provider uuid of resources involved
-    in the allocation request. The returned results are intended to be used
-    as the body of a PUT /allocations/{consumer_uuid} HTTP request at
-    micoversion 1.12 (and beyond). The JSON objects look like the following:
 
-    [
-        {
-            "allocations": {
-                $rp_uuid1: {
-                    "resources": {
-                        "MEMORY_MB": 512
-                        ...
-                    }
-                },
-                $rp_uuid2: {
-                    "resources": {
-                        "DISK_GB": 1024
-                        ...
-                    }
+def _transform_allocation_request_dict(ar, want_version):
+    """Turn supplied AllocationRequest object into an allocations dict keyed
+    by resource provider uuid of resources involved in the allocation request.
+    The returned result is intended to be used as the body of a PUT
+    /allocations/{consumer_uuid} HTTP request at micoversion 1.12 (and
+    beyond). The JSON object looks like the following:
+
+    {
+        "allocations": {
+            $rp_uuid1: {
+                "resources": {
+                    "MEMORY_MB": 512
+                    ...
                 }
             },
-            # If microversion >=1.34 then map suffixes to providers.
-            "mappings": {
-                "_COMPUTE": [$rp_uuid2],
-                "": [$rp_uuid1]
+            $rp_uuid2: {
+                "resources": {
+                    "DISK_GB": 1024
+                    ...
+                }
+            }
+        },
+        # If microversion >=1.34 then map suffixes to providers.
+        "mappings": {
+            "_COMPUTE": [$rp_uuid2],
+            "": [$rp_uuid1]
 
-            },
         },
-        ...
-    ]
-    """
-    results = []
-
-    for ar in alloc_reqs:
-        # A default dict of {$rp_uuid: "resources": {})
-        rp_resources = collections.defaultdict(lambda: dict(resources={}))
-        for rr in ar.resource_requests:
-            res_dict = rp_resources[rr.resource_provider.uuid]['resources']
-            res_dict[rr.resource_class] = rr.amount
-        result = dict(allocations=rp_resources)
-        if want_version.matches((1, 34)):
-            result['mappings'] = ar.mappings
-        results.append(result)
-
-    return results
-
-
-def _transform_allocation_requests_list(alloc_reqs):
-    """Turn supplied list of AllocationRequest objects into a list of dicts of
-    resources involved in the allocation request. The returned results is
-    intended to be able to be used as the body of a PUT
-    /allocations/{consumer_uuid} HTTP request, prior to microversion 1.12,
-    so therefore we return a list of JSON objects that looks like the
-    following:
-
-    [
-        {
-            "allocations": [
-                {
-                    "resource_provider": {
-                        "uuid": $rp_uuid,
-                    }
-                    "resources": {
-                        $resource_class: $requested_amount, ...
-                    },
-                }, ...
-            ],
-        }, ...
-    ]
+    }
     """
-    results = []
-    for ar in alloc_reqs:
-        provider_resources = collections.defaultdict(dict)
-        for rr in ar.resource_requests:
-            res_dict = provider_resources[rr.resource_provider.uuid]
-            res_dict[rr.resource_class] = rr.amount
-
-        allocs = [
+    # A default dict of {$rp_uuid: "resources": {})
+    rp_resources = collections.defaultdict(lambda: dict(resources={}))
+    for rr in ar.resource_requests:
+        res_dict = rp_resources[rr.resource_provider.uuid]['resources']
+        res_dict[rr.resource_class] = rr.amount
+    result = dict(allocations=rp_resources)
+    if want_version.matches((1, 34)):
+        result['mappings'] = ar.mappings
+    return result
+
+
+def _transform_allocation_request_list(ar):
+    """Turn supplied AllocationRequest object into a dict of resources
+    involved in the allocation request. The returned result is intended to be
+    able to be used as the body of a PUT /allocations/{consumer_uuid} HTTP
+    request, prior to microversion 1.12, so therefore we return a JSON object
+    that looks like the following:
+
+    {
+        "allocations": [
             {
                 "resource_provider": {
-                    "uuid": rp_uuid,
+                    "uuid": $rp_uuid,
+                }
+                "resources": {
+                    $resource_class: $requested_amount, ...
                 },
-                "resources": resources,
-            } for rp_uuid, resources in provider_resources.items()
-        ]
-        alloc = {
-            "allocations": allocs
-        }
-        results.append(alloc)
-    return results
+            }, ...
+        ],
+    }
+    """
+    provider_resources = collections.defaultdict(dict)
+    for rr in ar.resource_requests:
+        res_dict = provider_resources[rr.resource_provider.uuid]
+        res_dict[rr.resource_class] = rr.amount
+
+    allocs = [
+        {
+            "resource_provider": {
+                "uuid": rp_uuid,
+            },
+            "resources": resources,
+        } for rp_uuid, resources in provider_resources.items()
+    ]
+    return {
+        "allocations": allocs
+    }
 
 
 def _transform_provider_summaries(p_sums, requests, want_version):
-    """Turn supplied list of ProviderSummary objects into a dict, keyed by
-    resource provider UUID, of dicts of provider and inventory information.
+    """Turn supplied list of ProviderSummary objects into (resource provider
+    UUID, dict of provider and inventory information) tuples, generated in the
+    order of the list. Put in a dict, they look like the example below.
     The traits only show up when `want_version` is 1.17 or newer. All the
     resource classes are shown when `want_version` is 1.27 or newer while
     only requested resources are included in the `provider_summaries`
@@ -185,7 +177,6 @@ def _transform_provider_summaries(p_sums, requests, want_version):
     include_all_resources = want_version.matches((1, 27))
     enable_nested_providers = want_version.matches((1, 29))
 
-    ret = {}
     requested_resources = set()
 
     for requested_group in requests.values():
@@ -203,43 +194,65 @@ def _transform_provider_summaries(p_sums, requests, want_version):
                 psr.resource_class in requested_resources)
         }
 
-        ret[ps.resource_provider.uuid] = {'resources': resources}
+        summary = {'resources': resources}
 
         if include_traits:
-            ret[ps.resource_provider.uuid]['traits'] = ps.traits
+            summary['traits'] = ps.traits
 
         if enable_nested_providers:
-            ret[ps.resource_provider.uuid]['parent_provider_uuid'] = (
+            summary['parent_provider_uuid'] = (
                 ps.resource_provider.parent_provider_uuid)
-            ret[ps.resource_provider.uuid]['root_provider_uuid'] = (
+            summary['root_provider_uuid'] = (
                 ps.resource_provider.root_provider_uuid)
 
-    return ret
+        yield ps.resource_provider.uuid, summary
 
 
-def _transform_allocation_candidates(alloc_cands, requests, want_version):
-    """Turn supplied AllocationCandidates object into a dict containing
-    allocation requests and provider summaries.
+def _serialize_allocation_candidates(alloc_cands, requests, want_version):
+    """Generate the JSON text of the supplied AllocationCandidates object, a
+    dict containing allocation requests and provider summaries, piece by
+    piece. Joined, the pieces are the same as the output of jsonutils.dumps()
+    for the whole dict:
 
     {
         'allocation_requests': <ALLOC_REQUESTS>,
         'provider_summaries': <PROVIDER_SUMMARIES>,
     }
     """
-    if want_version.matches((1, 12)):
-        a_reqs = _transform_allocation_requests_dict(
-            alloc_cands.allocation_requests, want_version)
-    else:
-        a_reqs = _transform_allocation_requests_list(
-            alloc_cands.allocation_requests)
-
+    want_dict = want_version.matches((1, 12))
+    yield '{"allocation_requests": ['
+    for i, ar in enumerate(alloc_cands.allocation_requests):
+        if want_dict:
+            a_req = _transform_allocation_request_dict(ar, want_version)
+        else:
+            a_req = _transform_allocation_request_list(ar)
+        yield (', ' if i else '') + jsonutils.dumps(a_req)
+
+    yield '], "provider_summaries": {'
     p_sums = _transform_provider_summaries(
         alloc_cands.provider_summaries, requests, want_version)
+    for i, (rp_uuid, p_sum) in enumerate(p_sums):
+        yield '%s%s: %s' % (
+            ', ' if i else '', jsonutils.dumps(rp_uuid),
+            jsonutils.dumps(p_sum))
+    yield '}}'
 
-    return {
-        'allocation_requests': a_reqs,
-        'provider_summaries': p_sums,
-    }
+
+def _encode_chunks(pieces, chunk_size=_BODY_CHUNK_SIZE):
+    """Join the supplied strings into UTF-8 encoded chunks of at least
+    chunk_size characters (but the last one), suitable for a WSGI app_iter.
+    """
+    buf = []
+    buf_len = 0
+    for piece in pieces:
+        buf.append(piece)
+        buf_len += len(piece)
+        if buf_len >= chunk_size:
+            yield encodeutils.to_utf8(''.join(buf))
+            buf = []
+            buf_len = 0
+    if buf:
+        yield encodeutils.to_utf8(''.join(buf))
 
 
 def _get_schema(want_version):
@@ -283,6 +296,10 @@ def list_allocation_candidates(req):
     # We can't be aware of nested architecture with old microversions
     nested_aware = want_version.matches((1, 29))
 
+    conf = context.config.placement
+    profile = None
+    if conf.allocation_candidates_profiling:
+        profile = context.search_profile = search_profile.SearchProfile()
     try:
         cands = ac_obj.AllocationCandidates.get_by_requests(
             context, groups, rqparams, nested_aware=nested_aware)
@@ -292,11 +309,23 @@ def list_allocation_candidates(req):
             {'error': exc})
     except exception.TraitNotFound as exc:
         raise webob.exc.HTTPBadRequest(str(exc))
+    finally:
+        context.search_profile = None
 
     response = req.response
-    trx_cands = _transform_allocation_candidates(cands, groups, want_version)
-    json_data = jsonutils.dumps(trx_cands)
-    response.body = encodeutils.to_utf8(json_data)
+    if profile is not None:
+        search_profile.record(context, profile)
+        if conf.allocation_candidates_server_timing:
+            response.headers['Server-Timing'] = profile.server_timing()
+    # Rather than building the whole response body as a dict, then as a
+    # string and then as bytes, it is serialized into UTF-8 chunks one
+    # allocation request or provider summary at a time. The chunks are kept
+    # until the WSGI server consumes them so that the Content-Length of the
+    # response is known, as clients, proxies and the request log expect.
+    body = list(_encode_chunks(
+        _serialize_allocation_candidates(cands, groups, want_version)))
+    response.app_iter = body
+    response.content_length = sum(len(chunk) for chunk in body)
     response.content_type = 'application/json'
     if want_version.matches((1, 15)):
         response.cache_control = 'no-cache'
@@ -14,6 +14,7 @@
 import collections
 
 from oslo_log import log as logging
+from oslo_utils import excutils
 import webob
 
 from placement import errors
@@ -51,6 +52,10 @@ def get_or_create_consumer_type_id(ctx, name):
 
 
 def _get_or_create_project(ctx, project_id):
+    # The internal id is all that is needed of an existing project
+    internal_id = project_obj.ID_CACHE.get(project_id)
+    if internal_id is not None:
+        return project_obj.Project(ctx, id=internal_id, external_id=project_id)
     try:
         proj = project_obj.Project.get_by_external_id(ctx, project_id)
     except exception.NotFound:
@@ -65,6 +70,10 @@ def _get_or_create_project(ctx, project_id):
 
 
 def _get_or_create_user(ctx, user_id):
+    # The internal id is all that is needed of an existing user
+    internal_id = user_obj.ID_CACHE.get(user_id)
+    if internal_id is not None:
+        return user_obj.User(ctx, id=internal_id, external_id=user_id)
     try:
         user = user_obj.User.get_by_external_id(ctx, user_id)
     except exception.NotFound:
@@ -100,6 +109,28 @@ def _create_consumer(ctx, consumer_uuid, project, user, consumer_type_id):
     return consumer, created_new_consumer
 
 
+def _check_consumer_generation(consumer, consumer_generation):
+    """Raises HTTPConflict if the generation provided by the user does not
+    match that of the existing consumer, or is not None when the consumer
+    does not exist.
+    """
+    if consumer is None:
+        if consumer_generation is not None:
+            raise webob.exc.HTTPConflict(
+                'consumer generation conflict - '
+                'expected null but got %s' % consumer_generation,
+                comment=errors.CONCURRENT_UPDATE)
+    elif consumer.generation != consumer_generation:
+        raise webob.exc.HTTPConflict(
+            'consumer generation conflict - '
+            'expected %(expected_gen)s but got %(got_gen)s' %
+            {
+                'expected_gen': consumer.generation,
+                'got_gen': consumer_generation,
+            },
+            comment=errors.CONCURRENT_UPDATE)
+
+
 def ensure_consumer(ctx, consumer_uuid, project_id, user_id,
                     consumer_generation, consumer_type, want_version):
     """Ensures there are records in the consumers, projects and users table for
@@ -138,15 +169,7 @@ def ensure_consumer(ctx, consumer_uuid, project_id, user_id,
     try:
         consumer = consumer_obj.Consumer.get_by_uuid(ctx, consumer_uuid)
         if requires_consumer_generation:
-            if consumer.generation != consumer_generation:
-                raise webob.exc.HTTPConflict(
-                    'consumer generation conflict - '
-                    'expected %(expected_gen)s but got %(got_gen)s' %
-                    {
-                        'expected_gen': consumer.generation,
-                        'got_gen': consumer_generation,
-                    },
-                    comment=errors.CONCURRENT_UPDATE)
+            _check_consumer_generation(consumer, consumer_generation)
         if requires_consumer_type:
             cons_type_id = get_or_create_consumer_type_id(ctx, consumer_type)
     except exception.NotFound:
@@ -156,11 +179,7 @@ def ensure_consumer(ctx, consumer_uuid, project_id, user_id,
         # existing consumer with this UUID and therefore the user should be
         # indicating that they expect the consumer did not exist.
         if requires_consumer_generation:
-            if consumer_generation is not None:
-                raise webob.exc.HTTPConflict(
-                    'consumer generation conflict - '
-                    'expected null but got %s' % consumer_generation,
-                    comment=errors.CONCURRENT_UPDATE)
+            _check_consumer_generation(None, consumer_generation)
 
         if requires_consumer_type:
             cons_type_id = get_or_create_consumer_type_id(ctx, consumer_type)
@@ -176,6 +195,93 @@ def ensure_consumer(ctx, consumer_uuid, project_id, user_id,
     return consumer, created_new_consumer, request_attr
 
 
+def ensure_consumers(ctx, data, want_version):
+    """Ensures there are records in the consumers, projects and users table for
+    all the consumers of a multi-consumer allocation request, like
+    ensure_consumer() does for a single one.
+
+    The projects, users and consumers are looked up with one query each
+    whatever the number of consumers, and the missing ones are created with
+    one INSERT each. The consumer generations are all checked before any
+    consumer is created, so that a conflict leaves no consumer behind.
+
+    Returns a 3-tuple containing:
+        - a dict of the populated Consumer objects by consumer_uuid
+        - a list of the Consumer objects which were created
+        - a dict of RequestAttr objects by consumer_uuid
+
+    :param ctx: The request context.
+    :param data: A dictionary of multiple allocations by consumer uuid.
+    :param want_version: the microversion matcher.
+    :raises webob.exc.HTTPConflict if consumer generation is required and there
+            was a mismatch
+    """
+    requires_consumer_generation = want_version.matches((1, 28))
+    requires_consumer_type = want_version.matches((1, 38))
+
+    owners = {}
+    for consumer_uuid, alloc_data in data.items():
+        project_id = alloc_data['project_id']
+        user_id = alloc_data['user_id']
+        if project_id is None:
+            project_id = ctx.config.placement.incomplete_consumer_project_id
+            user_id = ctx.config.placement.incomplete_consumer_user_id
+        owners[consumer_uuid] = (project_id, user_id)
+    projects = project_obj.get_or_create_all_by_external_ids(
+        ctx, (project_id for project_id, _ in owners.values()))
+    users = user_obj.get_or_create_all_by_external_ids(
+        ctx, (user_id for _, user_id in owners.values()))
+    existing = consumer_obj.get_all_by_uuids(ctx, data)
+
+    consumers = {}
+    request_attrs = {}
+    to_create = []
+    for consumer_uuid, alloc_data in data.items():
+        consumer = existing.get(consumer_uuid)
+        if requires_consumer_generation:
+            _check_consumer_generation(
+                consumer, alloc_data.get('consumer_generation'))
+        cons_type_id = None
+        if requires_consumer_type:
+            cons_type_id = get_or_create_consumer_type_id(
+                ctx, alloc_data.get('consumer_type'))
+        project_id, user_id = owners[consumer_uuid]
+        proj = projects[project_id]
+        user = users[user_id]
+        if consumer is None:
+            # No such consumer. This is common for new allocations. Create
+            # the consumer record below, along with the others.
+            consumer = consumer_obj.Consumer(
+                ctx, uuid=consumer_uuid, project=proj, user=user,
+                consumer_type_id=cons_type_id)
+            to_create.append(consumer)
+        consumers[consumer_uuid] = consumer
+        request_attrs[consumer_uuid] = RequestAttr(proj, user, cons_type_id)
+
+    created = []
+    if to_create:
+        try:
+            consumer_obj.create_all(ctx, to_create)
+            created = to_create
+        except exception.ConsumerExists:
+            # Another thread created some of these consumers already, so
+            # create the others one at a time
+            try:
+                for consumer in to_create:
+                    consumer, created_new_consumer = _create_consumer(
+                        ctx, consumer.uuid, consumer.project, consumer.user,
+                        consumer.consumer_type_id)
+                    consumers[consumer.uuid] = consumer
+                    if created_new_consumer:
+                        created.append(consumer)
+            except Exception:
+                with excutils.save_and_reraise_exception():
+                    for consumer in created:
+                        consumer.delete()
+
+    return consumers, created, request_attrs
+
+
 def update_consumers(consumers, request_attrs):
     """Update consumers with the requested Project, User, and consumer type ID
     if they are different.
@@ -365,7 +365,7 @@ class RequestWideParams(object):
     """
     def __init__(self, limit=None, group_policy=None,
                  anchor_required_traits=None, anchor_forbidden_traits=None,
-                 same_subtrees=None):
+                 same_subtrees=None, sort=None):
         """Create a RequestWideParams.
 
         :param limit: An integer, N, representing the maximum number of
@@ -393,12 +393,20 @@ class RequestWideParams(object):
                 providers satisfying the specified request groups must be
                 rooted at one of the resource providers satisfying the request
                 groups.
+        :param sort: None, or a tuple of the sort strategy, "pack" or
+                "spread", and of a dict, keyed by resource class name, of the
+                weight of the free capacity of that resource class, or None to
+                weigh every resource class equally. With "pack", allocation
+                requests leaving the least of the weighted capacity of their
+                providers free come first, with "spread" those leaving the
+                most free come first.
         """
         self.limit = limit
         self.group_policy = group_policy
         self.anchor_required_traits = anchor_required_traits
         self.anchor_forbidden_traits = anchor_forbidden_traits
         self.same_subtrees = same_subtrees or []
+        self.sort = sort
 
     @classmethod
     def from_request(cls, req):
@@ -452,9 +460,31 @@ class RequestWideParams(object):
                         comment=errors.QUERYPARAM_BAD_VALUE)
                 same_subtrees.append(suffixes)
 
+        sort = req.GET.getall('sort')
+        if sort:
+            if len(sort) > 1:
+                raise webob.exc.HTTPBadRequest(
+                    "Query parameter 'sort' may be specified only once.",
+                    comment=errors.ILLEGAL_DUPLICATE_QUERYPARAM)
+            # JSONschema has already confirmed the format of sort.
+            strategy, _sep, weights = sort[0].partition(':')
+            if weights:
+                weights = dict(
+                    (rc_name, float(weight)) for rc_name, weight in (
+                        item.split('=') for item in weights.split(',')))
+                if not any(weights.values()):
+                    raise webob.exc.HTTPBadRequest(
+                        "At least one resource class must have a weight "
+                        "greater than 0 in 'sort'.",
+                        comment=errors.QUERYPARAM_BAD_VALUE)
+            sort = (strategy, weights or None)
+        else:
+            sort = None
+
         return cls(
             limit=limit,
             group_policy=group_policy,
             anchor_required_traits=anchor_required_traits,
             anchor_forbidden_traits=anchor_forbidden_traits,
-            same_subtrees=same_subtrees)
+            same_subtrees=same_subtrees,
+            sort=sort)
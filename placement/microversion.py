@@ -103,6 +103,8 @@ VERSIONS = [
              # parameter in the ``GET /resource_providers`` API as well as to
              # the ``required`` and ``requiredN`` query params of the
              # ``GET /allocation_candidates`` API.
+    '1.40',  # Adds a ``sort`` query parameter to
+             # ``GET /allocation_candidates``.
 ]
 
 
@@ -22,6 +22,7 @@ from placement import db_api
 from placement import exception
 from placement.objects import consumer as consumer_obj
 from placement.objects import project as project_obj
+from placement.objects import research_context as res_ctx
 from placement.objects import resource_provider as rp_obj
 from placement.objects import user as user_obj
 
@@ -51,14 +52,38 @@ class Allocation(object):
 
 
 @db_api.placement_context_manager.writer
-def _delete_allocations_for_consumer(ctx, consumer_id):
+def _delete_allocations_for_consumers(ctx, consumer_ids):
     """Deletes any existing allocations that correspond to the allocations to
     be written. This is wrapped in a transaction, so if the write subsequently
     fails, the deletion will also be rolled back.
     """
     del_sql = _ALLOC_TBL.delete().where(
-        _ALLOC_TBL.c.consumer_id == consumer_id)
-    ctx.session.execute(del_sql)
+        _ALLOC_TBL.c.consumer_id.in_(
+            sa.bindparam('consumer_ids', expanding=True)))
+    ctx.session.execute(del_sql, {'consumer_ids': list(consumer_ids)})
+
+
+def _set_allocation_ids(ctx, consumer_ids, allocs):
+    """Sets the ids of newly written allocations, looking them up with a
+    single query.
+
+    :param consumer_ids: The UUIDs of the consumers of allocs. They must have
+                         no other allocations.
+    :param allocs: The Allocation objects that were written.
+    """
+    sel = sa.select(
+        _ALLOC_TBL.c.id, _ALLOC_TBL.c.consumer_id,
+        _ALLOC_TBL.c.resource_provider_id, _ALLOC_TBL.c.resource_class_id,
+    ).where(_ALLOC_TBL.c.consumer_id.in_(
+        sa.bindparam('consumer_ids', expanding=True)))
+    id_by_key = {
+        (r.consumer_id, r.resource_provider_id, r.resource_class_id): r.id
+        for r in ctx.session.execute(
+            sel, {'consumer_ids': list(consumer_ids)})}
+    for alloc in allocs:
+        alloc.id = id_by_key[(
+            alloc.consumer.uuid, alloc.resource_provider.id,
+            ctx.rc_cache.id_from_string(alloc.resource_class))]
 
 
 @db_api.placement_context_manager.writer
@@ -68,6 +93,7 @@ def _delete_allocations_by_ids(ctx, alloc_ids):
     """
     del_sql = _ALLOC_TBL.delete().where(_ALLOC_TBL.c.id.in_(alloc_ids))
     ctx.session.execute(del_sql)
+    res_ctx.note_candidates_change(ctx)
 
 
 def _check_capacity_exceeded(ctx, allocs):
@@ -339,8 +365,10 @@ def _set_allocations(context, allocs):
     # provides a clean slate for the consumers mentioned in the list of
     # allocations being manipulated.
     consumer_ids = set(alloc.consumer.uuid for alloc in allocs)
-    for consumer_id in consumer_ids:
-        _delete_allocations_for_consumer(context, consumer_id)
+    _delete_allocations_for_consumers(context, consumer_ids)
+    # The providers the allocations are removed from don't get a new
+    # generation.
+    res_ctx.note_candidates_change(context)
 
     # Before writing any allocation records, we check that the submitted
     # allocations do not cause any inventory capacity to be exceeded for
@@ -363,6 +391,10 @@ def _set_allocations(context, allocs):
     # allocation is using a resource class that does not exist.
     visited_consumers = {}
     visited_rps = _check_capacity_exceeded(context, allocs)
+    # The allocation records to write, all at once, and the Allocation
+    # objects they are written for.
+    alloc_rows = []
+    written_allocs = []
     for alloc in allocs:
         if alloc.consumer.id not in visited_consumers:
             visited_consumers[alloc.consumer.id] = alloc.consumer
@@ -373,26 +405,25 @@ def _set_allocations(context, allocs):
         # continue
         if alloc.used == 0:
             continue
-        consumer_id = alloc.consumer.uuid
-        rp = alloc.resource_provider
-        rc_id = context.rc_cache.id_from_string(alloc.resource_class)
-        ins_stmt = _ALLOC_TBL.insert().values(
-            resource_provider_id=rp.id,
-            resource_class_id=rc_id,
-            consumer_id=consumer_id,
-            used=alloc.used)
-        res = context.session.execute(ins_stmt)
-        alloc.id = res.lastrowid
+        alloc_rows.append({
+            'resource_provider_id': alloc.resource_provider.id,
+            'resource_class_id': context.rc_cache.id_from_string(
+                alloc.resource_class),
+            'consumer_id': alloc.consumer.uuid,
+            'used': alloc.used,
+        })
+        written_allocs.append(alloc)
+    if alloc_rows:
+        context.session.execute(_ALLOC_TBL.insert(), alloc_rows)
+        _set_allocation_ids(context, consumer_ids, written_allocs)
 
     # Generation checking happens here. If the inventory for this resource
     # provider changed out from under us, this will raise a
     # ConcurrentUpdateDetected which can be caught by the caller to choose
     # to try again. It will also rollback the transaction so that these
     # changes always happen atomically.
-    for rp in visited_rps.values():
-        rp.increment_generation()
-    for consumer in visited_consumers.values():
-        consumer.increment_generation()
+    rp_obj.increment_generations(context, visited_rps.values())
+    consumer_obj.increment_generations(context, visited_consumers.values())
     # If any consumers involved in this transaction ended up having no
     # allocations, delete the consumer records. Exclude consumers that had
     # *some resource* in the allocation list with a total > 0 since clearly
@@ -508,22 +539,25 @@ def replace_all(context, alloc_list):
         except exception.ResourceProviderConcurrentUpdateDetected:
             LOG.debug('Retrying allocations write on resource provider '
                       'generation conflict')
-            # We only want to reload each unique resource provider once.
+            # We only want to reload each unique resource provider once, and
+            # all of them at once.
             alloc_rp_uuids = set(
                 alloc.resource_provider.uuid for alloc in alloc_list)
-            seen_rps = {}
-            for rp_uuid in alloc_rp_uuids:
-                # NOTE(melwitt): We use a separate database transaction to read
-                # the resource provider because we might be wrapped in an outer
-                # database transaction when we reach here. We want to get an
-                # up-to-date generation value in case a racing request has
-                # changed it after we began an outer transaction and this is
-                # the first time we are reading the resource provider records
-                # during our transaction.
-                db_context_manager = db_api.placement_context_manager
-                with db_context_manager.reader.independent.using(context):
-                    seen_rps[rp_uuid] = rp_obj.ResourceProvider.get_by_uuid(
-                        context, rp_uuid)
+            # NOTE(melwitt): We use a separate database transaction to read
+            # the resource provider because we might be wrapped in an outer
+            # database transaction when we reach here. We want to get an
+            # up-to-date generation value in case a racing request has
+            # changed it after we began an outer transaction and this is
+            # the first time we are reading the resource provider records
+            # during our transaction.
+            db_context_manager = db_api.placement_context_manager
+            with db_context_manager.reader.independent.using(context):
+                seen_rps, missing = rp_obj.get_all_by_uuids(
+                    context, alloc_rp_uuids)
+            if missing:
+                raise exception.NotFound(
+                    'No resource provider with uuid %s found' %
+                    ', '.join(sorted(missing)))
             for alloc in alloc_list:
                 rp_uuid = alloc.resource_provider.uuid
                 alloc.resource_provider = seen_rps[rp_uuid]
@@ -11,18 +11,23 @@
 #    under the License.
 
 import collections
+from concurrent import futures
+import contextlib
 import copy
 import itertools
+import time
 
 import os_traits
+from oslo_concurrency import lockutils
 from oslo_log import log as logging
 import sqlalchemy as sa
 
 from placement.db.sqlalchemy import models
 from placement import db_api
 from placement import exception
+from placement.objects import provider_snapshot
 from placement.objects import research_context as res_ctx
-from placement.objects import resource_provider as rp_obj
+from placement.objects import search_profile
 from placement.objects import trait as trait_obj
 
 
@@ -32,6 +37,17 @@ _RP_TBL = models.ResourceProvider.__table__
 
 LOG = logging.getLogger(__name__)
 
+_CACHE_LOCK = 'allocation_candidates_cache'
+# An OrderedDict, from the least to the most recently used, keyed by request
+# key and change watermark, of tuples of the time.monotonic() value at which
+# the result was cached and of the AllocationCandidates.
+_CACHE = collections.OrderedDict()
+
+_GROUP_EXECUTOR_LOCK = 'allocation_candidates_group_executor'
+# A tuple of the number of threads and the ThreadPoolExecutor searching for
+# the providers of request groups concurrently, once that has been needed.
+_GROUP_EXECUTOR = None
+
 
 class AllocationCandidates(object):
     """The AllocationCandidates object is a collection of possible allocations
@@ -56,7 +72,15 @@ class AllocationCandidates(object):
         of allocation requests constructed from that list of resource
         providers. If CONF.placement.randomize_allocation_candidates (on
         contex.config) is True (default is False) then the order of the
-        allocation requests will be randomized.
+        allocation requests will be randomized. If
+        CONF.placement.allocation_candidates_snapshot is True, the search is
+        run against the in-memory provider snapshot of this process, falling
+        back to the database if that finds nothing.
+
+        If CONF.placement.allocation_candidates_cache_ttl is not 0, and the
+        allocation requests are not randomized, the result is remembered by
+        this process for that many seconds and returned to identical requests
+        as long as no resource provider has changed in the meantime.
 
         :param context: placement.context.RequestContext object.
         :param groups: Dict, keyed by suffix, of placement.lib.RequestGroup
@@ -66,20 +90,69 @@ class AllocationCandidates(object):
                              if they come from the same tree.
         :return: An instance of AllocationCandidates with allocation_requests
                  and provider_summaries satisfying `requests`, limited
-                 according to `limit`.
+                 according to `limit`. It must not be modified, as it may
+                 be shared with other requests.
         """
-        try:
-            alloc_reqs, provider_summaries = cls._get_by_requests(
+        conf = context.config.placement
+        ttl = conf.allocation_candidates_cache_ttl
+        if not ttl or conf.randomize_allocation_candidates:
+            return cls._search(context, groups, rqparams, nested_aware)
+
+        with search_profile.phase(context, 'cache'):
+            key = (_request_key(groups, rqparams, nested_aware),
+                   _get_change_watermark(context))
+            cands = _get_cached(key, ttl)
+        if cands is not None:
+            LOG.debug('Returning cached allocation candidates')
+            return cands
+        # Let only one of a burst of identical requests do the search, the
+        # others then find its result in the cache.
+        with lockutils.lock(_CACHE_LOCK + '-%x' % (hash(key) & 0xffffffff)):
+            cands = _get_cached(key, ttl)
+            if cands is None:
+                cands = cls._search(context, groups, rqparams, nested_aware)
+                _set_cached(key, cands, conf.allocation_candidates_cache_size)
+        return cands
+
+    @classmethod
+    def _search(cls, context, groups, rqparams, nested_aware):
+        alloc_reqs, provider_summaries = [], []
+        if context.config.placement.allocation_candidates_snapshot:
+            with search_profile.phase(context, 'snapshot'):
+                context.provider_snapshot = provider_snapshot.get_snapshot(
+                    context)
+                context.provider_snapshot.use_attribute_caches(context)
+            try:
+                alloc_reqs, provider_summaries = (
+                    cls._get_by_requests_or_empty(
+                        context, groups, rqparams, nested_aware=nested_aware))
+            finally:
+                context.provider_snapshot = None
+            if not alloc_reqs:
+                # The snapshot may be slightly behind the database. Rather
+                # than tell the caller there is no room at all, which is the
+                # costly mistake, double check against the database.
+                LOG.debug('No allocation candidates found in the provider '
+                          'snapshot, retrying against the database')
+        if not alloc_reqs:
+            alloc_reqs, provider_summaries = cls._get_by_requests_or_empty(
                 context, groups, rqparams, nested_aware=nested_aware)
-        except exception.ResourceProviderNotFound:
-            alloc_reqs, provider_summaries = [], []
         return cls(
             allocation_requests=alloc_reqs,
             provider_summaries=provider_summaries,
         )
 
+    @classmethod
+    def _get_by_requests_or_empty(cls, context, groups, rqparams,
+                                  nested_aware=True):
+        try:
+            return cls._get_by_requests(
+                context, groups, rqparams, nested_aware=nested_aware)
+        except exception.ResourceProviderNotFound:
+            return [], []
+
     @staticmethod
-    def _get_by_one_request(rg_ctx, rw_ctx):
+    def _get_by_one_request(rg_ctx, rw_ctx, providers=None):
         """Get allocation candidates for one RequestGroup.
 
         Must be called from within an placement_context_manager.reader
@@ -87,7 +160,47 @@ class AllocationCandidates(object):
 
         :param rg_ctx: RequestGroupSearchContext.
         :param rw_ctx: RequestWideSearchContext.
+        :param providers: The result of _get_providers_for_one_request() for
+                          rg_ctx, if it has already been called.
+        """
+        context = rg_ctx.context
+        if providers is None:
+            providers = AllocationCandidates._get_providers_for_one_request(
+                rg_ctx, rw_ctx)
+        rp_candidates, rp_tuples = providers
+        with search_profile.phase(context, 'alloc_requests') as phase:
+            if rp_candidates is not None:
+                alloc_reqs = _alloc_candidates_multiple_providers(
+                    rg_ctx, rw_ctx, rp_candidates)
+            elif rp_tuples is not None:
+                alloc_reqs = _alloc_candidates_single_provider(
+                    rg_ctx, rw_ctx, rp_tuples)
+            else:
+                alloc_reqs = set()
+            phase.rows += len(alloc_reqs)
+        return alloc_reqs
+
+    @staticmethod
+    def _get_providers_for_one_request(rg_ctx, rw_ctx):
+        """Get the providers that may satisfy one RequestGroup.
+
+        :param rg_ctx: RequestGroupSearchContext.
+        :param rw_ctx: RequestWideSearchContext.
+        :return: A tuple of an RPCandidateList, to build allocation requests
+                 involving multiple providers from, and of a set of
+                 (provider ID, root provider ID) tuples, to build allocation
+                 requests involving a single provider from. At most one of
+                 them is not None.
         """
+        with search_profile.phase(rg_ctx.context, 'providers') as phase:
+            providers = AllocationCandidates._find_providers_for_one_request(
+                rg_ctx, rw_ctx)
+            phase.rows += len(providers[0] or providers[1] or ())
+        return providers
+
+    @staticmethod
+    def _find_providers_for_one_request(rg_ctx, rw_ctx):
+        """The unprofiled _get_providers_for_one_request()."""
         if not rg_ctx.use_same_provider and (
                 rg_ctx.exists_sharing or rg_ctx.exists_nested):
             # TODO(jaypipes): The check/callout to handle trees goes here.
@@ -115,25 +228,23 @@ class AllocationCandidates(object):
                     },
                 )
                 if not trait_rps:
-                    return set()
-            rp_candidates = res_ctx.get_trees_matching_all(rg_ctx, rw_ctx)
-            return _alloc_candidates_multiple_providers(
-                rg_ctx, rw_ctx, rp_candidates)
+                    return None, None
+            return res_ctx.get_trees_matching_all(rg_ctx, rw_ctx), None
 
         # Either we are processing a single-RP request group, or there are no
         # sharing providers that (help) satisfy the request.  Get a list of
         # tuples of (internal provider ID, root provider ID) that have ALL
         # the requested resources and more efficiently construct the
         # allocation requests.
-        rp_tuples = res_ctx.get_provider_ids_matching(rg_ctx)
-        return _alloc_candidates_single_provider(rg_ctx, rw_ctx, rp_tuples)
+        return None, res_ctx.get_provider_ids_matching(rg_ctx)
 
     @classmethod
     @db_api.placement_context_manager.reader
     def _get_by_requests(cls, context, groups, rqparams, nested_aware=True):
-        rw_ctx = res_ctx.RequestWideSearchContext(
-            context, rqparams, nested_aware)
-        sharing = res_ctx.get_sharing_providers(context)
+        with search_profile.phase(context, 'group_ctx'):
+            rw_ctx = res_ctx.RequestWideSearchContext(
+                context, rqparams, nested_aware)
+            sharing = res_ctx.get_all_sharing_providers(context)
         # TODO(efried): If we ran anchors_for_sharing_providers here, we could
         #  narrow to only sharing providers associated with our filtered trees.
         #  Unclear whether this would be cheaper than waiting until we've
@@ -141,49 +252,245 @@ class AllocationCandidates(object):
 
         seen_rcs = set()
         candidates = {}
-        for suffix, group in groups.items():
-            rg_ctx = res_ctx.RequestGroupSearchContext(
-                context, group, rw_ctx.has_trees, sharing, suffix)
-
-            # Which resource classes are requested in more than one group?
-            for rc in rg_ctx.rcs:
-                if rc in seen_rcs:
-                    rw_ctx.multi_group_rcs.add(rc)
-                else:
-                    seen_rcs.add(rc)
-
-            alloc_reqs = cls._get_by_one_request(rg_ctx, rw_ctx)
-            LOG.debug("%s (suffix '%s') returned %d matches",
-                      str(group), str(suffix), len(alloc_reqs))
-            if not alloc_reqs:
-                # Shortcut: If any one group resulted in no candidates, the
-                # whole operation is shot.
-                return [], []
-            # Mark each allocation request according to whether its
-            # corresponding RequestGroup required it to be restricted to a
-            # single provider.  We'll need this later to evaluate group_policy.
-            for areq in alloc_reqs:
-                areq.use_same_provider = group.use_same_provider
-            candidates[suffix] = alloc_reqs
+        with contextlib.closing(_search_groups(
+                context, rw_ctx, sharing, groups)) as searches:
+            for suffix, group, rg_ctx, providers in searches:
+                # Which resource classes are requested in more than one group?
+                for rc in rg_ctx.rcs:
+                    if rc in seen_rcs:
+                        rw_ctx.multi_group_rcs.add(rc)
+                    else:
+                        seen_rcs.add(rc)
+
+                alloc_reqs = cls._get_by_one_request(
+                    rg_ctx, rw_ctx, providers)
+                LOG.debug("%s (suffix '%s') returned %d matches",
+                          str(group), str(suffix), len(alloc_reqs))
+                if not alloc_reqs:
+                    # Shortcut: If any one group resulted in no candidates,
+                    # the whole operation is shot.
+                    return [], []
+                # Mark each allocation request according to whether its
+                # corresponding RequestGroup required it to be restricted to
+                # a single provider.  We'll need this later to evaluate
+                # group_policy.
+                for areq in alloc_reqs:
+                    areq.use_same_provider = group.use_same_provider
+                candidates[suffix] = alloc_reqs
 
         # At this point, each alloc_requests in `candidates` is independent of
         # the others. We need to fold them together such that  each allocation
         # request satisfies *all* the incoming `requests`. The `candidates`
         # dict is guaranteed to contain entries for all suffixes, or we would
         # have short-circuited above.
-        alloc_request_objs, summary_objs = _merge_candidates(
-            candidates, rw_ctx)
+        # NOTE: The merged allocation requests are generated lazily and only
+        # as many of them as the limit calls for are ever built.
+        # When profiled, the time spent producing each of them is attributed
+        # to the innermost of the merge, exclude_nested and limit phases.
+        alloc_request_objs = search_profile.iterate(
+            context, 'merge', _merge_candidates(candidates, rw_ctx))
+
+        alloc_request_objs = search_profile.iterate(
+            context, 'exclude_nested',
+            rw_ctx.exclude_nested_providers(alloc_request_objs))
+
+        with search_profile.phase(context, 'limit') as phase:
+            alloc_request_objs = rw_ctx.limit_results(alloc_request_objs)
+            phase.rows += len(alloc_request_objs)
+
+        # Now we have to produce provider summaries, only for the providers
+        # relevant to the allocation requests we are returning.
+        with search_profile.phase(context, 'summaries') as phase:
+            summary_objs = _build_provider_summaries(
+                context, rw_ctx, rw_ctx.provider_ids_for(alloc_request_objs))
+            phase.rows += len(summary_objs)
+
+        LOG.debug('Merging and limiting candidates yields %d allocation '
+                  'requests and %d provider summaries',
+                  len(alloc_request_objs), len(summary_objs))
+        return alloc_request_objs, summary_objs
+
+
+def _freeze(value):
+    """Returns a hashable equivalent of value, a RequestGroup or
+    RequestWideParams or any of their attributes, disregarding the order of
+    lists and sets but not that of tuples, like the (strategy, weights) of
+    RequestWideParams.sort.
+    """
+    if isinstance(value, dict):
+        return frozenset((k, _freeze(v)) for k, v in value.items())
+    if isinstance(value, tuple):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, (list, set, frozenset)):
+        return frozenset(_freeze(v) for v in value)
+    if hasattr(value, '__dict__'):
+        return (type(value).__name__, _freeze(vars(value)))
+    return value
+
+
+def _request_key(groups, rqparams, nested_aware):
+    """Returns a hashable key identifying a search for allocation candidates.
+    Requests which differ only in the order of their request groups or of
+    the values of a query parameter have the same key.
+    """
+    return _freeze(groups), _freeze(rqparams), nested_aware
+
+
+@db_api.placement_context_manager.reader
+def _get_change_watermark(ctx):
+    """Returns a tuple which changes whenever this process commits a change
+    to providers, inventories, traits, aggregates or allocations, and
+    whenever any process creates a provider or an allocation. Both maxima
+    are read from primary key indexes, so this is cheap even on cache hits.
+    """
+    sel = sa.select(
+        sa.select(sa.func.max(_RP_TBL.c.id)).scalar_subquery(),
+        sa.select(sa.func.max(_ALLOC_TBL.c.id)).scalar_subquery(),
+    )
+    return (tuple(ctx.session.execute(sel).fetchone()) +
+            (res_ctx.get_candidates_changes(),))
+
+
+def _get_cached(key, ttl):
+    """Returns the cached AllocationCandidates for key, if they are not older
+    than ttl seconds, marking them as the most recently used.
+    """
+    with lockutils.lock(_CACHE_LOCK):
+        entry = _CACHE.get(key)
+        if entry is None:
+            return None
+        cached_at, cands = entry
+        if time.monotonic() - cached_at >= ttl:
+            del _CACHE[key]
+            return None
+        _CACHE.move_to_end(key)
+        return cands
+
+
+def _set_cached(key, cands, size):
+    with lockutils.lock(_CACHE_LOCK):
+        _CACHE[key] = (time.monotonic(), cands)
+        _CACHE.move_to_end(key)
+        while len(_CACHE) > size:
+            _CACHE.popitem(last=False)
+
+
+def _get_group_executor(workers):
+    """Returns the thread pool of this process searching for the providers of
+    request groups, with the supplied number of threads.
+    """
+    global _GROUP_EXECUTOR
+    with lockutils.lock(_GROUP_EXECUTOR_LOCK):
+        if _GROUP_EXECUTOR is None or _GROUP_EXECUTOR[0] != workers:
+            if _GROUP_EXECUTOR is not None:
+                _GROUP_EXECUTOR[1].shutdown(wait=False)
+            _GROUP_EXECUTOR = (workers, futures.ThreadPoolExecutor(
+                max_workers=workers,
+                thread_name_prefix='placement-request-groups'))
+        return _GROUP_EXECUTOR[1]
+
+
+def shutdown_group_executor():
+    """Shuts down the thread pool of this process searching for the providers
+    of request groups, if there is one.
+    """
+    global _GROUP_EXECUTOR
+    with lockutils.lock(_GROUP_EXECUTOR_LOCK):
+        if _GROUP_EXECUTOR is not None:
+            _GROUP_EXECUTOR[1].shutdown(wait=True)
+            _GROUP_EXECUTOR = None
+
+
+def _can_search_concurrently(context):
+    """Returns whether the database of the transaction of context can serve
+    the reader transactions of other threads at the same time.
+    """
+    # NOTE: An in-memory SQLite database, as most functional tests use, is
+    # only seen through one connection, on which SQLite can't run concurrent
+    # transactions.
+    engine = context.session.connection().engine
+    return not (engine.dialect.name == 'sqlite' and
+                engine.url.database in (None, '', ':memory:'))
+
+
+@db_api.placement_context_manager.reader
+def _search_group(context, rw_ctx, sharing, suffix, group):
+    """Builds the RequestGroupSearchContext of one request group and finds the
+    providers that may satisfy it.
+
+    :return: A tuple of the RequestGroupSearchContext and of the result of
+             AllocationCandidates._get_providers_for_one_request().
+    """
+    with search_profile.phase(context, 'group_ctx'):
+        rg_ctx = res_ctx.RequestGroupSearchContext(
+            context, group, rw_ctx.has_trees, sharing, suffix)
+    return rg_ctx, AllocationCandidates._get_providers_for_one_request(
+        rg_ctx, rw_ctx)
+
+
+def _search_groups(context, rw_ctx, sharing, groups):
+    """Generates a tuple of (suffix, RequestGroup, RequestGroupSearchContext,
+    providers) for each of the request groups, in order, where providers is
+    the result of AllocationCandidates._get_providers_for_one_request().
+
+    If CONF.placement.allocation_candidates_group_workers is more than 1 and
+    the database supports it, the groups are searched concurrently by a
+    thread pool, each in a reader transaction of its own. The groups may then
+    see the database as it was at slightly different times, so allocations
+    written in between can make the candidates combining them stale, which
+    is noticed when they are claimed. Otherwise each group is only searched
+    once the previous one has been consumed, in the transaction of the
+    caller, so that a caller giving up early saves the search of the
+    remaining groups.
+    """
+    workers = context.config.placement.allocation_candidates_group_workers
+    if (workers < 2 or len(groups) < 2 or
+            not _can_search_concurrently(context)):
+        for suffix, group in groups.items():
+            yield (suffix, group) + _search_group(
+                context, rw_ctx, sharing, suffix, group)
+        return
+
+    executor = _get_group_executor(workers)
+    searches = [
+        (suffix, group, executor.submit(
+            _search_group, context, rw_ctx, sharing, suffix, group))
+        for suffix, group in groups.items()]
+    try:
+        for suffix, group, future in searches:
+            with search_profile.phase(context, 'group_wait'):
+                result = future.result()
+            yield (suffix, group) + result
+    finally:
+        # Don't search for the groups that are no longer needed. Searches
+        # which already started can't be interrupted, they run to completion
+        # and their results are dropped.
+        for _suffix, _group, future in searches:
+            future.cancel()
+
+
+class CandidateProvider(object):
+    """The identity of a resource provider involved in allocation candidates.
+
+    A light weight stand-in for a ResourceProvider, created once per request
+    for each provider and shared by all of the AllocationRequestResource and
+    ProviderSummary objects referring to it.
+    """
 
-        alloc_request_objs, summary_objs = rw_ctx.exclude_nested_providers(
-            alloc_request_objs, summary_objs)
+    __slots__ = 'id', 'uuid', 'root_provider_uuid', 'parent_provider_uuid'
 
-        return rw_ctx.limit_results(alloc_request_objs, summary_objs)
+    def __init__(self, id=None, uuid=None, root_provider_uuid=None,
+                 parent_provider_uuid=None):
+        self.id = id
+        self.uuid = uuid
+        self.root_provider_uuid = root_provider_uuid
+        self.parent_provider_uuid = parent_provider_uuid
 
 
 class AllocationRequest(object):
 
     __slots__ = ('anchor_root_provider_uuid', 'use_same_provider',
-                 'resource_requests', 'mappings')
+                 'resource_requests', 'mappings', '_hash')
 
     def __init__(self, anchor_root_provider_uuid=None,
                  use_same_provider=None, resource_requests=None,
@@ -201,6 +508,10 @@ class AllocationRequest(object):
         # mappings will be presented as a dict during output, so ensure we have
         # a reasonable default here, despite mappings always being set.
         self.mappings = mappings or dict()
+        # The hash, computed when first needed. Neither resource_requests nor
+        # the AllocationRequestResources in it are modified once an
+        # AllocationRequest is built.
+        self._hash = None
 
     def __repr__(self):
         anchor = (self.anchor_root_provider_uuid[-8:]
@@ -218,22 +529,26 @@ class AllocationRequest(object):
                 self.mappings == other.mappings)
 
     def __hash__(self):
-        # We need a stable sort order on the resource requests to get an
-        # accurate hash. To avoid needing to update the method everytime
-        # the structure of an AllocationRequestResource changes, we can
-        # sort on the hash of each request resource.
-        sorted_rr = sorted(self.resource_requests, key=lambda x: hash(x))
-        return hash(tuple(sorted_rr))
+        if self._hash is None:
+            # We need a stable sort order on the resource requests to get an
+            # accurate hash. To avoid needing to update the method everytime
+            # the structure of an AllocationRequestResource changes, we can
+            # sort on the hash of each request resource.
+            self._hash = hash(tuple(sorted(
+                hash(rr) for rr in self.resource_requests)))
+        return self._hash
 
     def __copy__(self):
         # This is shallow copy, so resource_requests and mappings are the
-        # same objects as prior to the copy.
-        return self.__class__(
+        # same objects as prior to the copy, and so is the hash.
+        areq = self.__class__(
             anchor_root_provider_uuid=self.anchor_root_provider_uuid,
             use_same_provider=self.use_same_provider,
             resource_requests=self.resource_requests,
             mappings=self.mappings
         )
+        areq._hash = self._hash
+        return areq
 
 
 class AllocationRequestResource(object):
@@ -315,14 +630,9 @@ def _alloc_candidates_multiple_providers(rg_ctx, rw_ctx, rp_candidates):
     # they have their "anchor" providers for the second value.
     root_ids = rp_candidates.all_rps
 
-    # Get a dict, keyed by resource provider internal ID, of trait string names
-    # that provider has associated with it
-    prov_traits = trait_obj.get_traits_by_provider_tree(
-        rg_ctx.context, root_ids)
-
-    # Extend rw_ctx.summaries_by_id dict, keyed by resource provider internal
-    # ID, of ProviderSummary objects for all providers
-    _build_provider_summaries(rg_ctx.context, rw_ctx, root_ids, prov_traits)
+    # Extend the provider and capacity information in rw_ctx with that of all
+    # providers in these trees
+    _load_providers(rg_ctx.context, rw_ctx, root_ids, rg_ctx.resources)
 
     # Get a dict, keyed by root provider internal ID, of a dict, keyed by
     # resource class internal ID, of lists of AllocationRequestResource objects
@@ -330,10 +640,9 @@ def _alloc_candidates_multiple_providers(rg_ctx, rw_ctx, rp_candidates):
 
     rc_cache = rg_ctx.context.rc_cache
     for rp in rp_candidates.rps_info:
-        rp_summary = rw_ctx.summaries_by_id[rp.id]
         tree_dict[rp.root_id][rp.rc_id].append(
             AllocationRequestResource(
-                resource_provider=rp_summary.resource_provider,
+                resource_provider=rw_ctx.providers_by_id[rp.id],
                 resource_class=rc_cache.string_from_id(rp.rc_id),
                 amount=rg_ctx.resources[rp.rc_id]))
 
@@ -357,25 +666,21 @@ def _alloc_candidates_multiple_providers(rg_ctx, rw_ctx, rp_candidates):
         # , which should be ordered by the resource class id.
         request_groups = [val for key, val in sorted(alloc_dict.items())]
 
-        root_summary = rw_ctx.summaries_by_id[root_id]
-        root_uuid = root_summary.resource_provider.uuid
+        root_uuid = rw_ctx.providers_by_id[root_id].uuid
         root_alloc_reqs = set()
 
-        # Using itertools.product, we get all the combinations of resource
-        # providers in a tree.
-        # For example, the sample in the comment above becomes:
+        # We get the combinations of resource providers in a tree that satisfy
+        # the trait constraints. Without any trait constraints, that is the
+        # whole product of request_groups. For example, the sample in the
+        # comment above becomes:
         # [(ARR(rc1, ss1), ARR(rc2, ss1), ARR(rc3, ss1)),
         #  (ARR(rc1, ss1), ARR(rc2, ss2), ARR(rc3, ss1)),
         #  (ARR(rc1, ss2), ARR(rc2, ss1), ARR(rc3, ss1)),
         #  (ARR(rc1, ss2), ARR(rc2, ss2), ARR(rc3, ss1))]
-        for res_requests in itertools.product(*request_groups):
-            if not _check_traits_for_alloc_request(
-                    res_requests, rw_ctx.summaries_by_id,
-                    rg_ctx.required_trait_names,
-                    rg_ctx.forbidden_traits.keys()):
-                # This combination doesn't satisfy trait constraints
-                continue
-
+        for res_requests in _resource_request_combinations(
+                request_groups, rw_ctx.traits_by_rp_id,
+                rg_ctx.required_trait_names,
+                rg_ctx.forbidden_traits.keys()):
             mappings = collections.defaultdict(set)
             for rr in res_requests:
                 mappings[rg_ctx.suffix].add(rr.resource_provider.uuid)
@@ -412,23 +717,24 @@ def _alloc_candidates_single_provider(rg_ctx, rw_ctx, rp_tuples):
     # Get all root resource provider IDs.
     root_ids = set(p[1] for p in rp_tuples)
 
-    # Get a dict, keyed by resource provider internal ID, of trait string names
-    # that provider has associated with it
-    prov_traits = trait_obj.get_traits_by_provider_tree(
-        rg_ctx.context, root_ids)
+    # Extend the provider and capacity information in rw_ctx with that of all
+    # providers in these trees
+    _load_providers(rg_ctx.context, rw_ctx, root_ids, rg_ctx.resources)
 
-    # Extend rw_ctx.summaries_by_id dict, keyed by resource provider internal
-    # ID, of ProviderSummary objects for all providers
-    _build_provider_summaries(rg_ctx.context, rw_ctx, root_ids, prov_traits)
+    # Look up the anchors of all the sharing providers at once, rather than
+    # one query per sharing provider in the loop below.
+    rw_ctx.anchors_for_sharing_providers(
+        rp_id for rp_id, _root_id in rp_tuples
+        if os_traits.MISC_SHARES_VIA_AGGREGATE in
+        rw_ctx.traits_by_rp_id[rp_id])
 
     # Next, build up a list of allocation requests. These allocation requests
     # are AllocationRequest objects, containing resource provider UUIDs,
     # resource class names and amounts to consume from that resource provider
     alloc_requests = []
     for rp_id, root_id in rp_tuples:
-        rp_summary = rw_ctx.summaries_by_id[rp_id]
         req_obj = _allocation_request_for_provider(
-            rg_ctx.context, rg_ctx.resources, rp_summary.resource_provider,
+            rg_ctx.context, rg_ctx.resources, rw_ctx.providers_by_id[rp_id],
             suffix=rg_ctx.suffix)
         # Exclude this if its anchor (which is its root) isn't in our
         # prefiltered list of anchors
@@ -436,10 +742,9 @@ def _alloc_candidates_single_provider(rg_ctx, rw_ctx, rp_tuples):
             alloc_requests.append(req_obj)
         # If this is a sharing provider, we have to include an extra
         # AllocationRequest for every possible anchor.
-        traits = rp_summary.traits
+        traits = rw_ctx.traits_by_rp_id[rp_id]
         if os_traits.MISC_SHARES_VIA_AGGREGATE in traits:
-            anchors = res_ctx.anchors_for_sharing_providers(
-                rg_ctx.context, [rp_summary.resource_provider.id])
+            anchors = rw_ctx.anchors_for_sharing_providers([rp_id])
             for anchor in anchors:
                 # We already added self
                 if anchor.anchor_id == root_id:
@@ -485,24 +790,105 @@ def _allocation_request_for_provider(context, requested_resources, provider,
         mappings=mappings)
 
 
-def _build_provider_summaries(context, rw_ctx, root_ids, prov_traits):
-    """Given a list of dicts of usage information and a map of providers to
-    their associated string traits, returns a dict, keyed by resource provider
-    ID, of ProviderSummary objects.
+def _load_providers(context, rw_ctx, root_ids, rc_ids):
+    """Extends the provider information in rw_ctx with that of all resource
+    providers in the trees of the supplied root providers, and the capacity
+    information in rw_ctx with that of their inventories of the supplied
+    resource classes.
 
-    Warning: This is side-effecty: It is extending the rw_ctx.summaries_by_id
-    dict. Nothing is returned.
+    Warning: This is side-effecty: It is extending the rw_ctx.providers_by_id,
+    rw_ctx.root_id_by_rp_id, rw_ctx.traits_by_rp_id, rw_ctx.capacity_by_rp_rc,
+    rw_ctx.headroom_by_rp_rc and rw_ctx.span_by_rp_uuid dicts. Nothing is
+    returned.
 
     :param context: placement.context.RequestContext object
     :param rw_ctx: placement.research_context.RequestWideSearchContext
     :param root_ids: A set of root resource provider ids
-    :param prov_traits: A dict, keyed by internal resource provider ID, of
-                        string trait names associated with that provider
+    :param rc_ids: An iterable of internal IDs of the resource classes whose
+                   capacity is needed
     """
     # Filter resource providers by those we haven't seen yet.
-    new_roots = root_ids - set(rw_ctx.summaries_by_id)
-    if not new_roots:
+    new_roots = root_ids - set(rw_ctx.providers_by_id)
+    if new_roots:
+        # Get a dict, keyed by resource provider internal ID, of trait string
+        # names that provider has associated with it
+        prov_traits = trait_obj.get_traits_by_provider_tree(
+            context, new_roots)
+
+        # Grab all the provider information (including root, parent and UUID
+        # information) for the providers.
+        provider_ids = _provider_ids_from_root_ids(context, new_roots)
+        parent_uuid_by_rp_uuid = {}
+        for pids in provider_ids.values():
+            parent_id = pids.parent_id
+            # If there is a parent, we can rely on it being in provider_ids
+            # because for any single provider, it also contains the full
+            # ancestry.
+            parent_uuid = provider_ids[parent_id].uuid if parent_id else None
+            parent_uuid_by_rp_uuid[pids.uuid] = parent_uuid
+            rw_ctx.providers_by_id[pids.id] = CandidateProvider(
+                id=pids.id, uuid=pids.uuid,
+                root_provider_uuid=provider_ids[pids.root_id].uuid,
+                parent_provider_uuid=parent_uuid)
+            rw_ctx.root_id_by_rp_id[pids.id] = pids.root_id
+            rw_ctx.traits_by_rp_id[pids.id] = prov_traits.get(pids.id, [])
+        # We know that we will visit all providers in all trees in play
+        # during _load_providers, so now is a good time to index the new
+        # trees for the same_subtree checks.
+        _index_subtrees(parent_uuid_by_rp_uuid, rw_ctx.span_by_rp_uuid)
+
+    # Only the capacity of the requested resource classes is needed to check
+    # the allocation requests, so fetch only that, once per tree.
+    rc_ids = set(rc_ids)
+    capacity_roots = set(
+        root_id for root_id in root_ids
+        if any((root_id, rc_id) not in rw_ctx.capacity_loaded
+               for rc_id in rc_ids))
+    if not capacity_roots:
         return
+    rw_ctx.capacity_loaded.update(
+        itertools.product(capacity_roots, rc_ids))
+    usages = res_ctx.get_usages_by_provider_trees(
+        context, capacity_roots, rc_ids=rc_ids)
+    for usage in usages:
+        # Construct a dict, keyed by resource provider + resource class, of
+        # ProviderCapacity. This will be used to do a final capacity
+        # check/filter on each merged AllocationRequest.
+        rc_name = context.rc_cache.string_from_id(usage.resource_class_id)
+        key = (usage.resource_provider_id, rc_name)
+        capacity = _capacity_from_usage(usage)
+        rw_ctx.capacity_by_rp_rc[key] = capacity
+        rw_ctx.headroom_by_rp_rc[key] = min(
+            capacity.capacity - capacity.used, capacity.max_unit)
+
+
+def _capacity_from_usage(usage):
+    """Returns a ProviderCapacity for a usage record returned by
+    res_ctx.get_usages_by_provider_trees().
+    """
+    # NOTE(jaypipes): usage.used may be None due to the LEFT JOIN of
+    # the usages subquery, so we coerce NULL values to 0 here. It may
+    # also be a Decimal, as that's the type that mysql tends to return
+    # when func.sum is used in a query. We need an int, otherwise later
+    # JSON serialization will not work.
+    used = int(usage.used or 0)
+    allocation_ratio = usage.allocation_ratio
+    cap = int((usage.total - usage.reserved) * allocation_ratio)
+    return res_ctx.ProviderCapacity(
+        capacity=cap, used=used, max_unit=usage.max_unit)
+
+
+def _build_provider_summaries(context, rw_ctx, rp_ids):
+    """Returns a list of ProviderSummary objects for the resource providers
+    with the supplied internal IDs, all of which must have been loaded into
+    rw_ctx by _load_providers().
+
+    :param context: placement.context.RequestContext object
+    :param rw_ctx: placement.research_context.RequestWideSearchContext
+    :param rp_ids: A set of internal resource provider ids
+    """
+    if not rp_ids:
+        return []
 
     # Get a dict-like usage information of resource providers in a tree where
     # at least one member of the tree is contributing resources or traits to
@@ -515,39 +901,25 @@ def _build_provider_summaries(context, rw_ctx, root_ids, prov_traits):
     #        'reserved': integer,
     #        'allocation_ratio': float,
     #    }
-    usages = res_ctx.get_usages_by_provider_trees(context, new_roots)
-
-    # Before we go creating provider summary objects, first grab all the
-    # provider information (including root, parent and UUID information) for
-    # the providers.
-    provider_ids = _provider_ids_from_root_ids(context, new_roots)
+    root_ids = set(rw_ctx.root_id_by_rp_id[rp_id] for rp_id in rp_ids)
+    usages = res_ctx.get_usages_by_provider_trees(context, root_ids)
 
     # Build up a dict, keyed by internal resource provider ID, of
     # ProviderSummary objects containing one or more ProviderSummaryResource
     # objects representing the resources the provider has inventory for.
+    summaries = {}
     for usage in usages:
         rp_id = usage.resource_provider_id
-        summary = rw_ctx.summaries_by_id.get(rp_id)
+        if rp_id not in rp_ids:
+            continue
+        summary = summaries.get(rp_id)
         if not summary:
-            pids = provider_ids[rp_id]
-            parent_id = pids.parent_id
-            # If there is a parent, we can rely on it being in provider_ids
-            # because for any single provider, it also contains the full
-            # ancestry.
-            parent_uuid = provider_ids[parent_id].uuid if parent_id else None
-            # Update the parent_uuid_by_rp_uuid cache here. We know that we
-            # will visit all providers in all trees in play during
-            # _build_provider_summaries, so now is a good time.
-            rw_ctx.parent_uuid_by_rp_uuid[pids.uuid] = parent_uuid
             summary = ProviderSummary(
-                resource_provider=rp_obj.ResourceProvider(
-                    context, id=pids.id, uuid=pids.uuid,
-                    root_provider_uuid=provider_ids[pids.root_id].uuid,
-                    parent_provider_uuid=parent_uuid),
+                resource_provider=rw_ctx.providers_by_id[rp_id],
                 resources=[],
+                traits=rw_ctx.traits_by_rp_id[rp_id],
             )
-            summary.traits = prov_traits[rp_id]
-            rw_ctx.summaries_by_id[rp_id] = summary
+            summaries[rp_id] = summary
 
         rc_id = usage.resource_class_id
         if rc_id is None:
@@ -557,45 +929,38 @@ def _build_provider_summaries(context, rw_ctx, root_ids, prov_traits):
             # Let's skip the following and leave "ProviderSummary.resources"
             # field empty.
             continue
-        # NOTE(jaypipes): usage.used may be None due to the LEFT JOIN of
-        # the usages subquery, so we coerce NULL values to 0 here. It may
-        # also be a Decimal, as that's the type that mysql tends to return
-        # when func.sum is used in a query. We need an int, otherwise later
-        # JSON serialization will not work.
-        used = int(usage.used or 0)
-        allocation_ratio = usage.allocation_ratio
-        cap = int((usage.total - usage.reserved) * allocation_ratio)
-        rc_name = context.rc_cache.string_from_id(rc_id)
-        rpsr = ProviderSummaryResource(
-            resource_class=rc_name,
-            capacity=cap,
-            used=used,
-            max_unit=usage.max_unit,
-        )
-        # Construct a dict, keyed by resource provider + resource class, of
-        # ProviderSummaryResource. This will be used to do a final capacity
-        # check/filter on each merged AllocationRequest.
-        psum_key = (rp_id, rc_name)
-        rw_ctx.psum_res_by_rp_rc[psum_key] = rpsr
-        summary.resources.append(rpsr)
-
-
-def _check_traits_for_alloc_request(res_requests, summaries, required_traits,
-                                    forbidden_traits):
-    """Given a list of AllocationRequestResource objects, check if that
-    combination can provide trait constraints. If it can, returns all
-    resource provider internal IDs in play, else return an empty list.
-
-    TODO(tetsuro): For optimization, we should move this logic to SQL in
-                   res_ctx.get_trees_matching_all().
-
-    :param res_requests: a list of AllocationRequestResource objects that have
-                         resource providers to be checked if they collectively
-                         satisfy trait constraints in the required_traits and
-                         forbidden_traits parameters.
-    :param summaries: dict, keyed by resource provider id, of ProviderSummary
-                      objects containing usage and trait information for
-                      resource providers involved in the overall request
+        capacity = _capacity_from_usage(usage)
+        summary.resources.append(ProviderSummaryResource(
+            resource_class=context.rc_cache.string_from_id(rc_id),
+            capacity=capacity.capacity,
+            used=capacity.used,
+            max_unit=capacity.max_unit,
+        ))
+    return list(summaries.values())
+
+
+def _resource_request_combinations(request_groups, traits_by_rp_id,
+                                   required_traits, forbidden_traits):
+    """Generates the combinations of AllocationRequestResource objects, one
+    from each of the lists in request_groups, that satisfy the trait
+    constraints.
+
+    Rather than checking every member of the product of request_groups, this
+    is a backtracking search: providers having forbidden traits are dropped
+    up front, and a partial combination is abandoned, along with all of its
+    extensions, as soon as the traits of its providers together with all of
+    the traits still on offer in the remaining lists can't fulfill the
+    required traits.
+
+    The traits that matter to the request are represented as the bits of an
+    integer, so that checking a combination takes a few bitwise operations
+    rather than building and intersecting sets of trait names.
+
+    :param request_groups: A list of lists of AllocationRequestResource
+                           objects, one list per requested resource class.
+    :param traits_by_rp_id: dict, keyed by resource provider id, of lists of
+                            trait names of the resource providers involved in
+                            the overall request
     :param required_traits: A list of set of trait names where traits
                             in the sets are in OR relationship while traits in
                             two different sets are in AND relationship. Each
@@ -604,51 +969,73 @@ def _check_traits_for_alloc_request(res_requests, summaries, required_traits,
     :param forbidden_traits: A set of trait names that a resource provider must
                             not have.
     """
-    all_prov_ids = []
-    all_traits = set()
-    for res_req in res_requests:
-        rp_id = res_req.resource_provider.id
-        rp_summary = summaries[rp_id]
-        rp_traits = set(rp_summary.traits)
-
-        # Check if there are forbidden_traits
-        conflict_traits = set(forbidden_traits) & set(rp_traits)
-        if conflict_traits:
-            LOG.debug('Excluding resource provider %s, it has '
-                      'forbidden traits: (%s).',
-                      rp_id, ', '.join(conflict_traits))
-            return []
+    forbidden_traits = set(forbidden_traits)
+    bit_by_trait = {}
+    for trait in itertools.chain(forbidden_traits, *required_traits):
+        bit_by_trait.setdefault(trait, 1 << len(bit_by_trait))
 
-        all_prov_ids.append(rp_id)
-        all_traits |= rp_traits
+    def _mask(traits):
+        mask = 0
+        for trait in traits:
+            mask |= bit_by_trait.get(trait, 0)
+        return mask
 
     # We need a match for *all* the items from the outer list of the
     # required_traits as that describes AND relationship, and we need at least
     # *one match* per nested trait set as that set describes OR relationship
-
-    # so collect all the matches with the nested sets
-    trait_matches = [
-        any_traits.intersection(all_traits) for any_traits in required_traits]
-
-    # if some internal sets do not match to the provided traits then we have
-    # missing trait (trait set)
-    if not all(trait_matches):
-        missing_traits = [
-            '(' + ' or '.join(any_traits) + ')'
-            for any_traits, match in zip(required_traits, trait_matches)
-            if not match
-        ]
-        LOG.debug(
-            'Excluding a set of allocation candidate %s : '
-            'missing traits %s are not satisfied.',
-            all_prov_ids,
-            ' and '.join(any_traits for any_traits in missing_traits))
-        return []
-
-    return all_prov_ids
-
-
-def _consolidate_allocation_requests(areqs, rw_ctx):
+    required_masks = [_mask(any_traits) for any_traits in required_traits]
+    forbidden_mask = _mask(forbidden_traits)
+    mask_by_rp_id = {}
+    for res_req in itertools.chain(*request_groups):
+        rp_id = res_req.resource_provider.id
+        if rp_id not in mask_by_rp_id:
+            mask_by_rp_id[rp_id] = _mask(traits_by_rp_id[rp_id])
+
+    candidates = []
+    for res_reqs in request_groups:
+        allowed = []
+        for res_req in res_reqs:
+            rp_id = res_req.resource_provider.id
+            if mask_by_rp_id[rp_id] & forbidden_mask:
+                LOG.debug('Excluding resource provider %s, it has '
+                          'forbidden traits: (%s).',
+                          rp_id, ', '.join(
+                              forbidden_traits & set(traits_by_rp_id[rp_id])))
+                continue
+            allowed.append(res_req)
+        if not allowed:
+            return
+        candidates.append(allowed)
+
+    # traits_on_offer[i] is the mask of the traits of all of the providers in
+    # candidates[i:].
+    traits_on_offer = [0]
+    for res_reqs in reversed(candidates):
+        mask = traits_on_offer[0]
+        for res_req in res_reqs:
+            mask |= mask_by_rp_id[res_req.resource_provider.id]
+        traits_on_offer.insert(0, mask)
+
+    def _extend(res_requests, traits):
+        depth = len(res_requests)
+        reachable = traits | traits_on_offer[depth]
+        for required in required_masks:
+            if not reachable & required:
+                return
+        if depth == len(candidates):
+            # Nothing more is on offer, so the complete combination fulfills
+            # the required traits itself.
+            yield res_requests
+            return
+        for res_req in candidates[depth]:
+            yield from _extend(
+                res_requests + (res_req,),
+                traits | mask_by_rp_id[res_req.resource_provider.id])
+
+    yield from _extend((), 0)
+
+
+def _consolidate_allocation_requests(areqs):
     """Consolidates a list of AllocationRequest into one.
 
     :param areqs: A list containing one AllocationRequest for each input
@@ -665,6 +1052,9 @@ def _consolidate_allocation_requests(areqs, rw_ctx):
     # returned AllocationRequest.
     anchor_rp_uuid = areqs[0].anchor_root_provider_uuid
     mappings = collections.defaultdict(set)
+    # The keys of arrs_by_rp_rc whose AllocationRequestResource is a copy
+    # made here, rather than one of the supplied areqs, and may be modified.
+    copied = set()
     for areq in areqs:
         # Sanity check: the anchor should be the same for every areq
         if anchor_rp_uuid != areq.anchor_root_provider_uuid:
@@ -676,9 +1066,14 @@ def _consolidate_allocation_requests(areqs, rw_ctx):
         for arr in areq.resource_requests:
             key = (arr.resource_provider.id, arr.resource_class)
             if key not in arrs_by_rp_rc:
-                arrs_by_rp_rc[key] = rw_ctx.copy_arr_if_needed(arr)
-            else:
-                arrs_by_rp_rc[key].amount += arr.amount
+                arrs_by_rp_rc[key] = arr
+                continue
+            # The same AllocationRequestResource may be used by other
+            # results, so only ever add to a copy of it.
+            if key not in copied:
+                arrs_by_rp_rc[key] = copy.copy(arrs_by_rp_rc[key])
+                copied.add(key)
+            arrs_by_rp_rc[key].amount += arr.amount
         for suffix, providers in areq.mappings.items():
             mappings[suffix].update(providers)
     return AllocationRequest(
@@ -690,20 +1085,19 @@ def _consolidate_allocation_requests(areqs, rw_ctx):
 # TODO(efried): Move _merge_candidates to rw_ctx?
 def _merge_candidates(candidates, rw_ctx):
     """Given a dict, keyed by RequestGroup suffix, of allocation_requests,
-    produce a single tuple of (allocation_requests, provider_summaries) that
-    appropriately incorporates the elements from each.
+    generate the allocation_requests that appropriately incorporate the
+    elements from each.
 
     Each alloc_reqs in `candidates` satisfies one RequestGroup. This method
-    creates a list of alloc_reqs, *each* of which satisfies *all*
-    of the RequestGroups.
-
-    For that merged list of alloc_reqs, a corresponding provider_summaries is
-    produced.
+    generates alloc_reqs, *each* of which satisfies *all* of the
+    RequestGroups. It is a generator so that the caller can stop as soon as
+    it has enough of them, without the whole product of the per-group
+    candidates ever being built.
 
     :param candidates: A dict, keyed by suffix string or '', of a set of
             allocation_requests to be merged.
     :param rw_ctx: RequestWideSearchContext.
-    :return: A tuple of (allocation_requests, provider_summaries).
+    :return: A generator of unique AllocationRequest.
     """
     # Build a dict, keyed by anchor root provider UUID, of dicts, keyed by
     # suffix, of nonempty lists of AllocationRequest.  Each inner dict must
@@ -727,44 +1121,36 @@ def _merge_candidates(candidates, rw_ctx):
             areq_lists_by_anchor[anchor][suffix].append(areq)
 
     # Create all combinations picking one AllocationRequest from each list
-    # for each anchor.
-    areqs = set()
+    # for each anchor. Different combinations may consolidate into the same
+    # AllocationRequest, so remember the ones already generated.
+    seen = set()
     all_suffixes = set(candidates)
-    num_granular_groups = len(all_suffixes - set(['']))
     for areq_lists_by_suffix in areq_lists_by_anchor.values():
         # Filter out any entries that don't have allocation requests for
         # *all* suffixes (i.e. all RequestGroups)
         if set(areq_lists_by_suffix) != all_suffixes:
             continue
-        # We're using itertools.product to go from this:
+        # We're using a backtracking search to go from this:
         # areq_lists_by_suffix = {
         #     '':   [areq__A,   areq__B,   ...],
         #     '1':  [areq_1_A,  areq_1_B,  ...],
         #     ...
         #     '42': [areq_42_A, areq_42_B, ...],
         # }
-        # to this:
+        # to the members of its product that satisfy the group policy, the
+        # same_subtree constraints and the capacity of the providers, so only
+        # those are consolidated:
         # [ [areq__A, areq_1_A, ..., areq_42_A],  Each of these lists is one
         #   [areq__A, areq_1_A, ..., areq_42_B],  areq_list in the loop below.
         #   [areq__A, areq_1_B, ..., areq_42_A],  each areq_list contains one
         #   [areq__A, areq_1_B, ..., areq_42_B],  AllocationRequest from each
         #   [areq__B, areq_1_A, ..., areq_42_A],  RequestGroup. So taken as a
         #   [areq__B, areq_1_A, ..., areq_42_B],  whole, each list is a viable
-        #   [areq__B, areq_1_B, ..., areq_42_A],  (preliminary) candidate to
-        #   [areq__B, areq_1_B, ..., areq_42_B],  return.
+        #   [areq__B, areq_1_B, ..., areq_42_A],  candidate to return.
+        #   [areq__B, areq_1_B, ..., areq_42_B],
         #   ...,
         # ]
-        for areq_list in itertools.product(
-                *list(areq_lists_by_suffix.values())):
-            # At this point, each AllocationRequest in areq_list is still
-            # marked as use_same_provider. This is necessary to filter by group
-            # policy, which enforces how these interact with each other.
-            # TODO(efried): Move _satisfies_group_policy to rw_ctx?
-            if not _satisfies_group_policy(
-                    areq_list, rw_ctx.group_policy, num_granular_groups):
-                continue
-            if not _satisfies_same_subtree(areq_list, rw_ctx):
-                continue
+        for areq_list in _areq_combinations(areq_lists_by_suffix, rw_ctx):
             # Now we go from this (where 'arr' is AllocationRequestResource):
             # [ areq__B(arrX, arrY, arrZ),
             #   areq_1_A(arrM, arrN),
@@ -781,82 +1167,120 @@ def _merge_candidates(candidates, rw_ctx):
             # => However, it still exists embedded in each
             # AllocationRequestResource. That's needed to construct the
             # mappings for the output.
-            areq = _consolidate_allocation_requests(areq_list, rw_ctx)
-            # Since we sourced this AllocationRequest from multiple
-            # *independent* queries, it's possible that the combined result
-            # now exceeds capacity where amounts of the same RP+RC were
-            # folded together.  So do a final capacity check/filter.
-            if rw_ctx.exceeds_capacity(areq):
+            areq = _consolidate_allocation_requests(areq_list)
+            if areq in seen:
                 continue
-            areqs.add(areq)
-
-    # It's possible we've filtered out everything.  If so, short out.
-    if not areqs:
-        return [], []
-
-    # Now we have to produce provider summaries. The provider summaries in
-    # rw_ctx.summary_by_id contain all the information; we just need to filter
-    # it down to only the providers in trees represented by our merged list of
-    # allocation requests.
-    tree_uuids = set()
-    for areq in areqs:
-        for arr in areq.resource_requests:
-            tree_uuids.add(arr.resource_provider.root_provider_uuid)
-    psums = [
-        psum for psum in rw_ctx.summaries_by_id.values()
-        if psum.resource_provider.root_provider_uuid in tree_uuids]
-
-    LOG.debug('Merging candidates yields %d allocation requests and %d '
-              'provider summaries', len(areqs), len(psums))
-    return list(areqs), psums
-
-
-def _satisfies_group_policy(areqs, group_policy, num_granular_groups):
-    """Applies group_policy to a list of AllocationRequest.
-
-    Returns True or False, indicating whether this list of
-    AllocationRequest satisfies group_policy, as follows:
-
-    * "isolate": Each AllocationRequest with use_same_provider=True
-                 is satisfied by a single resource provider.  If the "isolate"
-                 policy is in effect, each such AllocationRequest must be
-                 satisfied by a *unique* resource provider.
-    * "none" or None: Always returns True.
-
-    :param areqs: A list containing one AllocationRequest for each input
-            RequestGroup.
-    :param group_policy: String indicating how RequestGroups should interact
-            with each other.  If the value is "isolate", we will return False
-            if AllocationRequests that came from RequestGroups keyed by
-            nonempty suffixes are satisfied by the same provider.
-    :param num_granular_groups: The number of granular (use_same_provider=True)
-            RequestGroups in the request.
-    :return: True if areqs satisfies group_policy; False otherwise.
+            seen.add(areq)
+            yield areq
+
+
+def _areq_combinations(areq_lists_by_suffix, rw_ctx):
+    """Generates the lists of AllocationRequest, one from each of the lists in
+    areq_lists_by_suffix, that can be merged into a single AllocationRequest.
+
+    Rather than checking every member of the product of the lists, this is a
+    backtracking search that checks constraints as each AllocationRequest is
+    added to a partial combination, so that a partial combination failing
+    them is abandoned along with all of its extensions:
+
+    * group_policy=isolate: A provider satisfying a granular group must not
+      have been used by another granular group already, and enough providers
+      must be left for the granular groups yet to be added. A granular group
+      is always satisfied by a single provider, so this makes sure every
+      granular group is satisfied by a provider of its own.
+    * same_subtree: Checked as soon as all of the groups it names are in the
+      combination.
+    * Capacity: Since we sourced the AllocationRequests from multiple
+      *independent* queries, amounts of the same provider and resource class
+      requested by different groups are added up and checked against the
+      capacity of that provider.
+
+    :param areq_lists_by_suffix: A dict, keyed by suffix, of nonempty lists of
+            AllocationRequest, all with the same anchor.
+    :param rw_ctx: RequestWideSearchContext.
     """
-    if group_policy != 'isolate':
-        # group_policy="none" means no filtering
-        return True
-
-    # The number of unique resource providers referenced in the request groups
-    # having use_same_provider=True must be equal to the number of granular
-    # groups.
-    num_granular_groups_in_areqs = len(set().union(*(
-        # We can reliably use the first value of provider uuids in mappings:
-        # all the resource_requests are satisfied by the same provider
-        # by definition because use_same_provider is True.
-        list(areq.mappings.values())[0] for areq in areqs
-        if areq.use_same_provider)))
-    if num_granular_groups == num_granular_groups_in_areqs:
-        return True
-    LOG.debug('Excluding the following set of AllocationRequest because '
-              'group_policy=isolate and the number of granular groups in the '
-              'set (%d) does not match the number of granular groups in the '
-              'request (%d): %s',
-              num_granular_groups_in_areqs, num_granular_groups, str(areqs))
-    return False
+    suffixes = list(areq_lists_by_suffix)
+    areq_lists = [areq_lists_by_suffix[suffix] for suffix in suffixes]
+    # Lists, indexed by position in the combination, of the same_subtree
+    # constraints that can be checked once that position is filled.
+    same_subtrees_at = [[] for _ in suffixes]
+    for same_subtree in rw_ctx.same_subtrees:
+        last = max(suffixes.index(suffix) for suffix in same_subtree)
+        same_subtrees_at[last].append(same_subtree)
+    isolate = rw_ctx.group_policy == 'isolate'
+    # Lists, indexed by position in the combination, of the sets of uuids of
+    # the providers that group_policy=isolate keeps apart for each
+    # AllocationRequest at that position; empty sets for non-granular groups
+    # or if the policy is not isolate.
+    isolated_rp_uuids = [
+        [_isolated_rp_uuids(areq) if isolate else frozenset()
+         for areq in areq_list]
+        for areq_list in areq_lists]
+    # Sets, indexed by position in the combination, of the uuids of the
+    # providers that can satisfy each granular group after that position, and
+    # the number of those granular groups.
+    later_rp_uuids = [set() for _ in suffixes]
+    later_groups = [0 for _ in suffixes]
+    for depth in range(len(suffixes) - 1, 0, -1):
+        later_rp_uuids[depth - 1] = later_rp_uuids[depth].union(
+            *isolated_rp_uuids[depth])
+        later_groups[depth - 1] = later_groups[depth] + bool(
+            isolate and areq_lists[depth][0].use_same_provider)
+    # The providers satisfying granular groups in the combination so far
+    granular_rp_uuids = set()
+    # The amounts, keyed by (provider id, resource class name), requested by
+    # the combination so far
+    amounts_by_rp_rc = collections.defaultdict(int)
+    areq_list = []
+
+    def _extend(depth):
+        if depth == len(areq_lists):
+            yield list(areq_list)
+            return
+        for areq, rp_uuids in zip(areq_lists[depth], isolated_rp_uuids[depth]):
+            if rp_uuids:
+                if not granular_rp_uuids.isdisjoint(rp_uuids):
+                    continue
+                # Fail first: Abandon the partial combination if the granular
+                # groups still to be added could not all have a provider of
+                # their own any more.
+                later = later_rp_uuids[depth]
+                left = (len(later) - len(later & granular_rp_uuids) -
+                        len(later & rp_uuids))
+                if left < later_groups[depth]:
+                    continue
+            if rw_ctx.exceeds_capacity(areq, amounts_by_rp_rc):
+                continue
+            areq_list.append(areq)
+            if _satisfies_same_subtree(
+                    areq_list, rw_ctx, same_subtrees=same_subtrees_at[depth]):
+                granular_rp_uuids.update(rp_uuids)
+                for arr in areq.resource_requests:
+                    key = (arr.resource_provider.id, arr.resource_class)
+                    amounts_by_rp_rc[key] += arr.amount
+                yield from _extend(depth + 1)
+                for arr in areq.resource_requests:
+                    key = (arr.resource_provider.id, arr.resource_class)
+                    amounts_by_rp_rc[key] -= arr.amount
+                granular_rp_uuids.difference_update(rp_uuids)
+            areq_list.pop()
+
+    return _extend(0)
+
+
+def _isolated_rp_uuids(areq):
+    """Returns the set of uuids of the providers of an AllocationRequest that
+    group_policy=isolate keeps apart from those of other granular groups:
+    the single provider satisfying a granular group, or none.
+    """
+    if not areq.use_same_provider:
+        return frozenset()
+    # All the resource_requests are satisfied by the same provider by
+    # definition because use_same_provider is True.
+    return next(iter(areq.mappings.values()))
 
 
-def _satisfies_same_subtree(areqs, rw_ctx):
+def _satisfies_same_subtree(areqs, rw_ctx, same_subtrees=None):
     """Applies same_subtree policy to a list of AllocationRequest.
 
     :param areqs: A list containing one AllocationRequest for each input
@@ -869,48 +1293,82 @@ def _satisfies_same_subtree(areqs, rw_ctx):
                  request groups must be rooted at one of the resource providers
                  satisfying the request groups.
 
-            parent_uuid_by_rp_uuid: A dict of parent uuids keyed by rp uuids.
+            span_by_rp_uuid: A dict of the (entry, exit) numbers of the
+                 providers keyed by rp uuids, see _index_subtrees.
+    :param same_subtrees: An optional list of sets of request group suffixes
+            strings to check instead of rw_ctx.same_subtrees.
     :return: True if areqs satisfies same_subtree policy; False otherwise.
     """
-    for same_subtree in rw_ctx.same_subtrees:
+    if same_subtrees is None:
+        same_subtrees = rw_ctx.same_subtrees
+    for same_subtree in same_subtrees:
         # Collect RP uuids that must satisfy a single same_subtree constraint.
         rp_uuids = set().union(*(areq.mappings.get(suffix) for areq in areqs
                                for suffix in same_subtree
                                if areq.mappings.get(suffix)))
-        if not _check_same_subtree(rp_uuids, rw_ctx.parent_uuid_by_rp_uuid):
+        if not _check_same_subtree(rp_uuids, rw_ctx.span_by_rp_uuid):
             return False
     return True
 
 
-def _check_same_subtree(rp_uuids, parent_uuid_by_rp_uuid):
+def _check_same_subtree(rp_uuids, span_by_rp_uuid):
     """Returns True if given rp uuids are all in the same subtree.
 
     Note: The rps are in the same subtree means all the providers are
           rooted at one of the providers
+
+    :param rp_uuids: A set of resource provider uuids.
+    :param span_by_rp_uuid: A dict, keyed by resource provider uuid, of the
+            (entry, exit) numbers produced by _index_subtrees for every
+            provider in the trees of rp_uuids.
     """
-    if len(rp_uuids) == 1:
+    if len(rp_uuids) <= 1:
         return True
-    # A set of uuids of common ancestors of each rp in question
-    common_ancestors = set.intersection(*(
-        _get_ancestors_by_one_uuid(rp_uuid, parent_uuid_by_rp_uuid)
-        for rp_uuid in rp_uuids))
-    # if any of the rp_uuid is in the common_ancestors set, then
-    # we know that, that rp_uuid is the root of the other rp_uuids
-    # in this same_subtree constraint.
-    return len(common_ancestors.intersection(rp_uuids)) != 0
-
-
-def _get_ancestors_by_one_uuid(
-        rp_uuid, parent_uuid_by_rp_uuid, ancestors=None):
-    """Returns a set of uuids of ancestors for a given rp uuid"""
-    if ancestors is None:
-        ancestors = set([rp_uuid])
-    parent_uuid = parent_uuid_by_rp_uuid[rp_uuid]
-    if parent_uuid is None:
-        return ancestors
-    ancestors.add(parent_uuid)
-    return _get_ancestors_by_one_uuid(
-        parent_uuid, parent_uuid_by_rp_uuid, ancestors=ancestors)
+    spans = [span_by_rp_uuid[rp_uuid] for rp_uuid in rp_uuids]
+    # The only provider that can be the root of the others is the one entered
+    # first, and a provider is in its subtree if it is exited no later.
+    _entry, top_exit = min(spans)
+    return all(exit <= top_exit for _entry, exit in spans)
+
+
+def _index_subtrees(parent_uuid_by_rp_uuid, span_by_rp_uuid):
+    """Numbers the providers of whole trees in the order a depth first
+    traversal enters and exits them, so that a provider is in the subtree of
+    another if, and only if, it is entered no earlier and exited no later.
+
+    Warning: This is side-effecty: It is extending span_by_rp_uuid. The
+    numbers carry on from those already in it, so that the spans of
+    different trees never overlap.
+
+    :param parent_uuid_by_rp_uuid: A dict, keyed by resource provider uuid, of
+            the uuid of its parent provider, or None, for every provider of
+            the trees to index.
+    :param span_by_rp_uuid: A dict, keyed by resource provider uuid, of
+            (entry, exit) tuples of integers.
+    """
+    children_by_rp_uuid = collections.defaultdict(list)
+    for rp_uuid, parent_uuid in parent_uuid_by_rp_uuid.items():
+        children_by_rp_uuid[parent_uuid].append(rp_uuid)
+    number = 2 * len(span_by_rp_uuid)
+    entry_by_rp_uuid = {}
+    # The providers being traversed, from a root down, and iterators over
+    # their children left to traverse.
+    path = [None]
+    children = [iter(children_by_rp_uuid[None])]
+    while children:
+        rp_uuid = next(children[-1], None)
+        if rp_uuid is None:
+            children.pop()
+            rp_uuid = path.pop()
+            if rp_uuid is not None:
+                span_by_rp_uuid[rp_uuid] = (
+                    entry_by_rp_uuid.pop(rp_uuid), number)
+                number += 1
+            continue
+        entry_by_rp_uuid[rp_uuid] = number
+        number += 1
+        path.append(rp_uuid)
+        children.append(iter(children_by_rp_uuid[rp_uuid]))
 
 
 def _provider_ids_from_root_ids(context, root_ids):
@@ -928,6 +1386,9 @@ def _provider_ids_from_root_ids(context, root_ids):
                          provider (None if there is no parent)
               root_id: internal id of the resource providers's root provider
     """
+    if context.provider_snapshot is not None:
+        return context.provider_snapshot.provider_ids_from_root_ids(root_ids)
+
     # SELECT
     #   rp.id, rp.uuid, rp.parent_provider_id, rp.root_provider.id
     # FROM resource_providers AS rp
@@ -11,6 +11,7 @@
 #    under the License.
 
 from oslo_db import exception as db_exc
+from oslo_utils import timeutils
 import sqlalchemy as sa
 
 from placement.db.sqlalchemy import models
@@ -86,8 +87,25 @@ def delete_consumers_if_no_allocations(ctx, consumer_uuids):
     ctx.session.execute(del_stmt)
 
 
-@db_api.placement_context_manager.reader
-def _get_consumer_by_uuid(ctx, uuid):
+def increment_generations(ctx, consumers):
+    """Increments the generations of the supplied consumers with a single
+    statement, supplying their currently-known generations.
+
+    Must be called from within a placement_context_manager.writer context.
+
+    :param consumers: An iterable of distinct Consumer objects.
+    :raises placement.exception.ConcurrentUpdateDetected: if another thread
+        updated any of the consumers' view of its allocations in between the
+        time when its object was originally read and this call.
+    """
+    db_api.increment_generations(
+        ctx, CONSUMER_TBL, consumers, exception.ConcurrentUpdateDetected)
+
+
+def _consumer_select(uuid_cond):
+    """Returns a SELECT for the consumers matching the condition returned
+    by uuid_cond(), which is passed the uuid column of the consumers table.
+    """
     # The SQL for this looks like the following:
     # SELECT
     #   c.id, c.uuid, c.consumer_type_id,
@@ -99,7 +117,7 @@ def _get_consumer_by_uuid(ctx, uuid):
     #  ON c.project_id = p.id
     # INNER JOIN users u
     #  ON c.user_id = u.id
-    # WHERE c.uuid = $uuid
+    # WHERE $uuid_cond
     consumers = sa.alias(CONSUMER_TBL, name="c")
     projects = sa.alias(project_obj.PROJECT_TBL, name="p")
     users = sa.alias(user_obj.USER_TBL, name="u")
@@ -121,7 +139,12 @@ def _get_consumer_by_uuid(ctx, uuid):
         consumers.c.updated_at,
         consumers.c.created_at,
     ).select_from(c_to_u_join)
-    sel = sel.where(consumers.c.uuid == uuid)
+    return sel.where(uuid_cond(consumers.c.uuid))
+
+
+@db_api.placement_context_manager.reader
+def _get_consumer_by_uuid(ctx, uuid):
+    sel = _consumer_select(lambda uuid_col: uuid_col == uuid)
     res = ctx.session.execute(sel).fetchone()
     if not res:
         raise exception.ConsumerNotFound(uuid=uuid)
@@ -129,6 +152,61 @@ def _get_consumer_by_uuid(ctx, uuid):
     return dict(res._mapping)
 
 
+@db_api.placement_context_manager.reader
+def _get_consumers_by_uuids(ctx, uuids):
+    sel = _consumer_select(lambda uuid_col: uuid_col.in_(uuids))
+    return [dict(r._mapping) for r in ctx.session.execute(sel)]
+
+
+def get_all_by_uuids(ctx, uuids):
+    """Returns a dict, keyed by uuid, of the Consumer objects for those of
+    the supplied uuids that exist, fetched with a single query.
+
+    :param ctx: The request context.
+    :param uuids: An iterable of consumer uuids.
+    """
+    return {
+        res['uuid']: Consumer._from_db_object(ctx, Consumer(ctx), res)
+        for res in _get_consumers_by_uuids(ctx, list(uuids))
+    }
+
+
+@db_api.placement_context_manager.writer
+def create_all(ctx, consumers):
+    """Creates records for the supplied new Consumer objects with a single
+    INSERT, and sets their id, generation and timestamps.
+
+    :param ctx: The request context.
+    :param consumers: A list of Consumer objects not yet in the database.
+    :raises placement.exception.ConsumerExists: if any of the consumers was
+        already created, in which case none of them is.
+    """
+    # Like models.Consumer.save() in Consumer.create(), stamp created_at and
+    # leave updated_at unset until the consumer is first updated.
+    now = timeutils.utcnow()
+    rows = [
+        {'uuid': c.uuid, 'project_id': c.project.id, 'user_id': c.user.id,
+         'consumer_type_id': c.consumer_type_id, 'created_at': now,
+         'updated_at': None}
+        for c in consumers]
+    try:
+        ctx.session.execute(CONSUMER_TBL.insert(), rows)
+    except db_exc.DBDuplicateEntry:
+        raise exception.ConsumerExists(
+            uuid=', '.join(sorted(c.uuid for c in consumers)))
+    by_uuid = {c.uuid: c for c in consumers}
+    sel = sa.select(
+        CONSUMER_TBL.c.uuid, CONSUMER_TBL.c.id, CONSUMER_TBL.c.generation,
+        CONSUMER_TBL.c.created_at, CONSUMER_TBL.c.updated_at,
+    ).where(CONSUMER_TBL.c.uuid.in_(list(by_uuid)))
+    for row in ctx.session.execute(sel):
+        consumer = by_uuid[row.uuid]
+        consumer.id = row.id
+        consumer.generation = row.generation
+        consumer.created_at = row.created_at
+        consumer.updated_at = row.updated_at
+
+
 @db_api.placement_context_manager.writer
 def _delete_consumer(ctx, consumer):
     """Deletes the supplied consumer.
@@ -13,12 +13,17 @@
 from oslo_db import exception as db_exc
 import sqlalchemy as sa
 
+from placement import attribute_cache
 from placement.db.sqlalchemy import models
 from placement import db_api
 from placement import exception
 
 PROJECT_TBL = models.Project.__table__
 
+# The internal ids, by external id, of the projects recently used by this
+# process
+ID_CACHE = attribute_cache.ExternalIdCache('projects')
+
 
 @db_api.placement_context_manager.writer
 def ensure_incomplete_project(ctx):
@@ -53,6 +58,85 @@ def _get_project_by_external_id(ctx, external_id):
     return dict(res._mapping)
 
 
+@db_api.placement_context_manager.reader
+def _get_projects_by_external_ids(ctx, external_ids):
+    sel = sa.select(
+        PROJECT_TBL.c.id,
+        PROJECT_TBL.c.external_id,
+        PROJECT_TBL.c.updated_at,
+        PROJECT_TBL.c.created_at,
+    )
+    sel = sel.where(PROJECT_TBL.c.external_id.in_(external_ids))
+    return [dict(r._mapping) for r in ctx.session.execute(sel)]
+
+
+@db_api.placement_context_manager.writer
+def _create_projects_in_db(ctx, external_ids):
+    ins = PROJECT_TBL.insert()
+    try:
+        ctx.session.execute(
+            ins, [{'external_id': ext_id} for ext_id in external_ids])
+    except db_exc.DBDuplicateEntry:
+        raise exception.ProjectExists(
+            external_id=', '.join(sorted(external_ids)))
+
+
+def get_id_by_external_id(ctx, external_id):
+    """Returns the internal id of the project with the supplied external id, or
+    None if there is no such project, looking it up only if it is not in
+    ID_CACHE.
+    """
+    internal_id = ID_CACHE.get(external_id)
+    if internal_id is None:
+        try:
+            internal_id = Project.get_by_external_id(ctx, external_id).id
+        except exception.ProjectNotFound:
+            pass
+    return internal_id
+
+
+def get_or_create_all_by_external_ids(ctx, external_ids):
+    """Returns a dict, keyed by external ID, of Project objects for the
+    supplied external IDs, creating records for the ones that do not exist
+    with a single INSERT. The projects whose internal id is in ID_CACHE are not
+    looked up, and their objects have no timestamps.
+
+    :param ctx: The request context.
+    :param external_ids: An iterable of external IDs of projects.
+    """
+    external_ids = set(external_ids)
+
+    def _load(ext_ids):
+        loaded = {}
+        if ext_ids:
+            for res in _get_projects_by_external_ids(ctx, list(ext_ids)):
+                loaded[res['external_id']] = Project._from_db_object(
+                    ctx, Project(ctx), res)
+                ID_CACHE.set(ctx, res['external_id'], res['id'])
+        return loaded
+
+    projects = {}
+    for ext_id in external_ids:
+        internal_id = ID_CACHE.get(ext_id)
+        if internal_id is not None:
+            projects[ext_id] = Project(ctx, id=internal_id, external_id=ext_id)
+    projects.update(_load(external_ids - set(projects)))
+    missing = external_ids - set(projects)
+    if missing:
+        try:
+            _create_projects_in_db(ctx, sorted(missing))
+        except exception.ProjectExists:
+            # Another thread created some of these projects already, so
+            # create the others one at a time
+            for ext_id in missing:
+                try:
+                    Project(ctx, external_id=ext_id).create()
+                except exception.ProjectExists:
+                    pass
+        projects.update(_load(missing))
+    return projects
+
+
 class Project(object):
 
     def __init__(self, context, id=None, external_id=None, updated_at=None,
@@ -75,6 +159,7 @@ class Project(object):
     @classmethod
     def get_by_external_id(cls, ctx, external_id):
         res = _get_project_by_external_id(ctx, external_id)
+        ID_CACHE.set(ctx, external_id, res['id'])
         return cls._from_db_object(ctx, cls(ctx), res)
 
     def create(self):
@@ -87,3 +172,4 @@ class Project(object):
                 raise exception.ProjectExists(external_id=self.external_id)
             self._from_db_object(ctx, self, db_obj)
         _create_in_db(self._context)
+        ID_CACHE.set(self._context, self.external_id, self.id)
@@ -0,0 +1,600 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""An in-memory, per-process snapshot of the data needed to compute
+allocation candidates.
+
+When ``[placement]/allocation_candidates_snapshot`` is enabled, the
+allocation candidates search asks a ProviderSnapshot rather than the
+database for providers, trees, inventories, usages, traits and aggregates.
+The snapshot mirrors the query helpers in research_context so that the
+candidate assembly logic is shared by both code paths.
+
+The snapshot is kept current by periodically comparing the generation,
+parent and root of every resource provider with the database and reloading
+only the providers that changed. Generations are bumped whenever inventory,
+traits or allocations against a provider are written, but not for the
+providers that allocations are removed from, for example by
+DELETE /allocations/{consumer_uuid} or by moving allocations to another
+provider. So a cheap fingerprint of the allocations table is compared too,
+and the usages of all providers are reloaded when it has changed. As a last
+resort, the snapshot is rebuilt from scratch every
+``[placement]/allocation_candidates_snapshot_max_age`` seconds.
+
+The snapshot also holds the contents of the resource class and trait caches,
+which requests answered from it use rather than checking the database, so
+that such requests need not query the database at all.
+"""
+
+import collections
+import copy
+import time
+
+from oslo_concurrency import lockutils
+from oslo_log import log as logging
+import os_traits
+import sqlalchemy as sa
+from sqlalchemy import sql
+
+from placement import attribute_cache
+from placement.db.sqlalchemy import models
+from placement import db_api
+from placement import exception
+from placement.objects import research_context as res_ctx
+
+
+_ALLOC_TBL = models.Allocation.__table__
+_INV_TBL = models.Inventory.__table__
+_RP_TBL = models.ResourceProvider.__table__
+_AGG_TBL = models.PlacementAggregate.__table__
+_RP_AGG_TBL = models.ResourceProviderAggregate.__table__
+_RP_TRAIT_TBL = models.ResourceProviderTrait.__table__
+
+_SNAPSHOT_LOCK = 'provider_snapshot'
+# The ProviderSnapshot shared by all requests handled by this process. It is
+# replaced, never modified in place, so requests holding a reference to an
+# older snapshot are unaffected by a concurrent refresh.
+_SNAPSHOT = None
+
+LOG = logging.getLogger(__name__)
+
+
+_Provider = collections.namedtuple(
+    '_Provider', 'id uuid generation parent_id root_id')
+_Inventory = collections.namedtuple(
+    '_Inventory',
+    'total reserved min_unit max_unit step_size allocation_ratio')
+
+# These mirror the rows returned by the equivalent database queries so that
+# callers cannot tell where the data came from.
+ProviderIds = collections.namedtuple(
+    'ProviderIds', 'id uuid parent_id parent_uuid root_id root_uuid')
+ProviderTreeIds = collections.namedtuple(
+    'ProviderTreeIds', 'id uuid parent_id root_id')
+ProviderUsage = collections.namedtuple(
+    'ProviderUsage',
+    'resource_provider_id resource_provider_uuid resource_class_id total '
+    'reserved allocation_ratio max_unit used')
+
+
+class ProviderSnapshot(object):
+    """An immutable picture of resource providers, their trees, inventories,
+    summed usages, traits and aggregate memberships, all keyed by internal
+    IDs. Refreshing a snapshot creates a new one, sharing the data that has
+    not changed.
+
+    The public methods have the same semantics as the like-named query
+    helpers in placement.objects.research_context, which dispatch to them
+    when a snapshot is attached to the request context.
+    """
+
+    def __init__(self, providers, inventories, usages, traits, aggregates,
+                 agg_ids_by_uuid, agg_watermark, alloc_watermark,
+                 attribute_caches, sharing_trait_id, built_at=None):
+        """Create a ProviderSnapshot.
+
+        :param providers: dict, keyed by provider ID, of _Provider
+        :param inventories: dict, keyed by (provider ID, resource class ID),
+                            of _Inventory
+        :param usages: dict, keyed by (provider ID, resource class ID), of
+                       the summed amount allocated
+        :param traits: dict, keyed by provider ID, of frozensets of trait IDs
+        :param aggregates: dict, keyed by provider ID, of frozensets of
+                           aggregate IDs
+        :param agg_ids_by_uuid: dict, keyed by aggregate UUID, of aggregate ID
+        :param agg_watermark: the aggregate watermark the aggregate data was
+                              loaded at, see _get_aggregate_watermark()
+        :param alloc_watermark: the allocation watermark the usages were
+                                loaded at, see _get_allocation_watermark()
+        :param attribute_caches: dict, keyed by the name of the
+                                 RequestContext attribute holding each
+                                 attribute cache, of the contents of that
+                                 cache, see _get_attribute_caches()
+        :param sharing_trait_id: ID of the MISC_SHARES_VIA_AGGREGATE trait,
+                                 or None if there is no such trait
+        :param built_at: time.monotonic() value of the last full build. If
+                         None, this snapshot is a full build.
+        """
+        now = time.monotonic()
+        self.built_at = now if built_at is None else built_at
+        self.synced_at = now
+        self.agg_watermark = agg_watermark
+        self.alloc_watermark = alloc_watermark
+        self._attribute_caches = attribute_caches
+        self._sharing_trait_id = sharing_trait_id
+        self._providers = providers
+        self._inventories = inventories
+        self._usages = usages
+        self._traits = traits
+        self._aggregates = aggregates
+        self._agg_ids_by_uuid = agg_ids_by_uuid
+
+        self._id_by_uuid = {}
+        self._tree_members = collections.defaultdict(list)
+        self.has_trees = False
+        for prov in providers.values():
+            self._id_by_uuid[prov.uuid] = prov.id
+            self._tree_members[prov.root_id].append(prov.id)
+            if prov.parent_id is not None:
+                self.has_trees = True
+
+        self._rcs_by_rp = collections.defaultdict(list)
+        self._rps_by_rc = collections.defaultdict(list)
+        for rp_id, rc_id in inventories:
+            if rp_id not in providers:
+                continue
+            self._rcs_by_rp[rp_id].append(rc_id)
+            self._rps_by_rc[rc_id].append(rp_id)
+
+        self._rps_by_trait = collections.defaultdict(set)
+        for rp_id, trait_ids in traits.items():
+            for trait_id in trait_ids:
+                self._rps_by_trait[trait_id].add(rp_id)
+
+        self._rps_by_agg = collections.defaultdict(set)
+        for rp_id, agg_ids in aggregates.items():
+            for agg_id in agg_ids:
+                self._rps_by_agg[agg_id].add(rp_id)
+
+    def __len__(self):
+        return len(self._providers)
+
+    def _resynced(self, attribute_caches, sharing_trait_id):
+        """Return a copy of this snapshot, sharing all of its provider data,
+        which was found to still be current just now.
+        """
+        snap = copy.copy(self)
+        snap.synced_at = time.monotonic()
+        snap._attribute_caches = attribute_caches
+        snap._sharing_trait_id = sharing_trait_id
+        return snap
+
+    def use_attribute_caches(self, ctx):
+        """Make the resource class and trait caches of the supplied request
+        context use the contents loaded with this snapshot, rather than check
+        the database on their first lookup.
+        """
+        for name, contents in self._attribute_caches.items():
+            getattr(ctx, name).use_contents(contents)
+
+    def provider_ids_from_uuid(self, uuid):
+        rp_id = self._id_by_uuid.get(uuid)
+        if rp_id is None:
+            return None
+        prov = self._providers[rp_id]
+        parent_uuid = None
+        if prov.parent_id is not None:
+            parent_uuid = self._providers[prov.parent_id].uuid
+        return ProviderIds(
+            prov.id, prov.uuid, prov.parent_id, parent_uuid, prov.root_id,
+            self._providers[prov.root_id].uuid)
+
+    def get_providers_with_resources(self, resources, tree_root_id=None):
+        res = set()
+        for rc_id, amount in resources.items():
+            for rp_id in self._rps_by_rc.get(rc_id, ()):
+                root_id = self._providers[rp_id].root_id
+                if tree_root_id is not None and root_id != tree_root_id:
+                    continue
+                inv = self._inventories[(rp_id, rc_id)]
+                used = self._usages.get((rp_id, rc_id), 0)
+                capacity = (inv.total - inv.reserved) * inv.allocation_ratio
+                if (used + amount <= capacity and
+                        inv.min_unit <= amount <= inv.max_unit and
+                        amount % inv.step_size == 0):
+                    res.add((rp_id, root_id, rc_id))
+        return res
+
+    def get_providers_with_root(self, allowed, forbidden):
+        rp_ids = set(self._providers)
+        if allowed:
+            rp_ids &= set(allowed)
+        if forbidden:
+            rp_ids -= set(forbidden)
+        return set((rp_id, self._providers[rp_id].root_id)
+                   for rp_id in rp_ids)
+
+    def _get_trees_with_traits(self, rp_ids, required_traits,
+                               forbidden_traits):
+        forbidden = set(forbidden_traits)
+        original_rp_ids = {
+            rp_id: self._providers[rp_id].root_id
+            for rp_id in rp_ids if rp_id in self._providers}
+        good_rp_ids = {
+            rp_id: root_id for rp_id, root_id in original_rp_ids.items()
+            if not forbidden & self._traits.get(rp_id, frozenset())}
+
+        if not required_traits:
+            good_roots = set(good_rp_ids.values())
+            return set((rp_id, root_id)
+                       for rp_id, root_id in original_rp_ids.items()
+                       if root_id in good_roots)
+
+        root_to_traits = collections.defaultdict(set)
+        for rp_id, root_id in good_rp_ids.items():
+            root_to_traits[root_id] |= self._traits.get(rp_id, frozenset())
+
+        result = set()
+        for root_id, provided_traits in root_to_traits.items():
+            if all(any_traits & provided_traits
+                   for any_traits in required_traits):
+                result.update(
+                    (rp_id, root_id)
+                    for rp_id, original_root_id in original_rp_ids.items()
+                    if original_root_id == root_id)
+        return result
+
+    def _get_roots_with_traits(self, required_traits, forbidden_traits):
+        required = set(required_traits or ())
+        forbidden = set(forbidden_traits or ())
+        res = set()
+        for prov in self._providers.values():
+            if prov.parent_id is not None:
+                continue
+            traits = self._traits.get(prov.id, frozenset())
+            if required <= traits and not forbidden & traits:
+                res.add(prov.id)
+        return res
+
+    def provider_ids_matching_aggregates(self, member_of, rp_ids=None):
+        res = set(self._providers)
+        for members in member_of:
+            agg_ids = [self._agg_ids_by_uuid[member] for member in members
+                       if member in self._agg_ids_by_uuid]
+            if not agg_ids:
+                return set()
+            res &= set().union(
+                *(self._rps_by_agg.get(agg_id, ()) for agg_id in agg_ids))
+        if rp_ids:
+            res &= set(rp_ids)
+        return res
+
+    def provider_ids_matching_required_traits(self, required_traits,
+                                              rp_ids=None):
+        res = set(self._providers)
+        for any_traits in required_traits:
+            res &= set().union(
+                *(self._rps_by_trait.get(trait_id, ())
+                  for trait_id in any_traits))
+        if rp_ids:
+            res &= set(rp_ids)
+        return res
+
+    def get_provider_ids_having_any_trait(self, traits):
+        return set().union(
+            *(self._rps_by_trait.get(trait_id, ()) for trait_id in traits))
+
+    def get_trait_ids_by_provider(self, rp_ids, trait_ids):
+        trait_ids = set(trait_ids)
+        res = collections.defaultdict(set)
+        for rp_id in rp_ids:
+            rp_trait_ids = self._traits.get(rp_id, frozenset()) & trait_ids
+            if rp_trait_ids:
+                res[rp_id] = set(rp_trait_ids)
+        return res
+
+    def get_sharing_providers(self, rp_ids=None):
+        res = self._rps_by_trait.get(self._sharing_trait_id, set()) & set(
+            self._providers)
+        if rp_ids:
+            res &= set(rp_ids)
+        return res
+
+    def anchors_for_sharing_providers(self, rp_ids):
+        res = set()
+        for rp_id in rp_ids:
+            sharing = self._providers.get(rp_id)
+            if sharing is None:
+                continue
+            for agg_id in self._aggregates.get(rp_id, ()):
+                for member_id in self._rps_by_agg.get(agg_id, ()):
+                    member = self._providers.get(member_id)
+                    if member is None:
+                        continue
+                    root = self._providers[member.root_id]
+                    res.add(res_ctx.AnchorIds(
+                        sharing.id, sharing.uuid, root.id, root.uuid))
+        return res
+
+    def get_usages_by_provider_trees(self, root_ids, rc_ids=None):
+        res = []
+        for root_id in root_ids:
+            for rp_id in self._tree_members.get(root_id, ()):
+                rp_uuid = self._providers[rp_id].uuid
+                rp_rc_ids = self._rcs_by_rp.get(rp_id, ())
+                if rc_ids is not None:
+                    rp_rc_ids = [
+                        rc_id for rc_id in rp_rc_ids if rc_id in rc_ids]
+                elif not rp_rc_ids:
+                    res.append(ProviderUsage(
+                        rp_id, rp_uuid, None, None, None, None, None, None))
+                    continue
+                for rc_id in rp_rc_ids:
+                    inv = self._inventories[(rp_id, rc_id)]
+                    res.append(ProviderUsage(
+                        rp_id, rp_uuid, rc_id, inv.total, inv.reserved,
+                        inv.allocation_ratio, inv.max_unit,
+                        self._usages.get((rp_id, rc_id))))
+        return res
+
+    def provider_ids_from_root_ids(self, root_ids):
+        res = {}
+        for root_id in root_ids:
+            for rp_id in self._tree_members.get(root_id, ()):
+                prov = self._providers[rp_id]
+                res[rp_id] = ProviderTreeIds(
+                    prov.id, prov.uuid, prov.parent_id, prov.root_id)
+        return res
+
+    def get_traits_by_provider_tree(self, ctx, root_ids):
+        res = collections.defaultdict(list)
+        for root_id in root_ids:
+            for rp_id in self._tree_members.get(root_id, ()):
+                for trait_id in self._traits.get(rp_id, ()):
+                    res[rp_id].append(ctx.trait_cache.string_from_id(trait_id))
+        return res
+
+
+def _provider_select():
+    return sa.select(
+        _RP_TBL.c.id,
+        _RP_TBL.c.uuid,
+        _RP_TBL.c.generation,
+        _RP_TBL.c.parent_provider_id,
+        _RP_TBL.c.root_provider_id,
+    )
+
+
+def _get_providers(ctx):
+    return {r[0]: _Provider(*r)
+            for r in ctx.session.execute(_provider_select())}
+
+
+def _get_inventories(ctx, rp_ids=None):
+    sel = sa.select(
+        _INV_TBL.c.resource_provider_id,
+        _INV_TBL.c.resource_class_id,
+        _INV_TBL.c.total,
+        _INV_TBL.c.reserved,
+        _INV_TBL.c.min_unit,
+        _INV_TBL.c.max_unit,
+        _INV_TBL.c.step_size,
+        _INV_TBL.c.allocation_ratio,
+    )
+    params = {}
+    if rp_ids is not None:
+        sel = sel.where(_INV_TBL.c.resource_provider_id.in_(
+            sa.bindparam('rp_ids', expanding=True)))
+        params['rp_ids'] = list(rp_ids)
+    return {(r[0], r[1]): _Inventory(*r[2:])
+            for r in ctx.session.execute(sel, params)}
+
+
+def _get_usages(ctx, rp_ids=None):
+    sel = sa.select(
+        _ALLOC_TBL.c.resource_provider_id,
+        _ALLOC_TBL.c.resource_class_id,
+        sql.func.sum(_ALLOC_TBL.c.used).label('used'),
+    )
+    params = {}
+    if rp_ids is not None:
+        sel = sel.where(_ALLOC_TBL.c.resource_provider_id.in_(
+            sa.bindparam('rp_ids', expanding=True)))
+        params['rp_ids'] = list(rp_ids)
+    sel = sel.group_by(
+        _ALLOC_TBL.c.resource_provider_id, _ALLOC_TBL.c.resource_class_id)
+    # NOTE: SUM() may come back as a Decimal on MySQL.
+    return {(r[0], r[1]): int(r[2])
+            for r in ctx.session.execute(sel, params)}
+
+
+def _get_traits(ctx, rp_ids=None):
+    sel = sa.select(
+        _RP_TRAIT_TBL.c.resource_provider_id, _RP_TRAIT_TBL.c.trait_id)
+    params = {}
+    if rp_ids is not None:
+        sel = sel.where(_RP_TRAIT_TBL.c.resource_provider_id.in_(
+            sa.bindparam('rp_ids', expanding=True)))
+        params['rp_ids'] = list(rp_ids)
+    res = collections.defaultdict(set)
+    for rp_id, trait_id in ctx.session.execute(sel, params):
+        res[rp_id].add(trait_id)
+    return {rp_id: frozenset(trait_ids) for rp_id, trait_ids in res.items()}
+
+
+def _get_aggregates(ctx):
+    sel = sa.select(
+        _RP_AGG_TBL.c.resource_provider_id, _RP_AGG_TBL.c.aggregate_id)
+    aggs = collections.defaultdict(set)
+    for rp_id, agg_id in ctx.session.execute(sel):
+        aggs[rp_id].add(agg_id)
+    aggs = {rp_id: frozenset(agg_ids) for rp_id, agg_ids in aggs.items()}
+    sel = sa.select(_AGG_TBL.c.uuid, _AGG_TBL.c.id)
+    agg_ids_by_uuid = {r[0]: r[1] for r in ctx.session.execute(sel)}
+    return aggs, agg_ids_by_uuid
+
+
+def _get_aggregate_watermark(ctx):
+    """Returns a cheap fingerprint of the resource_provider_aggregates table.
+
+    Changing aggregate associations does not necessarily increment the
+    provider generation (it only does so from microversion 1.19), so we
+    cannot rely on generations to notice them. The row count, the sums of
+    both ID columns and the latest creation time change whenever an
+    association is added or removed.
+    """
+    sel = sa.select(
+        sql.func.count(),
+        sql.func.sum(_RP_AGG_TBL.c.resource_provider_id),
+        sql.func.sum(_RP_AGG_TBL.c.aggregate_id),
+        sql.func.max(_RP_AGG_TBL.c.created_at),
+    )
+    return tuple(ctx.session.execute(sel).fetchone())
+
+
+def _get_allocation_watermark(ctx):
+    """Returns a cheap fingerprint of the allocations table.
+
+    Removing allocations does not increment the generation of their provider,
+    so we cannot rely on generations to notice them. Allocations are never
+    updated, only deleted and inserted again, so the row count changes when
+    allocations are removed, and the highest ID (which SQLite may reuse) or
+    the sum of the provider IDs when they are moved to another provider.
+    """
+    sel = sa.select(
+        sql.func.count(_ALLOC_TBL.c.id),
+        sql.func.max(_ALLOC_TBL.c.id),
+        sql.func.sum(_ALLOC_TBL.c.resource_provider_id),
+    )
+    return tuple(ctx.session.execute(sel).fetchone())
+
+
+def _get_attribute_caches(ctx):
+    """Returns a dict, keyed by the name of the RequestContext attribute
+    holding each, of the contents of the resource class and trait caches, and
+    the ID of the MISC_SHARES_VIA_AGGREGATE trait, or None if there is no such
+    trait.
+
+    Fresh caches are used so that the contents are as current as the
+    database, whatever the caches of ctx hold.
+    """
+    rc_cache = attribute_cache.ResourceClassCache(ctx)
+    trait_cache = attribute_cache.TraitCache(ctx)
+    try:
+        sharing_trait_id = trait_cache.id_from_string(
+            os_traits.MISC_SHARES_VIA_AGGREGATE)
+    except exception.TraitNotFound:
+        sharing_trait_id = None
+    caches = {
+        'rc_cache': rc_cache.get_contents(),
+        'trait_cache': trait_cache.get_contents(),
+    }
+    return caches, sharing_trait_id
+
+
+@db_api.placement_context_manager.reader
+def _build_snapshot(ctx):
+    """Load a complete ProviderSnapshot from the database."""
+    agg_watermark = _get_aggregate_watermark(ctx)
+    alloc_watermark = _get_allocation_watermark(ctx)
+    attribute_caches, sharing_trait_id = _get_attribute_caches(ctx)
+    aggs, agg_ids_by_uuid = _get_aggregates(ctx)
+    snap = ProviderSnapshot(
+        _get_providers(ctx), _get_inventories(ctx), _get_usages(ctx),
+        _get_traits(ctx), aggs, agg_ids_by_uuid, agg_watermark,
+        alloc_watermark, attribute_caches, sharing_trait_id)
+    LOG.debug('Built provider snapshot with %d providers', len(snap))
+    return snap
+
+
+@db_api.placement_context_manager.reader
+def _refresh_snapshot(ctx, snap):
+    """Return a ProviderSnapshot that is current with the database, reusing
+    the data in ``snap`` for every provider that has not changed.
+    """
+    providers = _get_providers(ctx)
+    # Any provider whose generation, parent or root differs from what we
+    # have, including new providers, needs reloading.
+    changed = set(rp_id for rp_id, prov in providers.items()
+                  if snap._providers.get(rp_id) != prov)
+    stale = changed | (set(snap._providers) - set(providers))
+    agg_watermark = _get_aggregate_watermark(ctx)
+    alloc_watermark = _get_allocation_watermark(ctx)
+    attribute_caches, sharing_trait_id = _get_attribute_caches(ctx)
+
+    if (not stale and agg_watermark == snap.agg_watermark and
+            alloc_watermark == snap.alloc_watermark):
+        return snap._resynced(attribute_caches, sharing_trait_id)
+
+    inventories = {key: inv for key, inv in snap._inventories.items()
+                   if key[0] not in stale}
+    traits = {rp_id: trait_ids for rp_id, trait_ids in snap._traits.items()
+              if rp_id not in stale}
+    if changed:
+        inventories.update(_get_inventories(ctx, changed))
+        traits.update(_get_traits(ctx, changed))
+
+    if alloc_watermark == snap.alloc_watermark:
+        usages = {key: used for key, used in snap._usages.items()
+                  if key[0] not in stale}
+        if changed:
+            usages.update(_get_usages(ctx, changed))
+    else:
+        # Allocations were written or removed. The providers they were
+        # removed from, if any, kept their generation, so we can't tell
+        # which ones they are.
+        usages = _get_usages(ctx)
+
+    if agg_watermark == snap.agg_watermark:
+        aggs, agg_ids_by_uuid = snap._aggregates, snap._agg_ids_by_uuid
+    else:
+        aggs, agg_ids_by_uuid = _get_aggregates(ctx)
+
+    LOG.debug('Refreshed provider snapshot: %d of %d providers changed',
+              len(stale), len(providers))
+    return ProviderSnapshot(
+        providers, inventories, usages, traits, aggs, agg_ids_by_uuid,
+        agg_watermark, alloc_watermark, attribute_caches, sharing_trait_id,
+        built_at=snap.built_at)
+
+
+def get_snapshot(ctx):
+    """Returns the process-wide ProviderSnapshot, building or refreshing it
+    first if the configured refresh interval or maximum age has elapsed.
+
+    :param ctx: `placement.context.RequestContext` that may be used to grab a
+                DB connection.
+    """
+    global _SNAPSHOT
+    conf = ctx.config.placement
+    snap = _SNAPSHOT
+    if snap is not None and (
+            time.monotonic() - snap.synced_at <
+            conf.allocation_candidates_snapshot_refresh_interval):
+        return snap
+
+    # If another thread is already refreshing, wait for it and use its
+    # result if that is recent enough.
+    with lockutils.lock(_SNAPSHOT_LOCK):
+        snap = _SNAPSHOT
+        now = time.monotonic()
+        if snap is not None and (
+                now - snap.synced_at <
+                conf.allocation_candidates_snapshot_refresh_interval):
+            return snap
+        if snap is None or (
+                now - snap.built_at >=
+                conf.allocation_candidates_snapshot_max_age):
+            snap = _build_snapshot(ctx)
+        else:
+            snap = _refresh_snapshot(ctx, snap)
+        _SNAPSHOT = snap
+    return snap
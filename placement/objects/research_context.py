@@ -11,13 +11,16 @@
 #    under the License.
 """Utility methods for getting allocation candidates."""
 import collections
-import copy
+import heapq
+import itertools
 
 import os_traits
+from oslo_concurrency import lockutils
 from oslo_log import log as logging
 import random
 import sqlalchemy as sa
 from sqlalchemy import sql
+import time
 
 from placement.db.sqlalchemy import models
 from placement import db_api
@@ -37,9 +40,22 @@ _RP_TRAIT_TBL = models.ResourceProviderTrait.__table__
 
 LOG = logging.getLogger(__name__)
 
+# A dict, keyed by the name of a deployment topology fact, of (value,
+# time.monotonic() at which the value was read from the database) tuples,
+# shared by all requests in this process. See _get_topology_fact().
+_TOPOLOGY = {}
+
+# The number of writer transactions committed by this process which may have
+# changed the allocation candidates of some request. See
+# note_candidates_change().
+_CANDIDATES_CHANGES = 0
+_CANDIDATES_CHANGES_LOCK = 'candidates_changes'
+
 
 AnchorIds = collections.namedtuple(
     'AnchorIds', 'rp_id rp_uuid anchor_id anchor_uuid')
+ProviderCapacity = collections.namedtuple(
+    'ProviderCapacity', 'capacity used max_unit')
 
 
 class RequestGroupSearchContext(object):
@@ -125,21 +141,23 @@ class RequestGroupSearchContext(object):
                       "tree with the root provider %s",
                       self.suffix, tree_ids.root_uuid)
 
-        self._rps_with_resource = {}
+        # NOTE(tetsuro): We could pass rps in requested aggregates to
+        # get_providers_with_resources here once we explicitly put
+        # aggregates to nested (non-root) providers (the aggregate
+        # flows down feature) rather than applying later the implicit rule
+        # that aggregate on root spans the whole tree
+        self._rps_with_resource = {rc_id: set() for rc_id in self.resources}
+        if self.resources:
+            LOG.debug('getting providers with %s', group.resources)
+            provs_with_resources = get_providers_with_resources(
+                context, self.resources, tree_root_id=self.tree_root_id)
+            for rp_id, root_id, rc_id in provs_with_resources:
+                self._rps_with_resource[rc_id].add((rp_id, root_id))
         for rc_id, amount in self.resources.items():
-            # NOTE(tetsuro): We could pass rps in requested aggregates to
-            # get_providers_with_resource here once we explicitly put
-            # aggregates to nested (non-root) providers (the aggregate
-            # flows down feature) rather than applying later the implicit rule
-            # that aggregate on root spans the whole tree
-            rc_name = context.rc_cache.string_from_id(rc_id)
-            LOG.debug('getting providers with %d %s', amount, rc_name)
-            provs_with_resource = get_providers_with_resource(
-                context, rc_id, amount, tree_root_id=self.tree_root_id)
-            if not provs_with_resource:
-                LOG.debug('found no providers with %d %s', amount, rc_name)
+            if not self._rps_with_resource[rc_id]:
+                LOG.debug('found no providers with %d %s', amount,
+                          context.rc_cache.string_from_id(rc_id))
                 raise exception.ResourceProviderNotFound()
-            self._rps_with_resource[rc_id] = provs_with_resource
 
         # a set of resource provider IDs that share some inventory for some
         # resource class.
@@ -154,8 +172,11 @@ class RequestGroupSearchContext(object):
         the requested resource class (if there isn't, we take faster, simpler
         code paths)
         """
-        # NOTE: This could be refactored to see the requested resources
-        return bool(self._sharing_providers)
+        if not self.resources:
+            return bool(self._sharing_providers)
+        return any(
+            self.get_rps_with_shared_capacity(rc_id)
+            for rc_id in self.resources)
 
     @property
     def exists_nested(self):
@@ -168,7 +189,9 @@ class RequestGroupSearchContext(object):
     def get_rps_with_shared_capacity(self, rc_id):
         sharing_in_aggs = self._sharing_providers
         if self.rps_in_aggs:
-            sharing_in_aggs &= self.rps_in_aggs
+            # Don't modify the set of sharing providers in place: it is shared
+            # by all request groups and possibly by other requests.
+            sharing_in_aggs = sharing_in_aggs & self.rps_in_aggs
         if not sharing_in_aggs:
             return set()
         rps_with_resource = set(p[0] for p in self._rps_with_resource[rc_id])
@@ -192,28 +215,48 @@ class RequestWideSearchContext(object):
         """
         self._ctx = context
         self._limit = rqparams.limit
+        self._sort = rqparams.sort
         self.group_policy = rqparams.group_policy
         self._nested_aware = nested_aware
-        self.has_trees = _has_provider_trees(context)
+        self.has_trees = has_provider_trees(context)
         # This is set up by _process_anchor_* below. It remains None if no
         # anchor filters were requested. Otherwise it becomes a set of internal
         # IDs of root providers that conform to the requested filters.
         self.anchor_root_ids = None
         self._process_anchor_traits(rqparams)
         self.same_subtrees = rqparams.same_subtrees
-        # A dict, keyed by resource provider id of ProviderSummary objects.
-        # Used as a cache of ProviderSummaries created in this request to
-        # avoid duplication.
-        self.summaries_by_id = {}
+        # A dict, keyed by resource provider id, of ResourceProvider objects
+        # for every provider in the trees found while searching. Used as a
+        # cache of ResourceProviders created in this request to avoid
+        # duplication. ProviderSummary objects are only built, once the
+        # results are limited, for the providers that are returned.
+        self.providers_by_id = {}
+        # A dict, keyed by resource provider id, of the id of its root provider
+        self.root_id_by_rp_id = {}
+        # A dict, keyed by resource provider id, of lists of trait names
+        self.traits_by_rp_id = {}
         # A set of resource classes that were requested in more than one group
         self.multi_group_rcs = set()
-        # A mapping of resource provider uuid to parent provider uuid, used
-        # when merging allocation candidates.
-        self.parent_uuid_by_rp_uuid = {}
-        # Dict mapping (resource provier uuid, resource class name) to a
-        # ProviderSummaryResource. Used during _exceeds_capacity in
-        # _merge_candidates.
-        self.psum_res_by_rp_rc = {}
+        # A dict, keyed by resource provider uuid, of the numbers at which a
+        # depth first traversal of its tree enters and exits the provider.
+        # Used to check same_subtree constraints when merging allocation
+        # candidates.
+        self.span_by_rp_uuid = {}
+        # Dict mapping (resource provider id, resource class name) to a
+        # ProviderCapacity. Used to sort the results, and to log why
+        # exceeds_capacity rejects AllocationRequests in _merge_candidates.
+        self.capacity_by_rp_rc = {}
+        # Dict mapping (resource provider id, resource class name) to the
+        # largest amount that can still be allocated at once: the smaller of
+        # the free capacity and the max_unit. Used by exceeds_capacity.
+        self.headroom_by_rp_rc = {}
+        # A set of (root provider id, resource class id) tuples for which
+        # capacity_by_rp_rc has been loaded.
+        self.capacity_loaded = set()
+        # A dict, keyed by internal ID of sharing provider, of sets of
+        # AnchorIds for that sharing provider. Used as a cache so that anchors
+        # are looked up once per request rather than once per request group.
+        self._anchors_by_sharing_rp_id = {}
 
     def _process_anchor_traits(self, rqparams):
         """Set or filter self.anchor_root_ids according to anchor
@@ -244,6 +287,29 @@ class RequestWideSearchContext(object):
                       'forbidden traits: %s', required, forbidden)
             raise exception.ResourceProviderNotFound()
 
+    def anchors_for_sharing_providers(self, rp_ids):
+        """Returns a set of AnchorIds namedtuples for the sharing providers
+        with the supplied internal IDs, as anchors_for_sharing_providers()
+        does.
+
+        The anchors of all of the sharing providers not seen before in this
+        request are looked up in a single query, and remembered for the rest
+        of the request.
+
+        :param rp_ids: An iterable of internal IDs of sharing providers.
+        """
+        rp_ids = set(rp_ids)
+        missing = rp_ids - set(self._anchors_by_sharing_rp_id)
+        if missing:
+            # Request groups may be searched concurrently, so only add the
+            # anchors to the cache once they are all known.
+            found = {rp_id: set() for rp_id in missing}
+            for anchor in anchors_for_sharing_providers(self._ctx, missing):
+                found[anchor.rp_id].add(anchor)
+            self._anchors_by_sharing_rp_id.update(found)
+        return set().union(*(
+            self._anchors_by_sharing_rp_id[rp_id] for rp_id in rp_ids))
+
     def in_filtered_anchors(self, anchor_root_id):
         """Returns whether anchor_root_id is present in filtered anchors. (If
         we don't have filtered anchors, that implicitly means "all possible
@@ -254,95 +320,125 @@ class RequestWideSearchContext(object):
             return True
         return anchor_root_id in self.anchor_root_ids
 
-    def exclude_nested_providers(
-            self, allocation_requests, provider_summaries):
-        """Exclude allocation requests and provider summaries for old
-        microversions if they involve more than one provider from the same
-        tree.
+    def exclude_nested_providers(self, allocation_requests):
+        """Exclude allocation requests for old microversions if they involve
+        more than one provider from the same tree.
+
+        :param allocation_requests: An iterable of AllocationRequest.
+        :return: An iterable of the AllocationRequest that are not excluded.
+                 It is lazily evaluated if allocation_requests is.
         """
         if self._nested_aware or not self.has_trees:
-            return allocation_requests, provider_summaries
-
-        filtered_areqs = []
-        all_rp_uuids = set()
-        for a_req in allocation_requests:
-            root_by_rp = {
-                arr.resource_provider.uuid:
-                    arr.resource_provider.root_provider_uuid
-                for arr in a_req.resource_requests}
-            # If more than one allocation is provided by the same tree,
-            # we need to skip that allocation request.
-            if len(root_by_rp) == len(set(root_by_rp.values())):
-                filtered_areqs.append(a_req)
-                all_rp_uuids |= set(root_by_rp)
-
-        # Exclude eliminated providers from the provider summaries.
-        filtered_summaries = [ps for ps in provider_summaries
-                              if ps.resource_provider.uuid in all_rp_uuids]
-
-        LOG.debug(
-            'Excluding nested providers yields %d allocation requests and '
-            '%d provider summaries', len(filtered_areqs),
-            len(filtered_summaries))
-        return filtered_areqs, filtered_summaries
-
-    def limit_results(self, alloc_request_objs, summary_objs):
-        # Limit the number of allocation request objects. We do this after
-        # creating all of them so that we can do a random slice without
-        # needing to mess with complex sql or add additional columns to the DB.
-        if self._limit and self._limit < len(alloc_request_objs):
-            if self._ctx.config.placement.randomize_allocation_candidates:
-                alloc_request_objs = random.sample(
-                    alloc_request_objs, self._limit)
-            else:
-                alloc_request_objs = alloc_request_objs[:self._limit]
-            # Limit summaries to only those mentioned in the allocation reqs.
-            kept_summary_objs = []
-            alloc_req_root_uuids = set()
-            # Extract root resource provider uuids from the resource requests.
-            for aro in alloc_request_objs:
-                for arr in aro.resource_requests:
-                    alloc_req_root_uuids.add(
-                        arr.resource_provider.root_provider_uuid)
-            for summary in summary_objs:
-                rp_root_uuid = summary.resource_provider.root_provider_uuid
-                # Skip a summary if we are limiting and haven't selected an
-                # allocation request that uses the resource provider.
-                if rp_root_uuid not in alloc_req_root_uuids:
-                    continue
-                kept_summary_objs.append(summary)
-            summary_objs = kept_summary_objs
-            LOG.debug('Limiting results yields %d allocation requests and '
-                      '%d provider summaries', len(alloc_request_objs),
-                      len(summary_objs))
-        elif self._ctx.config.placement.randomize_allocation_candidates:
+            return allocation_requests
+        return (a_req for a_req in allocation_requests
+                if not self._uses_nested_providers(a_req))
+
+    @staticmethod
+    def _uses_nested_providers(a_req):
+        root_by_rp = {
+            arr.resource_provider.uuid:
+                arr.resource_provider.root_provider_uuid
+            for arr in a_req.resource_requests}
+        # If more than one allocation is provided by the same tree,
+        # we need to skip that allocation request.
+        if len(root_by_rp) == len(set(root_by_rp.values())):
+            return False
+        LOG.debug('Excluding the following AllocationRequest because it '
+                  'involves more than one provider from the same tree: %s',
+                  a_req)
+        return True
+
+    def limit_results(self, alloc_request_objs):
+        """Limit the number of allocation request objects.
+
+        The allocation requests are consumed only as far as needed, so when
+        alloc_request_objs is a generator the work done to produce them
+        scales with the limit rather than with the number of possible
+        candidates. When randomizing, every allocation request has to be
+        looked at to draw a uniform sample, but reservoir sampling means that
+        no more than `limit` of them are held at any one time. The same goes
+        for sorting, which selects the first `limit` allocation requests with
+        a bounded heap and takes precedence over randomizing.
+
+        :param alloc_request_objs: An iterable of AllocationRequest.
+        :return: A list of no more than `limit` AllocationRequest.
+        """
+        if self._sort:
+            if self._limit:
+                return heapq.nsmallest(
+                    self._limit, alloc_request_objs, key=self._sort_key)
+            return sorted(alloc_request_objs, key=self._sort_key)
+        randomize = self._ctx.config.placement.randomize_allocation_candidates
+        if not self._limit:
+            alloc_request_objs = list(alloc_request_objs)
+        elif randomize:
+            alloc_request_objs = _reservoir_sample(
+                alloc_request_objs, self._limit)
+        else:
+            alloc_request_objs = list(
+                itertools.islice(alloc_request_objs, self._limit))
+        if randomize:
+            # Neither a reservoir sample nor the unlimited list is in random
+            # order by itself.
             random.shuffle(alloc_request_objs)
+        return alloc_request_objs
 
-        return alloc_request_objs, summary_objs
+    def _sort_key(self, areq):
+        """Returns the key ordering the supplied AllocationRequest according
+        to the requested sort.
 
-    def copy_arr_if_needed(self, arr):
-        """Copy or return arr, depending on the search context.
+        The key is based on the mean, weighted by resource class, of the
+        fraction of the capacity of each resource class of each provider that
+        would remain free once areq is allocated. Smaller keys come first, so
+        the fraction is used as is to pack and negated to spread.
 
-        In cases with group_policy=none where multiple groups request
-        amounts from the same resource class, we end up using the same
-        AllocationRequestResource more than once when consolidating. So we
-        need to make a copy so we don't overwrite the one used for a
-        different result. But as an optimization, since this copy is not
-        cheap, we don't do it unless it's necessary.
-
-        :param arr: An AllocationRequestResource to be returned or copied and
-                returned.
-        :return: arr or a copy thereof.
+        :param areq: An AllocationRequest that does not exceed capacity.
         """
-        if self.group_policy != 'none':
-            return arr
-        if arr.resource_class in self.multi_group_rcs:
-            return copy.copy(arr)
-        return arr
-
-    def exceeds_capacity(self, areq):
+        strategy, weights = self._sort
+        total = weight_sum = 0.0
+        for arr in areq.resource_requests:
+            weight = weights.get(arr.resource_class, 0) if weights else 1
+            if not weight:
+                continue
+            cap = self.capacity_by_rp_rc[
+                (arr.resource_provider.id, arr.resource_class)]
+            free = cap.capacity - cap.used - arr.amount
+            total += weight * free / cap.capacity
+            weight_sum += weight
+        free_ratio = total / weight_sum if weight_sum else 0.0
+        return free_ratio if strategy == 'pack' else -free_ratio
+
+    def provider_ids_for(self, alloc_request_objs):
+        """Returns a set of the internal IDs of the providers, among those
+        found while searching, whose summaries are to be returned along with
+        the supplied allocation requests.
+
+        That is every provider in the trees involved in the allocation requests
+        or, for microversions that are blind to nested providers, only the
+        providers involved in them.
+
+        :param alloc_request_objs: A list of AllocationRequest.
+        """
+        if self._nested_aware or not self.has_trees:
+            # Extract root resource provider uuids from the resource requests.
+            root_uuids = set(
+                arr.resource_provider.root_provider_uuid
+                for aro in alloc_request_objs
+                for arr in aro.resource_requests)
+            return set(
+                rp_id for rp_id, rp in self.providers_by_id.items()
+                if rp.root_provider_uuid in root_uuids)
+        rp_uuids = set(
+            arr.resource_provider.uuid
+            for aro in alloc_request_objs
+            for arr in aro.resource_requests)
+        return set(
+            rp_id for rp_id, rp in self.providers_by_id.items()
+            if rp.uuid in rp_uuids)
+
+    def exceeds_capacity(self, areq, amounts_by_rp_rc=None):
         """Checks a (consolidated) AllocationRequest against the provider
-        summaries to ensure that it does not exceed capacity.
+        capacities to ensure that it does not exceed capacity.
 
         Exceeding capacity can mean the total amount (already used plus this
         allocation) exceeds the total inventory amount; or this allocation
@@ -350,27 +446,57 @@ class RequestWideSearchContext(object):
 
         :param areq: An AllocationRequest produced by the
                 `_consolidate_allocation_requests` method.
+        :param amounts_by_rp_rc: An optional dict, keyed by (resource provider
+                id, resource class name), of the amounts requested by other
+                AllocationRequests that areq is going to be consolidated with.
+                If provided, those amounts are counted as part of areq.
         :return: True if areq exceeds capacity; False otherwise.
         """
+        headroom_by_rp_rc = self.headroom_by_rp_rc
         for arr in areq.resource_requests:
             key = (arr.resource_provider.id, arr.resource_class)
-            psum_res = self.psum_res_by_rp_rc[key]
-            if psum_res.used + arr.amount > psum_res.capacity:
-                LOG.debug('Excluding the following AllocationRequest because '
-                          'used (%d) + amount (%d) > capacity (%d) for '
-                          'resource class %s: %s',
-                          psum_res.used, arr.amount, psum_res.capacity,
-                          arr.resource_class, str(areq))
-                return True
-            if arr.amount > psum_res.max_unit:
-                LOG.debug('Excluding the following AllocationRequest because '
-                          'amount (%d) > max_unit (%d) for resource class '
-                          '%s: %s',
-                          arr.amount, psum_res.max_unit, arr.resource_class,
-                          str(areq))
+            amount = arr.amount
+            if amounts_by_rp_rc:
+                amount += amounts_by_rp_rc.get(key, 0)
+            if amount > headroom_by_rp_rc[key]:
+                # Only describe the AllocationRequest if it is going to be
+                # logged, it is rejected way too often for that to be free.
+                if LOG.isEnabledFor(logging.DEBUG):
+                    self._log_exceeded(areq, arr, amount)
                 return True
         return False
 
+    def _log_exceeded(self, areq, arr, amount):
+        psum_res = self.capacity_by_rp_rc[
+            (arr.resource_provider.id, arr.resource_class)]
+        if psum_res.used + amount > psum_res.capacity:
+            LOG.debug('Excluding the following AllocationRequest because '
+                      'used (%d) + amount (%d) > capacity (%d) for '
+                      'resource class %s: %s',
+                      psum_res.used, amount, psum_res.capacity,
+                      arr.resource_class, areq)
+        else:
+            LOG.debug('Excluding the following AllocationRequest because '
+                      'amount (%d) > max_unit (%d) for resource class '
+                      '%s: %s',
+                      amount, psum_res.max_unit, arr.resource_class, areq)
+
+
+def _reservoir_sample(iterable, k):
+    """Returns a list of a uniform random sample of k items from iterable (or
+    of all of its items, if there are no more than k) without holding more
+    than k items at a time.
+    """
+    sample = []
+    for i, item in enumerate(iterable):
+        if i < k:
+            sample.append(item)
+            continue
+        j = random.randint(0, i)
+        if j < k:
+            sample[j] = item
+    return sample
+
 
 @db_api.placement_context_manager.reader
 def provider_ids_from_uuid(context, uuid):
@@ -383,6 +509,9 @@ def provider_ids_from_uuid(context, uuid):
               provider identified by the supplied UUID
     :param uuid: The UUID of the provider to look up
     """
+    if context.provider_snapshot is not None:
+        return context.provider_snapshot.provider_ids_from_uuid(uuid)
+
     # SELECT
     #   rp.id, rp.uuid,
     #   parent.id AS parent_id, parent.uuid AS parent_uuid,
@@ -441,58 +570,80 @@ def _capacity_check_clause(amount, usage, inv_tbl=_INV_TBL):
 
 
 @db_api.placement_context_manager.reader
-def get_providers_with_resource(ctx, rc_id, amount, tree_root_id=None):
-    """Returns a set of tuples of (provider ID, root provider ID) of providers
-    that satisfy the request for a single resource class.
+def get_providers_with_resources(ctx, resources, tree_root_id=None):
+    """Returns a set of tuples of (provider ID, root provider ID, resource
+    class ID) of providers that satisfy the request for any of the supplied
+    resource classes. A provider appears once for each of the requested
+    resource classes it has capacity for.
 
     :param ctx: Session context to use
-    :param rc_id: Internal ID of resource class to check inventory for
-    :param amount: Amount of resource being requested
+    :param resources: A dict, keyed by internal ID of resource class, of the
+                      amount of that resource class being requested
     :param tree_root_id: An optional root provider ID. If provided, the results
                          are limited to the resource providers under the given
                          root resource provider.
     """
-    # SELECT rp.id, rp.root_provider_id
+    if ctx.provider_snapshot is not None:
+        return ctx.provider_snapshot.get_providers_with_resources(
+            resources, tree_root_id=tree_root_id)
+
+    # All of the requested resource classes are checked in one query over a
+    # single usage derived table, so allocations are aggregated once per
+    # request group rather than once per resource class.
+    #
+    # SELECT rp.id, rp.root_provider_id, inv.resource_class_id
     # FROM resource_providers AS rp
     # JOIN inventories AS inv
     #  ON rp.id = inv.resource_provider_id
-    #  AND inv.resource_class_id = $RC_ID
+    #  AND inv.resource_class_id IN ($RC_IDS)
     # LEFT JOIN (
     #  SELECT
     #    alloc.resource_provider_id,
+    #    alloc.resource_class_id,
     #    SUM(allocs.used) AS used
     #  FROM allocations AS alloc
-    #  WHERE allocs.resource_class_id = $RC_ID
-    #  GROUP BY allocs.resource_provider_id
+    #  WHERE allocs.resource_class_id IN ($RC_IDS)
+    #  GROUP BY allocs.resource_provider_id, allocs.resource_class_id
     # ) AS usage
     #  ON inv.resource_provider_id = usage.resource_provider_id
-    # WHERE
-    #  used + $AMOUNT <= ((total - reserved) * inv.allocation_ratio)
+    #  AND inv.resource_class_id = usage.resource_class_id
+    # WHERE (
+    #  # For each requested resource class
+    #  inv.resource_class_id = $RC_ID
+    #  AND used + $AMOUNT <= ((total - reserved) * inv.allocation_ratio)
     #  AND inv.min_unit <= $AMOUNT
     #  AND inv.max_unit >= $AMOUNT
     #  AND $AMOUNT % inv.step_size == 0
+    # ) OR ...
     #  # If tree_root_id specified:
     #  AND rp.root_provider_id == $tree_root_id
+    rc_ids = list(resources)
     rpt = sa.alias(_RP_TBL, name="rp")
     inv = sa.alias(_INV_TBL, name="inv")
-    usage = _usage_select([rc_id])
+    usage = _usage_select(rc_ids)
     rp_to_inv = sa.join(
         rpt, inv, sa.and_(
             rpt.c.id == inv.c.resource_provider_id,
-            inv.c.resource_class_id == rc_id))
+            inv.c.resource_class_id.in_(rc_ids)))
     inv_to_usage = sa.outerjoin(
-        rp_to_inv, usage,
-        inv.c.resource_provider_id == usage.c.resource_provider_id)
-    sel = sa.select(rpt.c.id, rpt.c.root_provider_id)
+        rp_to_inv, usage, sa.and_(
+            inv.c.resource_provider_id == usage.c.resource_provider_id,
+            inv.c.resource_class_id == usage.c.resource_class_id))
+    sel = sa.select(
+        rpt.c.id, rpt.c.root_provider_id, inv.c.resource_class_id)
     sel = sel.select_from(inv_to_usage)
-    where_conds = _capacity_check_clause(amount, usage, inv_tbl=inv)
+    where_conds = sa.or_(*[
+        sa.and_(
+            inv.c.resource_class_id == rc_id,
+            _capacity_check_clause(amount, usage, inv_tbl=inv))
+        for rc_id, amount in resources.items()])
     if tree_root_id is not None:
         where_conds = sa.and_(
             rpt.c.root_provider_id == tree_root_id,
             where_conds)
     sel = sel.where(where_conds)
     res = ctx.session.execute(sel).fetchall()
-    res = set((r[0], r[1]) for r in res)
+    res = set((r[0], r[1], r[2]) for r in res)
     return res
 
 
@@ -505,6 +656,10 @@ def get_providers_with_root(ctx, allowed, forbidden):
     :param allowed: resource provider ids to include
     :param forbidden: resource provider ids to exclude
     """
+    if ctx.provider_snapshot is not None:
+        return ctx.provider_snapshot.get_providers_with_root(
+            allowed, forbidden)
+
     # SELECT rp.id, rp.root_provider_id
     # FROM resource_providers AS rp
     # WHERE rp.id IN ($allowed)
@@ -670,11 +825,10 @@ def get_trees_matching_all(rg_ctx, rw_ctx):
             # There are sharing providers for this resource class, so we
             # should also get combinations of (sharing provider, anchor root)
             # in addition to (non-sharing provider, anchor root) we've just
-            # got via get_providers_with_resource() above. We must skip this
+            # got via get_providers_with_resources() above. We must skip this
             # process if tree_root_id is provided via the ?in_tree=<rp_uuid>
             # queryparam, because it restricts resources from another tree.
-            anchors = anchors_for_sharing_providers(
-                rg_ctx.context, sharing_providers)
+            anchors = rw_ctx.anchors_for_sharing_providers(sharing_providers)
             rc_provs_with_inv = set(
                 (anchor.rp_id, anchor.anchor_id) for anchor in anchors)
             provs_with_inv_rc.add_rps(rc_provs_with_inv, rc_id)
@@ -730,13 +884,25 @@ def get_trees_matching_all(rg_ctx, rw_ctx):
         if not provs_with_inv:
             return rp_candidates.RPCandidateList()
 
-    if (not rg_ctx.required_traits and not rg_ctx.forbidden_traits) or (
-            rg_ctx.exists_sharing):
+    if not rg_ctx.required_traits and not rg_ctx.forbidden_traits:
         # If there were no traits required, there's no difference in how we
         # calculate allocation requests between nested and non-nested
-        # environments, so just short-circuit and return. Or if sharing
-        # providers are in play, we check the trait constraints later
-        # in _alloc_candidates_multiple_providers(), so skip.
+        # environments, so just short-circuit and return.
+        return provs_with_inv
+
+    if rg_ctx.exists_sharing:
+        # If sharing providers are in play, the providers anchored to a tree
+        # are not all in the tree, so _get_trees_with_traits() can't be used.
+        # The trait constraints are checked for each combination of providers
+        # later in _alloc_candidates_multiple_providers(), but trees which
+        # can't possibly satisfy them are dropped here.
+        _filter_trees_by_traits(rg_ctx, provs_with_inv)
+        LOG.debug("found %d providers under %d trees after applying "
+                  "traits filter including sharing providers - required: "
+                  "%s, forbidden: %s",
+                  len(provs_with_inv.rps), len(provs_with_inv.trees),
+                  list(rg_ctx.required_trait_names),
+                  list(rg_ctx.forbidden_traits))
         return provs_with_inv
 
     # Return the providers where the providers have the available inventory
@@ -755,6 +921,82 @@ def get_trees_matching_all(rg_ctx, rw_ctx):
     return provs_with_inv
 
 
+def _filter_trees_by_traits(rg_ctx, provs_with_inv):
+    """Filters the supplied RPCandidateList, in which a "tree" includes the
+    sharing providers anchored to it, to the trees that can satisfy the trait
+    constraints of the request group.
+
+    Providers having any of the forbidden traits are dropped, then trees
+    whose remaining providers no longer have inventory for every requested
+    resource class, or don't collectively have all of the required traits,
+    are dropped. Whether a particular combination of the remaining providers
+    satisfies the constraints is still to be checked by the caller.
+
+    :param rg_ctx: RequestGroupSearchContext
+    :param provs_with_inv: RPCandidateList to filter in place
+    """
+    if not provs_with_inv:
+        return
+    forbidden = set(rg_ctx.forbidden_traits.values())
+    trait_ids = forbidden.union(*rg_ctx.required_traits)
+    trait_ids_by_rp = get_trait_ids_by_provider(
+        rg_ctx.context, provs_with_inv.rps, trait_ids)
+
+    # Represent the traits of each tree as the bits of an integer.
+    bit_by_trait = {}
+    for trait_id in trait_ids:
+        bit_by_trait[trait_id] = 1 << len(bit_by_trait)
+    required_masks = [
+        sum(bit_by_trait[trait_id] for trait_id in any_traits)
+        for any_traits in rg_ctx.required_traits]
+
+    mask_by_root = collections.defaultdict(int)
+    rcs_by_root = collections.defaultdict(set)
+    allowed = set()
+    for p in provs_with_inv.rp_candidates:
+        rp_trait_ids = trait_ids_by_rp.get(p.id, set())
+        if forbidden & rp_trait_ids:
+            continue
+        allowed.add(p)
+        rcs_by_root[p.root_id].add(p.rc_id)
+        for trait_id in rp_trait_ids:
+            mask_by_root[p.root_id] |= bit_by_trait[trait_id]
+
+    trees = set(
+        root_id for root_id, rc_ids in rcs_by_root.items()
+        if len(rc_ids) == len(rg_ctx.resources) and all(
+            mask_by_root[root_id] & required for required in required_masks))
+    provs_with_inv.rp_candidates = allowed
+    provs_with_inv.filter_by_tree(trees)
+
+
+@db_api.placement_context_manager.reader
+def get_trait_ids_by_provider(ctx, rp_ids, trait_ids):
+    """Returns a dict, keyed by resource provider internal ID, of sets of
+    the internal IDs of the traits among trait_ids that the provider has.
+    Providers having none of the traits are not included.
+
+    :param ctx: Session context to use
+    :param rp_ids: An iterable of internal resource provider IDs
+    :param trait_ids: An iterable of internal trait IDs
+    """
+    if ctx.provider_snapshot is not None:
+        return ctx.provider_snapshot.get_trait_ids_by_provider(
+            rp_ids, trait_ids)
+
+    rptt = sa.alias(_RP_TRAIT_TBL, name="rpt")
+    sel = sa.select(rptt.c.resource_provider_id, rptt.c.trait_id)
+    sel = sel.where(sa.and_(
+        rptt.c.resource_provider_id.in_(
+            sa.bindparam('rp_ids', expanding=True)),
+        rptt.c.trait_id.in_(sa.bindparam('trait_ids', expanding=True))))
+    res = collections.defaultdict(set)
+    for rp_id, trait_id in ctx.session.execute(
+            sel, {'rp_ids': list(rp_ids), 'trait_ids': list(trait_ids)}):
+        res[rp_id].add(trait_id)
+    return res
+
+
 @db_api.placement_context_manager.reader
 def _get_trees_with_traits(ctx, rp_ids, required_traits, forbidden_traits):
     """Given a list of provider IDs, filter them to return a set of tuples of
@@ -777,7 +1019,7 @@ def _get_trees_with_traits(ctx, rp_ids, required_traits, forbidden_traits):
     returns a tree even if some providers need to be ignored due to forbidden
     traits. So if those RPs are needed from resource perspective then the tree
     will be filtered out later by
-    objects.allocation_candidate._check_traits_for_alloc_request
+    objects.allocation_candidate._resource_request_combinations
 
     :param ctx: Session context to use
     :param rp_ids: a set of resource provider IDs
@@ -788,6 +1030,10 @@ def _get_trees_with_traits(ctx, rp_ids, required_traits, forbidden_traits):
     :param forbidden_traits: A list of trait internal IDs that a resource
         provider tree must not have.
     """
+    if ctx.provider_snapshot is not None:
+        return ctx.provider_snapshot._get_trees_with_traits(
+            rp_ids, required_traits, forbidden_traits)
+
     # TODO(gibi): if somebody can formulate the below three SQL query to a
     # single one then probably that will improve performance
 
@@ -897,6 +1143,10 @@ def _get_roots_with_traits(ctx, required_traits, forbidden_traits):
         raise ValueError("At least one of required_traits or forbidden_traits "
                          "is required.")
 
+    if ctx.provider_snapshot is not None:
+        return ctx.provider_snapshot._get_roots_with_traits(
+            required_traits, forbidden_traits)
+
     # The SQL we want looks like this:
     #
     #   SELECT rp.id FROM resource_providers AS rp
@@ -973,6 +1223,10 @@ def provider_ids_matching_aggregates(context, member_of, rp_ids=None):
     :returns: A set of internal resource provider IDs having all required
         aggregate associations
     """
+    if context.provider_snapshot is not None:
+        return context.provider_snapshot.provider_ids_matching_aggregates(
+            member_of, rp_ids=rp_ids)
+
     # Given a request for the following:
     #
     # member_of = [
@@ -1064,6 +1318,10 @@ def provider_ids_matching_required_traits(
     if not required_traits:
         raise ValueError('required_traits must not be empty')
 
+    if context.provider_snapshot is not None:
+        return context.provider_snapshot.provider_ids_matching_required_traits(
+            required_traits, rp_ids=rp_ids)
+
     # Given a request for the following:
     #
     # required = [
@@ -1119,6 +1377,9 @@ def get_provider_ids_having_any_trait(ctx, traits):
     if not traits:
         raise ValueError('traits must not be empty')
 
+    if ctx.provider_snapshot is not None:
+        return ctx.provider_snapshot.get_provider_ids_having_any_trait(traits)
+
     rptt = sa.alias(_RP_TRAIT_TBL, name="rpt")
     sel = sa.select(rptt.c.resource_provider_id)
     sel = sel.where(rptt.c.trait_id.in_(traits))
@@ -1231,6 +1492,9 @@ def get_sharing_providers(ctx, rp_ids=None):
     #     AND rpt.trait_id = ${"MISC_SHARES_VIA_AGGREGATE" trait id}
     # WHERE rp.id IN $(RP_IDs)
 
+    if ctx.provider_snapshot is not None:
+        return ctx.provider_snapshot.get_sharing_providers(rp_ids=rp_ids)
+
     sharing_trait = trait_obj.Trait.get_by_name(
         ctx, os_traits.MISC_SHARES_VIA_AGGREGATE)
 
@@ -1263,6 +1527,9 @@ def anchors_for_sharing_providers(context, rp_ids):
     If the sharing provider is not part of any aggregate, the empty list is
     returned.
     """
+    if context.provider_snapshot is not None:
+        return context.provider_snapshot.anchors_for_sharing_providers(rp_ids)
+
     # SELECT sps.id, sps.uuid, rps.id, rps.uuid)
     # FROM resource_providers AS sps
     # INNER JOIN resource_provider_aggregates AS shr_aggs
@@ -1306,6 +1573,9 @@ def _has_provider_trees(ctx):
 
     NOTE(jaypipes): The result of this function can be cached extensively.
     """
+    if ctx.provider_snapshot is not None:
+        return ctx.provider_snapshot.has_trees
+
     sel = sa.select(_RP_TBL.c.id)
     sel = sel.where(_RP_TBL.c.parent_provider_id.isnot(None))
     sel = sel.limit(1)
@@ -1313,10 +1583,97 @@ def _has_provider_trees(ctx):
     return len(res) > 0
 
 
-def get_usages_by_provider_trees(ctx, root_ids):
+def _get_topology_fact(ctx, name, func):
+    """Returns the result of func(ctx), reusing the result of an earlier call
+    made by any request in this process for up to
+    CONF.placement.provider_topology_cache_ttl seconds.
+
+    Requests answered from a provider snapshot always call func(ctx), which
+    then reads the snapshot rather than the database.
+    """
+    if ctx.provider_snapshot is not None:
+        return func(ctx)
+    ttl = ctx.config.placement.provider_topology_cache_ttl
+    cached = _TOPOLOGY.get(name)
+    if cached is not None and time.monotonic() - cached[1] < ttl:
+        return cached[0]
+    now = time.monotonic()
+    value = func(ctx)
+    if ttl:
+        _TOPOLOGY[name] = (value, now)
+    return value
+
+
+def clear_topology_cache():
+    """Forgets the deployment topology facts cached by has_provider_trees()
+    and get_all_sharing_providers().
+    """
+    _TOPOLOGY.clear()
+
+
+def clear_topology_cache_on_commit(ctx):
+    """Forgets the cached deployment topology facts now and again once the
+    writer transaction of ctx is committed. Otherwise a search running
+    concurrently could cache what it read before the commit for the whole
+    TTL. Called whenever this process creates a provider with a parent,
+    reparents a provider, or adds or removes the MISC_SHARES_VIA_AGGREGATE
+    trait of a provider.
+    """
+    clear_topology_cache()
+    db_api.call_after_commit(ctx, clear_topology_cache)
+
+
+def note_candidates_change(ctx):
+    """Makes get_candidates_changes() return a new value once the writer
+    transaction of ctx is committed. Called by every write to providers,
+    inventories, traits, aggregate associations or allocations which may
+    change the allocation candidates of some request.
+    """
+    info = ctx.session.info
+    if not info.get('candidates_change'):
+        info['candidates_change'] = True
+        db_api.call_after_commit(ctx, _count_candidates_change)
+
+
+def _count_candidates_change():
+    global _CANDIDATES_CHANGES
+    with lockutils.lock(_CANDIDATES_CHANGES_LOCK):
+        _CANDIDATES_CHANGES += 1
+
+
+def get_candidates_changes():
+    """Returns the number of writer transactions committed by this process
+    which may have changed the allocation candidates of some request.
+    """
+    return _CANDIDATES_CHANGES
+
+
+def has_provider_trees(ctx):
+    """Cached version of _has_provider_trees()."""
+    return _get_topology_fact(ctx, 'has_trees', _has_provider_trees)
+
+
+def get_all_sharing_providers(ctx):
+    """Cached version of get_sharing_providers() without rp_ids, returning a
+    frozenset so that callers cannot modify the cached value.
+    """
+    return _get_topology_fact(
+        ctx, 'sharing',
+        lambda ctx: frozenset(get_sharing_providers(ctx)))
+
+
+def get_usages_by_provider_trees(ctx, root_ids, rc_ids=None):
     """Returns a row iterator of usage records grouped by provider ID
     for all resource providers in all trees indicated in the ``root_ids``.
+
+    :param rc_ids: When present, only inventories of the resource classes with
+                   these internal IDs are returned, and providers without any
+                   such inventory are left out.
     """
+    if ctx.provider_snapshot is not None:
+        return ctx.provider_snapshot.get_usages_by_provider_trees(
+            root_ids, rc_ids=rc_ids)
+
     # We build up a SQL expression that looks like this:
     # SELECT
     #   rp.id as resource_provider_id
@@ -1357,13 +1714,23 @@ def get_usages_by_provider_trees(ctx, root_ids):
         _ALLOC_TBL.c.resource_provider_id,
         _ALLOC_TBL.c.resource_class_id,
         sql.func.sum(_ALLOC_TBL.c.used).label('used'),
-    ).select_from(derived_alloc_to_rp).group_by(
+    ).select_from(derived_alloc_to_rp)
+    if rc_ids is not None:
+        rc_ids = list(rc_ids)
+        usage = usage.where(_ALLOC_TBL.c.resource_class_id.in_(rc_ids))
+    usage = usage.group_by(
         _ALLOC_TBL.c.resource_provider_id,
         _ALLOC_TBL.c.resource_class_id
     ).subquery(name='usage')
     # Build a join between the resource providers and inventories table
-    rpt_inv_join = sa.outerjoin(rpt, inv,
-                                rpt.c.id == inv.c.resource_provider_id)
+    if rc_ids is None:
+        rpt_inv_join = sa.outerjoin(rpt, inv,
+                                    rpt.c.id == inv.c.resource_provider_id)
+    else:
+        rpt_inv_join = sa.join(
+            rpt, inv,
+            sa.and_(rpt.c.id == inv.c.resource_provider_id,
+                    inv.c.resource_class_id.in_(rc_ids)))
     # And then join to the derived table of usages
     usage_join = sa.outerjoin(
         rpt_inv_join,
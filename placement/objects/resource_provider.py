@@ -19,6 +19,7 @@ import copy
 # not be registered and there is no need to express VERSIONs nor handle
 # obj_make_compatible.
 
+import os_traits
 from oslo_db import api as oslo_db_api
 from oslo_db import exception as db_exc
 from oslo_log import log as logging
@@ -260,13 +261,13 @@ def _set_inventory(context, rp, inv_list):
     return exceeded
 
 
-@db_api.placement_context_manager.reader
-def _get_provider_by_uuid(context, uuid):
-    """Given a UUID, return a dict of information about the resource provider
-    from the database.
+def _provider_by_uuid_select(uuid_cond):
+    """Returns a select of the information about the resource providers
+    matching a condition on their UUIDs needed to build ResourceProvider
+    objects.
 
-    :raises: NotFound if no such provider was found
-    :param uuid: The UUID to look up
+    :param uuid_cond: A function returning the condition, given the UUID
+                      column of the resource providers.
     """
     rpt = sa.alias(_RP_TBL, name="rp")
     parent = sa.alias(_RP_TBL, name="parent")
@@ -275,7 +276,7 @@ def _get_provider_by_uuid(context, uuid):
     rp_to_parent = sa.outerjoin(
         rp_to_root, parent,
         rpt.c.parent_provider_id == parent.c.id)
-    sel = sa.select(
+    return sa.select(
         rpt.c.id,
         rpt.c.uuid,
         rpt.c.name,
@@ -284,7 +285,18 @@ def _get_provider_by_uuid(context, uuid):
         parent.c.uuid.label("parent_provider_uuid"),
         rpt.c.updated_at,
         rpt.c.created_at,
-    ).select_from(rp_to_parent).where(rpt.c.uuid == uuid)
+    ).select_from(rp_to_parent).where(uuid_cond(rpt.c.uuid))
+
+
+@db_api.placement_context_manager.reader
+def _get_provider_by_uuid(context, uuid):
+    """Given a UUID, return a dict of information about the resource provider
+    from the database.
+
+    :raises: NotFound if no such provider was found
+    :param uuid: The UUID to look up
+    """
+    sel = _provider_by_uuid_select(lambda col: col == uuid)
     res = context.session.execute(sel).fetchone()
     if not res:
         raise exception.NotFound(
@@ -292,6 +304,19 @@ def _get_provider_by_uuid(context, uuid):
     return dict(res._mapping)
 
 
+@db_api.placement_context_manager.reader
+def _get_providers_by_uuids(context, uuids):
+    """Given an iterable of UUIDs, return a list of dicts of information about
+    the resource providers with those UUIDs that exist in the database.
+
+    :param uuids: The UUIDs to look up
+    """
+    sel = _provider_by_uuid_select(
+        lambda col: col.in_(sa.bindparam('uuids', expanding=True)))
+    res = context.session.execute(sel, {'uuids': list(uuids)})
+    return [dict(r._mapping) for r in res]
+
+
 @db_api.placement_context_manager.reader
 def _get_aggregates_by_provider_id(context, rp_id):
     """Returns a dict, keyed by internal aggregate ID, of aggregate UUIDs
@@ -346,6 +371,7 @@ def _ensure_aggregate(ctx, agg_uuid):
 def _set_aggregates(context, resource_provider, provided_aggregates,
                     increment_generation=False):
     rp_id = resource_provider.id
+    res_ctx.note_candidates_change(context)
     # When aggregate uuids are persisted no validation is done
     # to ensure that they refer to something that has meaning
     # elsewhere. It is assumed that code which makes use of the
@@ -477,6 +503,11 @@ def _set_traits(context, rp, traits):
         _add_traits_to_provider(context, rp.id, to_add)
     rp.increment_generation()
 
+    sharing_trait_id = context.trait_cache.id_from_string(
+        os_traits.MISC_SHARES_VIA_AGGREGATE)
+    if sharing_trait_id in to_add | to_delete:
+        res_ctx.clear_topology_cache_on_commit(context)
+
 
 @db_api.placement_context_manager.reader
 def _has_child_providers(context, rp_id):
@@ -686,6 +717,7 @@ class ResourceProvider(object):
         if res.rowcount != 1:
             raise exception.ResourceProviderConcurrentUpdateDetected()
         self.generation = new_generation
+        res_ctx.note_candidates_change(self._context)
 
     @db_api.placement_context_manager.writer
     def _create_in_db(self, context, updates):
@@ -713,6 +745,7 @@ class ResourceProvider(object):
             updates['root_provider_id'] = root_id
             updates['parent_provider_id'] = parent_id
             self.root_provider_uuid = parent_ids.root_uuid
+            res_ctx.clear_topology_cache_on_commit(context)
 
         db_rp = models.ResourceProvider()
         db_rp.update(updates)
@@ -747,6 +780,7 @@ class ResourceProvider(object):
             models.Allocation.resource_provider_id == _id).count()
         if rp_allocations:
             raise exception.ResourceProviderInUse()
+        res_ctx.note_candidates_change(context)
         # Delete any inventory associated with the resource provider
         query = context.session.query(models.Inventory)
         query = query.filter(models.Inventory.resource_provider_id == _id)
@@ -786,6 +820,7 @@ class ResourceProvider(object):
         new_root_id = None
         new_root_uuid = None
         if 'parent_provider_uuid' in updates:
+            res_ctx.note_candidates_change(context)
             my_ids = res_ctx.provider_ids_from_uuid(context, self.uuid)
             parent_uuid = updates.pop('parent_provider_uuid')
             if parent_uuid is not None:
@@ -826,6 +861,7 @@ class ResourceProvider(object):
                 self.root_provider_uuid = parent_ids.root_uuid
                 new_root_id = parent_ids.root_id
                 new_root_uuid = parent_ids.root_uuid
+                res_ctx.clear_topology_cache_on_commit(context)
             else:
                 if my_ids.parent_id is not None:
                     if not allow_reparenting:
@@ -845,6 +881,7 @@ class ResourceProvider(object):
                     self.root_provider_uuid = my_ids.uuid
                     new_root_id = my_ids.id
                     new_root_uuid = my_ids.uuid
+                    res_ctx.clear_topology_cache_on_commit(context)
 
         db_rp = context.session.query(models.ResourceProvider).filter_by(
             id=id).first()
@@ -1014,16 +1051,66 @@ def _get_all_by_filters_from_db(context, filters):
             context, [forbidden_aggs])
         if rps_bad_aggs:
             query = query.where(~rp.c.id.in_(rps_bad_aggs))
-    for rc_name, amount in resources.items():
-        rc_id = context.rc_cache.id_from_string(rc_name)
-        rps_with_resource = res_ctx.get_providers_with_resource(
-            context, rc_id, amount)
-        rps_with_resource = (rp[0] for rp in rps_with_resource)
-        query = query.where(rp.c.id.in_(rps_with_resource))
+    if resources:
+        rc_amounts = {
+            context.rc_cache.id_from_string(rc_name): amount
+            for rc_name, amount in resources.items()}
+        provs_with_resources = res_ctx.get_providers_with_resources(
+            context, rc_amounts)
+        # Only providers with capacity for every requested resource class
+        # qualify.
+        rps_by_rc = collections.defaultdict(set)
+        for rp_id, _root_id, rc_id in provs_with_resources:
+            rps_by_rc[rc_id].add(rp_id)
+        rps_with_resources = set.intersection(
+            *[rps_by_rc[rc_id] for rc_id in rc_amounts])
+        if not rps_with_resources:
+            return []
+        query = query.where(rp.c.id.in_(rps_with_resources))
 
     return context.session.execute(query).fetchall()
 
 
+def increment_generations(context, rps):
+    """Increments the generations of the supplied providers with a single
+    statement, supplying their currently-known generations.
+
+    Must be called from within a placement_context_manager.writer context.
+
+    :param context: `placement.context.RequestContext` that may be used to
+        grab a DB connection.
+    :param rps: An iterable of distinct `ResourceProvider` objects.
+    :raises placement.exception.ResourceProviderConcurrentUpdateDetected: if
+        another thread updated any of the providers in between the time when
+        its object was originally read and this call.
+    """
+    db_api.increment_generations(
+        context, _RP_TBL, rps,
+        exception.ResourceProviderConcurrentUpdateDetected)
+    res_ctx.note_candidates_change(context)
+
+
+def get_all_by_uuids(context, uuids):
+    """Returns the `ResourceProvider` objects with the supplied UUIDs, all
+    fetched with a single query.
+
+    :param context: `placement.context.RequestContext` that may be used to
+        grab a DB connection.
+    :param uuids: An iterable of resource provider UUIDs.
+    :return: A tuple of a dict, keyed by UUID, of `ResourceProvider` objects,
+        and of a set of the supplied UUIDs for which no resource provider
+        exists.
+    """
+    uuids = set(uuids)
+    if not uuids:
+        return {}, set()
+    rps = {}
+    for rp_rec in _get_providers_by_uuids(context, uuids):
+        rps[rp_rec['uuid']] = ResourceProvider._from_db_object(
+            context, ResourceProvider(context), rp_rec)
+    return rps, uuids - set(rps)
+
+
 def get_all_by_filters(context, filters=None):
     """Returns a list of `ResourceProvider` objects that have sufficient
     resources in their inventories to satisfy the amounts specified in the
@@ -0,0 +1,393 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Per request profiling of the phases of an allocation candidates search.
+
+A SearchProfile records, for each phase of a search, the wall clock time
+spent, the number of SQL statements executed and the number of rows (results)
+produced. Time and statements are attributed to the innermost phase running,
+so the phases of lazily evaluated pipelines, whose work is interleaved, are
+still told apart. Completed profiles are added to a process wide histogram
+of the searches of the last
+CONF.placement.allocation_candidates_profiling_report_interval seconds, which
+summary() returns and which is logged once per interval.
+"""
+
+import collections
+import threading
+import time
+
+from oslo_concurrency import lockutils
+from oslo_log import log as logging
+import sqlalchemy as sa
+
+LOG = logging.getLogger(__name__)
+
+_WINDOW_LOCK = 'search_profile_window'
+_LISTEN_LOCK = 'search_profile_listen'
+
+# The upper bounds, in milliseconds, of the buckets of the histogram. The
+# last bucket holds everything slower.
+_BUCKET_BOUNDS = tuple(2 ** x for x in range(-2, 15))
+# The number of slots the rolling window is divided in. The oldest slot is
+# dropped as a whole, so the window spans between one and 1 + 1 / _SLOTS
+# report intervals.
+_SLOTS = 10
+
+# The SearchProfile of the search running in this thread, if any.
+_ACTIVE = threading.local()
+_LISTENING = False
+
+# The _Window of the profiles recorded by this process in the last report
+# interval.
+_WINDOW = None
+
+
+class PhaseStats(object):
+    """The time, SQL statements and rows of one phase of a search."""
+
+    __slots__ = ('seconds', 'queries', 'rows')
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.queries = 0
+        self.rows = 0
+
+
+class _NullPhase(object):
+    """Stands in for a phase when the search is not profiled."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    @property
+    def rows(self):
+        return 0
+
+    @rows.setter
+    def rows(self, value):
+        pass
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class _Phase(object):
+
+    __slots__ = ('profile', 'name')
+
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        return self.profile._enter(self.name)
+
+    def __exit__(self, *exc_info):
+        self.profile._exit()
+        return False
+
+
+class _Track(object):
+    """The phases entered by one thread."""
+
+    __slots__ = ('phases', 'stack', 'started')
+
+    def __init__(self):
+        # An OrderedDict, keyed by phase name, of PhaseStats, in the order
+        # the phases were first entered.
+        self.phases = collections.OrderedDict()
+        self.stack = []
+        self.started = None
+
+
+class SearchProfile(object):
+    """The phases of one allocation candidates search.
+
+    Each thread taking part in the search records its phases separately, and
+    the phases of all of them are added up. The time of a phase run by
+    several threads at once is therefore the sum of the times of the threads.
+    """
+
+    def __init__(self):
+        _listen_once()
+        self._local = threading.local()
+        self._tracks = []
+        self._track()
+
+    def _track(self):
+        track = getattr(self._local, 'track', None)
+        if track is None:
+            track = self._local.track = _Track()
+            self._tracks.append(track)
+        return track
+
+    @property
+    def phases(self):
+        """An OrderedDict, keyed by phase name, of PhaseStats, in the order
+        the phases were first entered.
+        """
+        if len(self._tracks) == 1:
+            return self._tracks[0].phases
+        phases = collections.OrderedDict()
+        for track in list(self._tracks):
+            for name, stats in track.phases.items():
+                total = phases.get(name)
+                if total is None:
+                    total = phases[name] = PhaseStats()
+                total.seconds += stats.seconds
+                total.queries += stats.queries
+                total.rows += stats.rows
+        return phases
+
+    def phase(self, name):
+        """Returns a context manager running the named phase. Entering it
+        returns the PhaseStats of the phase, the rows of which the caller may
+        increase.
+        """
+        return _Phase(self, name)
+
+    def _enter(self, name):
+        now = time.monotonic()
+        track = self._track()
+        if track.stack:
+            track.stack[-1].seconds += now - track.started
+        else:
+            _ACTIVE.profile = self
+        stats = track.phases.get(name)
+        if stats is None:
+            stats = track.phases[name] = PhaseStats()
+        track.stack.append(stats)
+        track.started = now
+        return stats
+
+    def _exit(self):
+        now = time.monotonic()
+        track = self._local.track
+        track.stack.pop().seconds += now - track.started
+        track.started = now
+        if not track.stack:
+            _ACTIVE.profile = None
+
+    def _count_query(self):
+        stack = self._local.track.stack
+        if stack:
+            stack[-1].queries += 1
+
+    def server_timing(self):
+        """Returns the phases as the value of a Server-Timing header."""
+        return ', '.join(
+            '%s;dur=%.3f;desc="queries=%d rows=%d"' % (
+                name, stats.seconds * 1000, stats.queries, stats.rows)
+            for name, stats in self.phases.items())
+
+
+class _Histogram(object):
+    """The distribution of the time spent in each phase by the profiles
+    recorded since started_at.
+    """
+
+    def __init__(self, started_at):
+        self.started_at = started_at
+        self.searches = 0
+        # A dict, keyed by phase name, of lists of the number of times the
+        # phase fell in each bucket.
+        self.buckets = {}
+        # A dict, keyed by phase name, of the total number of SQL statements
+        # the phase executed.
+        self.queries = collections.Counter()
+
+    def add(self, profile):
+        self.searches += 1
+        for name, stats in profile.phases.items():
+            counts = self.buckets.get(name)
+            if counts is None:
+                counts = self.buckets[name] = [0] * (len(_BUCKET_BOUNDS) + 1)
+            counts[_bucket(stats.seconds * 1000)] += 1
+            self.queries[name] += stats.queries
+
+    def merge(self, other):
+        self.searches += other.searches
+        for name, counts in other.buckets.items():
+            total = self.buckets.get(name)
+            if total is None:
+                self.buckets[name] = list(counts)
+            else:
+                for idx, count in enumerate(counts):
+                    total[idx] += count
+        self.queries.update(other.queries)
+
+
+class _Window(object):
+    """The histograms of the profiles recorded in the last interval seconds,
+    one per slot of interval / _SLOTS seconds, so that the oldest profiles
+    drop out as time passes.
+    """
+
+    def __init__(self, interval, now):
+        self.interval = interval
+        self.reported_at = now
+        self.slots = collections.deque()
+
+    def _expire(self, now):
+        slot_length = self.interval / _SLOTS
+        while (self.slots and
+               now - self.slots[0].started_at >= self.interval + slot_length):
+            self.slots.popleft()
+        return slot_length
+
+    def add(self, profile, now):
+        slot_length = self._expire(now)
+        if not self.slots or now - self.slots[-1].started_at >= slot_length:
+            self.slots.append(_Histogram(now))
+        self.slots[-1].add(profile)
+
+    def histogram(self, now):
+        self._expire(now)
+        total = _Histogram(self.slots[0].started_at if self.slots else now)
+        for slot in self.slots:
+            total.merge(slot)
+        return total
+
+
+def _bucket(milliseconds):
+    for idx, bound in enumerate(_BUCKET_BOUNDS):
+        if milliseconds <= bound:
+            return idx
+    return len(_BUCKET_BOUNDS)
+
+
+def _percentile(counts, fraction):
+    """Returns the upper bound of the bucket holding the given fraction of
+    the counts, or 'inf' for the last bucket.
+    """
+    wanted = fraction * sum(counts)
+    seen = 0
+    for idx, count in enumerate(counts):
+        seen += count
+        if count and seen >= wanted:
+            break
+    if idx < len(_BUCKET_BOUNDS):
+        return _BUCKET_BOUNDS[idx]
+    return 'inf'
+
+
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    profile = getattr(_ACTIVE, 'profile', None)
+    if profile is not None:
+        profile._count_query()
+
+
+def _listen_once():
+    global _LISTENING
+    if _LISTENING:
+        return
+    with lockutils.lock(_LISTEN_LOCK):
+        if not _LISTENING:
+            sa.event.listen(sa.engine.Engine, 'after_cursor_execute',
+                            _count_query)
+            _LISTENING = True
+
+
+def phase(ctx, name):
+    """Returns a context manager running the named phase of the search
+    profiled by ctx, or one that does nothing if the search isn't profiled.
+    """
+    if ctx.search_profile is None:
+        return _NULL_PHASE
+    return ctx.search_profile.phase(name)
+
+
+def iterate(ctx, name, iterable):
+    """Returns an iterator over iterable which runs the named phase of the
+    search profiled by ctx, if any, whenever the next item is produced. Each
+    item counts as a row.
+    """
+    profile = ctx.search_profile
+    if profile is None:
+        return iterable
+    return _iterate(profile, name, iterable)
+
+
+def _iterate(profile, name, iterable):
+    iterator = iter(iterable)
+    while True:
+        stats = profile._enter(name)
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            profile._exit()
+        stats.rows += 1
+        yield item
+
+
+def record(ctx, profile):
+    """Adds a completed profile to the rolling histogram of this process,
+    and logs the summary of the histogram once per report interval.
+    """
+    global _WINDOW
+    conf = ctx.config.placement
+    interval = conf.allocation_candidates_profiling_report_interval
+    if not interval:
+        return
+    now = time.monotonic()
+    with lockutils.lock(_WINDOW_LOCK):
+        if _WINDOW is None or _WINDOW.interval != interval:
+            _WINDOW = _Window(interval, now)
+        _WINDOW.add(profile, now)
+        if now - _WINDOW.reported_at < interval:
+            return
+        _WINDOW.reported_at = now
+        histogram = _WINDOW.histogram(now)
+    searches, phases = _summarize(histogram)
+    LOG.info('Profiled %d allocation candidates searches in the last '
+             '%d seconds', searches, now - histogram.started_at)
+    for name, phase_summary in sorted(phases.items()):
+        LOG.info('Allocation candidates phase %(name)s: count=%(count)d '
+                 'p50<=%(p50)s p90<=%(p90)s p99<=%(p99)s max<=%(max)s '
+                 '(ms), queries/search=%(queries).1f',
+                 dict(phase_summary, name=name))
+
+
+def summary():
+    """Returns a tuple of the number of searches profiled by this process in
+    the last report interval, and of a dict, keyed by phase name, of dicts
+    of the number of searches having run the phase, of the upper bounds in
+    milliseconds of the 'p50', 'p90', 'p99' and 'max' percentiles of its
+    time, and of the average number of SQL 'queries' it executed.
+    """
+    with lockutils.lock(_WINDOW_LOCK):
+        if _WINDOW is None:
+            return 0, {}
+        histogram = _WINDOW.histogram(time.monotonic())
+    return _summarize(histogram)
+
+
+def _summarize(histogram):
+    phases = {}
+    for name, counts in histogram.buckets.items():
+        total = sum(counts)
+        phases[name] = {
+            'count': total,
+            'p50': _percentile(counts, 0.5),
+            'p90': _percentile(counts, 0.9),
+            'p99': _percentile(counts, 0.99),
+            'max': _percentile(counts, 1.0),
+            'queries': histogram.queries[name] / total,
+        }
+    return histogram.searches, phases
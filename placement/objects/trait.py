@@ -195,6 +195,10 @@ def get_traits_by_provider_tree(ctx, root_ids):
         raise ValueError("Expected root_ids to be a list of root resource "
                          "provider internal IDs, but got an empty list.")
 
+    if ctx.provider_snapshot is not None:
+        return ctx.provider_snapshot.get_traits_by_provider_tree(
+            ctx, root_ids)
+
     rpt = sa.alias(_RP_TBL, name='rpt')
     rptt = sa.alias(_RP_TRAIT_TBL, name='rptt')
     rpt_rptt = sa.join(rpt, rptt, rpt.c.id == rptt.c.resource_provider_id)
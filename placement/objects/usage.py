@@ -18,6 +18,8 @@ from sqlalchemy import sql
 from placement.db.sqlalchemy import models
 from placement import db_api
 from placement.objects import consumer_type as consumer_type_obj
+from placement.objects import project as project_obj
+from placement.objects import user as user_obj
 
 
 class Usage(object):
@@ -72,6 +74,21 @@ def _get_all_by_resource_provider_uuid(context, rp_uuid):
     return result
 
 
+def _get_owner_ids(context, project_id, user_id):
+    """Returns a tuple of the internal ids of the project and (optional) user
+    with the supplied external ids, or None if either does not exist.
+    """
+    proj_id = project_obj.get_id_by_external_id(context, project_id)
+    if proj_id is None:
+        return None
+    usr_id = None
+    if user_id:
+        usr_id = user_obj.get_id_by_external_id(context, user_id)
+        if usr_id is None:
+            return None
+    return proj_id, usr_id
+
+
 @db_api.placement_context_manager.reader
 def _get_all_by_project_user(context, project_id, user_id=None,
                              consumer_type=None):
@@ -90,17 +107,18 @@ def _get_all_by_project_user(context, project_id, user_id=None,
                           specified, all results will be grouped under one key,
                           "unknown".
     """
+    owner_ids = _get_owner_ids(context, project_id, user_id)
+    if owner_ids is None:
+        return []
+    proj_id, usr_id = owner_ids
+
     query = (context.session.query(models.Allocation.resource_class_id,
              func.coalesce(func.sum(models.Allocation.used), 0))
              .join(models.Consumer,
                    models.Allocation.consumer_id == models.Consumer.uuid)
-             .join(models.Project,
-                   models.Consumer.project_id == models.Project.id)
-             .filter(models.Project.external_id == project_id))
+             .filter(models.Consumer.project_id == proj_id))
     if user_id:
-        query = query.join(models.User,
-                           models.Consumer.user_id == models.User.id)
-        query = query.filter(models.User.external_id == user_id)
+        query = query.filter(models.Consumer.user_id == usr_id)
     query = query.group_by(models.Allocation.resource_class_id)
 
     if consumer_type in ('all', 'unknown'):
@@ -114,14 +132,10 @@ def _get_all_by_project_user(context, project_id, user_id=None,
             func.count(distinct(models.Allocation.consumer_id)))
             .join(models.Consumer,
                   models.Allocation.consumer_id == models.Consumer.uuid)
-            .join(models.Project,
-                  models.Consumer.project_id == models.Project.id)
-            .filter(models.Project.external_id == project_id))
+            .filter(models.Consumer.project_id == proj_id))
         if user_id:
-            count_query = count_query.join(
-                models.User, models.Consumer.user_id == models.User.id)
             count_query = count_query.filter(
-                models.User.external_id == user_id)
+                models.Consumer.user_id == usr_id)
         if consumer_type == 'unknown':
             count_query = count_query.filter(
                 models.Consumer.consumer_type_id == sa.null())
@@ -151,6 +165,11 @@ def _get_by_consumer_type(context, project_id, user_id=None,
         return _get_all_by_project_user(context, project_id, user_id,
                                         consumer_type=consumer_type)
 
+    owner_ids = _get_owner_ids(context, project_id, user_id)
+    if owner_ids is None:
+        return []
+    proj_id, usr_id = owner_ids
+
     query = (context.session.query(
              models.Allocation.resource_class_id,
              func.coalesce(func.sum(models.Allocation.used), 0),
@@ -161,13 +180,9 @@ def _get_by_consumer_type(context, project_id, user_id=None,
              .outerjoin(models.ConsumerType,
                         models.Consumer.consumer_type_id ==
                         models.ConsumerType.id)
-             .join(models.Project,
-                   models.Consumer.project_id == models.Project.id)
-             .filter(models.Project.external_id == project_id))
+             .filter(models.Consumer.project_id == proj_id))
     if user_id:
-        query = query.join(models.User,
-                           models.Consumer.user_id == models.User.id)
-        query = query.filter(models.User.external_id == user_id)
+        query = query.filter(models.Consumer.user_id == usr_id)
     if consumer_type:
         query = query.filter(models.ConsumerType.name == consumer_type)
     # NOTE(melwitt): We have to count grouped by only consumer type first in
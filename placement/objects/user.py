@@ -13,12 +13,17 @@
 from oslo_db import exception as db_exc
 import sqlalchemy as sa
 
+from placement import attribute_cache
 from placement.db.sqlalchemy import models
 from placement import db_api
 from placement import exception
 
 USER_TBL = models.User.__table__
 
+# The internal ids, by external id, of the users recently used by this
+# process
+ID_CACHE = attribute_cache.ExternalIdCache('users')
+
 
 @db_api.placement_context_manager.writer
 def ensure_incomplete_user(ctx):
@@ -56,6 +61,84 @@ def _get_user_by_external_id(ctx, external_id):
     return dict(res._mapping)
 
 
+@db_api.placement_context_manager.reader
+def _get_users_by_external_ids(ctx, external_ids):
+    sel = sa.select(
+        USER_TBL.c.id,
+        USER_TBL.c.external_id,
+        USER_TBL.c.updated_at,
+        USER_TBL.c.created_at,
+    )
+    sel = sel.where(USER_TBL.c.external_id.in_(external_ids))
+    return [dict(r._mapping) for r in ctx.session.execute(sel)]
+
+
+@db_api.placement_context_manager.writer
+def _create_users_in_db(ctx, external_ids):
+    ins = USER_TBL.insert()
+    try:
+        ctx.session.execute(
+            ins, [{'external_id': ext_id} for ext_id in external_ids])
+    except db_exc.DBDuplicateEntry:
+        raise exception.UserExists(external_id=', '.join(sorted(external_ids)))
+
+
+def get_id_by_external_id(ctx, external_id):
+    """Returns the internal id of the user with the supplied external id, or
+    None if there is no such user, looking it up only if it is not in
+    ID_CACHE.
+    """
+    internal_id = ID_CACHE.get(external_id)
+    if internal_id is None:
+        try:
+            internal_id = User.get_by_external_id(ctx, external_id).id
+        except exception.UserNotFound:
+            pass
+    return internal_id
+
+
+def get_or_create_all_by_external_ids(ctx, external_ids):
+    """Returns a dict, keyed by external ID, of User objects for the
+    supplied external IDs, creating records for the ones that do not exist
+    with a single INSERT. The users whose internal id is in ID_CACHE are not
+    looked up, and their objects have no timestamps.
+
+    :param ctx: The request context.
+    :param external_ids: An iterable of external IDs of users.
+    """
+    external_ids = set(external_ids)
+
+    def _load(ext_ids):
+        loaded = {}
+        if ext_ids:
+            for res in _get_users_by_external_ids(ctx, list(ext_ids)):
+                loaded[res['external_id']] = User._from_db_object(
+                    ctx, User(ctx), res)
+                ID_CACHE.set(ctx, res['external_id'], res['id'])
+        return loaded
+
+    users = {}
+    for ext_id in external_ids:
+        internal_id = ID_CACHE.get(ext_id)
+        if internal_id is not None:
+            users[ext_id] = User(ctx, id=internal_id, external_id=ext_id)
+    users.update(_load(external_ids - set(users)))
+    missing = external_ids - set(users)
+    if missing:
+        try:
+            _create_users_in_db(ctx, sorted(missing))
+        except exception.UserExists:
+            # Another thread created some of these users already, so
+            # create the others one at a time
+            for ext_id in missing:
+                try:
+                    User(ctx, external_id=ext_id).create()
+                except exception.UserExists:
+                    pass
+        users.update(_load(missing))
+    return users
+
+
 class User(object):
 
     def __init__(self, context, id=None, external_id=None, updated_at=None,
@@ -78,6 +161,7 @@ class User(object):
     @classmethod
     def get_by_external_id(cls, ctx, external_id):
         res = _get_user_by_external_id(ctx, external_id)
+        ID_CACHE.set(ctx, external_id, res['id'])
         return cls._from_db_object(ctx, cls(ctx), res)
 
     def create(self):
@@ -90,3 +174,4 @@ class User(object):
                 raise exception.UserExists(external_id=self.external_id)
             self._from_db_object(ctx, self, db_obj)
         _create_in_db(self._context)
+        ID_CACHE.set(self._context, self.external_id, self.id)
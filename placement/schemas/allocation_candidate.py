@@ -102,3 +102,12 @@ GET_SCHEMA_1_36 = copy.deepcopy(GET_SCHEMA_1_35)
 GET_SCHEMA_1_36["properties"]['same_subtree'] = {
     "type": ["string"]
 }
+
+# Microversion 1.40 supports sort, optionally weighting resource classes.
+_SORT_WEIGHT_PAT = "[A-Z0-9_]+=[0-9]+(\\.[0-9]+)?"
+GET_SCHEMA_1_40 = copy.deepcopy(GET_SCHEMA_1_36)
+GET_SCHEMA_1_40["properties"]['sort'] = {
+    "type": "string",
+    "pattern": "^(pack|spread)(:%s(,%s)*)?$" % (
+        _SORT_WEIGHT_PAT, _SORT_WEIGHT_PAT),
+}
@@ -20,11 +20,18 @@
 from oslo_config import cfg
 from oslo_db.sqlalchemy import test_fixtures
 
+from placement import attribute_cache
 from placement.db.sqlalchemy import migration
 from placement import db_api as placement_db
 from placement import deploy
+from placement.objects import allocation_candidate as ac_obj
+from placement.objects import project as project_obj
+from placement.objects import provider_snapshot
+from placement.objects import research_context as res_ctx
 from placement.objects import resource_class
+from placement.objects import search_profile
 from placement.objects import trait
+from placement.objects import user as user_obj
 
 
 class Database(test_fixtures.GeneratesSchema, test_fixtures.AdHocDbFixture):
@@ -75,3 +82,12 @@ class Database(test_fixtures.GeneratesSchema, test_fixtures.AdHocDbFixture):
     def cleanup(self):
         trait._TRAITS_SYNCED = False
         resource_class._RESOURCE_CLASSES_SYNCED = False
+        provider_snapshot._SNAPSHOT = None
+        attribute_cache._SHARED_CACHES.clear()
+        attribute_cache._NOT_FOUND_CACHES.clear()
+        res_ctx._TOPOLOGY.clear()
+        search_profile._WINDOW = None
+        ac_obj.shutdown_group_executor()
+        ac_obj._CACHE.clear()
+        project_obj.ID_CACHE.clear()
+        user_obj.ID_CACHE.clear()
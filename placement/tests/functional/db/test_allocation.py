@@ -20,6 +20,7 @@ from placement.objects import allocation as alloc_obj
 from placement.objects import consumer as consumer_obj
 from placement.objects import consumer_type as ct_obj
 from placement.objects import inventory as inv_obj
+from placement.objects import resource_provider as rp_obj
 from placement.objects import usage as usage_obj
 from placement.tests.functional.db import test_base as tb
 
@@ -72,6 +73,95 @@ class TestAllocation(tb.PlacementDbBaseTestCase):
         allocs = alloc_obj.get_all_by_resource_provider(self.ctx, cn1)
         self.assertEqual(0, len(allocs))
 
+    def test_replace_all_multiple_consumers(self):
+        cn1 = self._create_provider('cn1')
+        tb.add_inventory(cn1, 'VCPU', 8)
+        tb.add_inventory(cn1, 'MEMORY_MB', 1024)
+        cn2 = self._create_provider('cn2')
+        tb.add_inventory(cn2, 'VCPU', 8)
+        bystander = self.allocate_from_provider(cn1, 'VCPU', 1)[0]
+        c1, c2 = (
+            tb.ensure_consumer(self.ctx, self.user_obj, self.project_obj)
+            for _ in range(2))
+        self.allocate_from_provider(cn2, 'VCPU', 4, consumer=c1)
+
+        allocs = [
+            alloc_obj.Allocation(
+                resource_provider=cn1, resource_class='VCPU', consumer=c1,
+                used=2),
+            alloc_obj.Allocation(
+                resource_provider=cn1, resource_class='MEMORY_MB',
+                consumer=c1, used=512),
+            alloc_obj.Allocation(
+                resource_provider=cn2, resource_class='VCPU', consumer=c2,
+                used=3),
+        ]
+        alloc_obj.replace_all(self.ctx, allocs)
+
+        # The previous allocations of the consumers are replaced, those of
+        # other consumers are left alone, and the new allocations get the
+        # ids of their records.
+        written = dict(
+            ((a.consumer.uuid, a.resource_provider.uuid, a.resource_class),
+             (a.id, a.used))
+            for rp in (cn1, cn2)
+            for a in alloc_obj.get_all_by_resource_provider(self.ctx, rp))
+        self.assertEqual({
+            (bystander.consumer.uuid, cn1.uuid, 'VCPU'): (bystander.id, 1),
+            (c1.uuid, cn1.uuid, 'VCPU'): (allocs[0].id, 2),
+            (c1.uuid, cn1.uuid, 'MEMORY_MB'): (allocs[1].id, 512),
+            (c2.uuid, cn2.uuid, 'VCPU'): (allocs[2].id, 3),
+        }, written)
+        self.assertEqual(4, len(set(a_id for a_id, _used in written.values())))
+
+    def test_replace_all_generation_conflicts(self):
+        cn1 = self._create_provider('cn1')
+        tb.add_inventory(cn1, 'VCPU', 8)
+        cn2 = self._create_provider('cn2')
+        tb.add_inventory(cn2, 'VCPU', 8)
+        c1, c2 = (
+            tb.ensure_consumer(self.ctx, self.user_obj, self.project_obj)
+            for _ in range(2))
+
+        def allocs(cn1, cn2, c2):
+            return [
+                alloc_obj.Allocation(
+                    resource_provider=cn1, resource_class='VCPU',
+                    consumer=c1, used=1),
+                alloc_obj.Allocation(
+                    resource_provider=cn2, resource_class='VCPU',
+                    consumer=c2, used=1),
+            ]
+
+        cn1_gen, cn2_gen = cn1.generation, cn2.generation
+        alloc_obj.replace_all(self.ctx, allocs(cn1, cn2, c2))
+        self.assertEqual(cn1_gen + 1, cn1.generation)
+        self.assertEqual(cn2_gen + 1, cn2.generation)
+        self.assertEqual(1, c1.generation)
+        self.assertEqual(1, c2.generation)
+
+        # A stale provider fails the whole write, without retries.
+        self.conf_fixture.config(allocation_conflict_retry_count=1,
+                                 group='placement')
+        stale_cn2 = rp_obj.ResourceProvider.get_by_uuid(self.ctx, cn2.uuid)
+        stale_cn2.generation -= 1
+        self.assertRaises(
+            exception.ResourceProviderConcurrentUpdateDetected,
+            alloc_obj.replace_all, self.ctx, allocs(cn1, stale_cn2, c2))
+        self.assertEqual(
+            cn1_gen + 1,
+            rp_obj.ResourceProvider.get_by_uuid(self.ctx, cn1.uuid).generation)
+
+        # So does a stale consumer.
+        stale_c2 = consumer_obj.Consumer.get_by_uuid(self.ctx, c2.uuid)
+        stale_c2.generation -= 1
+        self.assertRaises(
+            exception.ConcurrentUpdateDetected,
+            alloc_obj.replace_all, self.ctx, allocs(cn1, cn2, stale_c2))
+        self.assertEqual(
+            cn1_gen + 1,
+            rp_obj.ResourceProvider.get_by_uuid(self.ctx, cn1.uuid).generation)
+
     def test_multi_provider_allocation(self):
         """Tests that an allocation that includes more than one resource
         provider can be created, listed and deleted properly.
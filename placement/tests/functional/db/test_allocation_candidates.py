@@ -11,18 +11,30 @@
 #    under the License.
 
 import collections
+from concurrent import futures
+import os
+import threading
+from unittest import mock
 
+import fixtures
 import os_resource_classes as orc
 import os_traits
+from oslo_db.sqlalchemy import engines
 from oslo_utils.fixture import uuidsentinel as uuids
 import sqlalchemy as sa
 
+from placement import context
+from placement.db.sqlalchemy import migration
+from placement import db_api
+from placement import deploy
 from placement import exception
 from placement import lib as placement_lib
+from placement.objects import allocation as alloc_obj
 from placement.objects import allocation_candidate as ac_obj
 from placement.objects import research_context as res_ctx
 from placement.objects import resource_class as rc_obj
 from placement.objects import resource_provider as rp_obj
+from placement.objects import search_profile
 from placement.objects import trait as trait_obj
 from placement.tests.functional.db import test_base as tb
 
@@ -449,6 +461,46 @@ class ProviderDBHelperTestCase(tb.PlacementDbBaseTestCase):
 
         run([{'HW_CPU_X86_TBM'}, {'HW_CPU_X86_TSX', 'CUSTOM_FOO'}], [cn3.id])
 
+    def test_get_providers_with_resources(self):
+        vcpu_id = self.ctx.rc_cache.id_from_string(orc.VCPU)
+        mem_id = self.ctx.rc_cache.id_from_string(orc.MEMORY_MB)
+
+        # Enough of both
+        cn1 = self._create_provider('cn1')
+        tb.add_inventory(cn1, orc.VCPU, 8)
+        tb.add_inventory(cn1, orc.MEMORY_MB, 2048)
+
+        # Enough VCPU, but the memory is already consumed
+        cn2 = self._create_provider('cn2')
+        tb.add_inventory(cn2, orc.VCPU, 8)
+        tb.add_inventory(cn2, orc.MEMORY_MB, 2048)
+        self.allocate_from_provider(cn2, orc.MEMORY_MB, 2000)
+
+        # Only memory, in a tree
+        cn3 = self._create_provider('cn3')
+        numa = self._create_provider('numa', parent=cn3.uuid)
+        tb.add_inventory(numa, orc.MEMORY_MB, 1024, step_size=256)
+
+        obs = res_ctx.get_providers_with_resources(
+            self.ctx, {vcpu_id: 2, mem_id: 512})
+        expected = {
+            (cn1.id, cn1.id, vcpu_id),
+            (cn1.id, cn1.id, mem_id),
+            (cn2.id, cn2.id, vcpu_id),
+            (numa.id, cn3.id, mem_id),
+        }
+        self.assertEqual(expected, obs)
+
+        # The step size of the numa node's memory is honored
+        obs = res_ctx.get_providers_with_resources(
+            self.ctx, {vcpu_id: 2, mem_id: 500})
+        self.assertNotIn((numa.id, cn3.id, mem_id), obs)
+
+        # Limited to a single tree
+        obs = res_ctx.get_providers_with_resources(
+            self.ctx, {vcpu_id: 2, mem_id: 512}, tree_root_id=cn3.id)
+        self.assertEqual({(numa.id, cn3.id, mem_id)}, obs)
+
 
 class ProviderTreeDBHelperTestCase(tb.PlacementDbBaseTestCase):
 
@@ -670,7 +722,7 @@ class ProviderTreeDBHelperTestCase(tb.PlacementDbBaseTestCase):
         # NOTE(tetsuro): Actually we also get providers without traits here.
         # This is reported as bug#1771707 and from users' view the bug is now
         # fixed out of this get_trees_matching_all() function by checking
-        # traits later again in _check_traits_for_alloc_request().
+        # traits later again in _resource_request_combinations().
         # But ideally, we'd like to have only pf1 from cn3 here using SQL
         # query in get_trees_matching_all() function for optimization.
         # provider_names = ['cn3', 'cn3_numa1_pf1']
@@ -694,7 +746,7 @@ class ProviderTreeDBHelperTestCase(tb.PlacementDbBaseTestCase):
         # NOTE(tetsuro): Actually we also get providers without traits here.
         # This is reported as bug#1771707 and from users' view the bug is now
         # fixed out of this get_trees_matching_all() function by checking
-        # traits later again in _check_traits_for_alloc_request().
+        # traits later again in _resource_request_combinations().
         # But ideally, we'd like to have only pf1 from cn3 here using SQL
         # query in get_trees_matching_all() function for optimization.
         # provider_names = ['cn3', 'cn3_numa1_pf1']
@@ -723,6 +775,85 @@ class ProviderTreeDBHelperTestCase(tb.PlacementDbBaseTestCase):
         _run_test([], [], required_traits=req_traits,
                   forbidden_traits=forbidden_traits)
 
+    def test_get_trees_matching_all_with_sharing(self):
+        """Tests that get_trees_matching_all() drops the trees that can't
+        satisfy the trait constraints when sharing providers are in play.
+        """
+        resources = {orc.VCPU: 2, orc.DISK_GB: 100}
+
+        def _run_test(expected_trees, expected_rps, **kwargs):
+            rg_ctx = _req_group_search_context(
+                self.ctx, resources=resources, **kwargs)
+            self.assertTrue(rg_ctx.exists_sharing)
+            rw_ctx = res_ctx.RequestWideSearchContext(
+                self.ctx, placement_lib.RequestWideParams(), True)
+            results = res_ctx.get_trees_matching_all(rg_ctx, rw_ctx)
+
+            tree_ids = self._get_rp_ids_matching_names(expected_trees)
+            rp_ids = self._get_rp_ids_matching_names(expected_rps)
+            self.assertEqual(tree_ids, results.trees)
+            self.assertEqual(rp_ids, results.rps)
+
+        # Two compute nodes, with a NUMA child each, share two storage
+        # providers through agg1:
+        #
+        #   cn1                     cn2 (HW_CPU_X86_AVX2)  ss1 (CUSTOM_SLOW)
+        #    |                       |                     ss2
+        #   cn1_numa0 (VCPU,        cn2_numa0 (VCPU)
+        #              HW_CPU_X86_AVX2)
+        for x in ('1', '2'):
+            cn = self._create_provider('cn' + x, uuids.agg1)
+            numa = self._create_provider(
+                'cn' + x + '_numa0', parent=cn.uuid)
+            tb.add_inventory(numa, orc.VCPU, 8)
+            if x == '1':
+                tb.set_traits(numa, os_traits.HW_CPU_X86_AVX2)
+            else:
+                # The root of cn2 doesn't provide any of the resources, so
+                # its traits don't count.
+                tb.set_traits(cn, os_traits.HW_CPU_X86_AVX2)
+        for x in ('1', '2'):
+            ss = self._create_provider('ss' + x, uuids.agg1)
+            tb.add_inventory(ss, orc.DISK_GB, 1000)
+            traits = [os_traits.MISC_SHARES_VIA_AGGREGATE]
+            if x == '1':
+                traits.append('CUSTOM_SLOW')
+            tb.set_traits(ss, *traits)
+
+        all_rps = ['cn1_numa0', 'cn2_numa0', 'ss1', 'ss2']
+        _run_test(['cn1', 'cn2'], all_rps)
+
+        # Only cn1 provides VCPU from a provider having the required trait
+        req_traits = [{os_traits.HW_CPU_X86_AVX2}]
+        _run_test(['cn1'], ['cn1_numa0', 'ss1', 'ss2'],
+                  required_traits=req_traits)
+
+        # Either of the sharing providers has the storage trait, so all the
+        # trees are still in play
+        slow_t = trait_obj.Trait.get_by_name(self.ctx, 'CUSTOM_SLOW')
+        _run_test(['cn1', 'cn2'], all_rps,
+                  required_traits=[{'CUSTOM_SLOW'}])
+
+        # Forbidding the storage trait drops the sharing provider having it
+        forbidden_traits = {slow_t.name: slow_t.id}
+        _run_test(['cn1', 'cn2'], ['cn1_numa0', 'cn2_numa0', 'ss2'],
+                  forbidden_traits=forbidden_traits)
+        _run_test(['cn1'], ['cn1_numa0', 'ss2'],
+                  required_traits=req_traits,
+                  forbidden_traits=forbidden_traits)
+
+        # Forbidding the trait of the NUMA node drops the tree, which has no
+        # other provider of VCPU
+        avx2_t = trait_obj.Trait.get_by_name(
+            self.ctx, os_traits.HW_CPU_X86_AVX2)
+        _run_test(['cn2'], ['cn2_numa0', 'ss1', 'ss2'],
+                  forbidden_traits={avx2_t.name: avx2_t.id})
+
+        # No tree has both traits on offer once the storage trait is
+        # forbidden
+        _run_test([], [], required_traits=req_traits + [{'CUSTOM_SLOW'}],
+                  forbidden_traits=forbidden_traits)
+
     def _make_trees_with_traits(self):
         # We are setting up 6 trees of providers with following traits:
         #
@@ -1674,6 +1805,255 @@ class AllocationCandidatesTestCase(tb.PlacementDbBaseTestCase):
         # provider summaries should have two rps
         self.assertEqual(expected_length, len(alloc_cands.provider_summaries))
 
+    def test_summaries_only_for_limited_results(self):
+        for name in ('cn1', 'cn2', 'cn3'):
+            cn = self._create_provider(name)
+            tb.add_inventory(cn, orc.VCPU, 24)
+            tb.add_inventory(cn, orc.MEMORY_MB, 32768)
+            tb.add_inventory(cn, orc.DISK_GB, 2000)
+
+        with mock.patch.object(
+                res_ctx, 'get_usages_by_provider_trees',
+                wraps=res_ctx.get_usages_by_provider_trees) as mock_usages:
+            alloc_cands = self._get_allocation_candidates(
+                groups={'': placement_lib.RequestGroup(
+                    use_same_provider=False, resources={orc.VCPU: 1})},
+                rqparams=placement_lib.RequestWideParams(limit=1))
+        self.assertEqual(1, len(alloc_cands.allocation_requests))
+        self.assertEqual(1, len(alloc_cands.provider_summaries))
+        # The capacity of the requested resource class is fetched for every
+        # candidate tree, but the full usage information only for the tree
+        # that is returned.
+        self.assertEqual(2, mock_usages.call_count)
+        all_roots = mock_usages.call_args_list[0][0][1]
+        returned_roots = mock_usages.call_args_list[1][0][1]
+        self.assertEqual(3, len(all_roots))
+        self.assertEqual(
+            {self.ctx.rc_cache.id_from_string(orc.VCPU)},
+            mock_usages.call_args_list[0][1]['rc_ids'])
+        self.assertEqual(1, len(returned_roots))
+        self.assertEqual(
+            {orc.VCPU, orc.MEMORY_MB, orc.DISK_GB},
+            set(res.resource_class
+                for res in alloc_cands.provider_summaries[0].resources))
+
+    def test_search_profile(self):
+        for name in ('cn1', 'cn2', 'cn3'):
+            cn = self._create_provider(name)
+            tb.add_inventory(cn, orc.VCPU, 24)
+            tb.add_inventory(cn, orc.MEMORY_MB, 32768)
+
+        profile = search_profile.SearchProfile()
+        self.ctx.search_profile = profile
+        alloc_cands = self._get_allocation_candidates(
+            groups={'': placement_lib.RequestGroup(
+                use_same_provider=False, resources={orc.VCPU: 1})},
+            rqparams=placement_lib.RequestWideParams(limit=2))
+        self.assertEqual(2, len(alloc_cands.allocation_requests))
+
+        phases = profile.phases
+        for name in ('group_ctx', 'providers', 'alloc_requests', 'merge',
+                     'exclude_nested', 'limit', 'summaries'):
+            self.assertIn(name, phases)
+        self.assertEqual(3, phases['providers'].rows)
+        self.assertEqual(3, phases['alloc_requests'].rows)
+        # Only as many allocation requests as the limit are merged
+        self.assertEqual(2, phases['merge'].rows)
+        self.assertEqual(2, phases['limit'].rows)
+        self.assertEqual(2, phases['summaries'].rows)
+        self.assertGreater(
+            sum(stats.queries for stats in phases.values()), 0)
+        self.assertIsNone(search_profile._ACTIVE.profile)
+
+    def test_parallel_request_groups(self):
+        for name in ('cn1', 'cn2', 'cn3'):
+            cn = self._create_provider(name)
+            tb.add_inventory(cn, orc.VCPU, 24)
+            tb.add_inventory(cn, orc.MEMORY_MB, 32768)
+            for x in ('0', '1'):
+                pf = self._create_provider(name + '_pf' + x, parent=cn.uuid)
+                tb.add_inventory(pf, orc.SRIOV_NET_VF, 8)
+        groups = {
+            '': placement_lib.RequestGroup(
+                use_same_provider=False,
+                resources={orc.VCPU: 2, orc.MEMORY_MB: 1024}),
+            '_NET1': placement_lib.RequestGroup(
+                resources={orc.SRIOV_NET_VF: 1}),
+            '_NET2': placement_lib.RequestGroup(
+                resources={orc.SRIOV_NET_VF: 1}),
+        }
+        rqparams = placement_lib.RequestWideParams(group_policy='isolate')
+
+        expected = self._get_allocation_candidates(groups, rqparams)
+        self.assertEqual(6, len(expected.allocation_requests))
+
+        def assertSameCandidates(alloc_cands):
+            self.assertEqual(
+                expected.allocation_requests, alloc_cands.allocation_requests)
+            self.assertEqual(
+                [ps.resource_provider.uuid
+                 for ps in expected.provider_summaries],
+                [ps.resource_provider.uuid
+                 for ps in alloc_cands.provider_summaries])
+
+        # SQLite can't serve the transactions of several threads at once, so
+        # the groups are searched one after the other.
+        self.conf_fixture.config(
+            allocation_candidates_group_workers=4, group='placement')
+        with mock.patch.object(
+                ac_obj, '_get_group_executor') as mock_executor:
+            alloc_cands = self._get_allocation_candidates(groups, rqparams)
+        mock_executor.assert_not_called()
+        assertSameCandidates(alloc_cands)
+
+        # The searches submitted to the thread pool give the same candidates
+        # in the same order. They are run by the submitting thread here.
+        submitted = []
+
+        def submit(fn, *args):
+            submitted.append(args[-2])
+            future = futures.Future()
+            future.set_result(fn(*args))
+            return future
+
+        patcher = mock.patch.object(
+            ac_obj, '_can_search_concurrently', return_value=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        with mock.patch.object(ac_obj, '_get_group_executor') as mock_executor:
+            mock_executor.return_value.submit.side_effect = submit
+            alloc_cands = self._get_allocation_candidates(groups, rqparams)
+        mock_executor.assert_called_once_with(4)
+        self.assertEqual(['', '_NET1', '_NET2'], sorted(submitted))
+        assertSameCandidates(alloc_cands)
+
+        # A group without candidates still makes the whole request fail
+        groups['_NET3'] = placement_lib.RequestGroup(
+            resources={orc.SRIOV_NET_VF: 9})
+        with mock.patch.object(ac_obj, '_get_group_executor') as mock_executor:
+            mock_executor.return_value.submit.side_effect = submit
+            alloc_cands = self._get_allocation_candidates(groups, rqparams)
+        self.assertEqual([], alloc_cands.allocation_requests)
+
+    def test_result_cache(self):
+        cn1 = self._create_provider('cn1')
+        tb.add_inventory(cn1, orc.VCPU, 8)
+        self.conf_fixture.config(
+            allocation_candidates_cache_ttl=60, group='placement')
+
+        def get(*traits):
+            groups = {'': placement_lib.RequestGroup(
+                use_same_provider=False, resources={orc.VCPU: 2},
+                required_traits=[set(traits)] if traits else [])}
+            return self._get_allocation_candidates(groups=groups)
+
+        with mock.patch.object(
+                ac_obj.AllocationCandidates, '_search',
+                wraps=ac_obj.AllocationCandidates._search) as mock_search:
+            first = get()
+            self.assertEqual(1, len(first.allocation_requests))
+            self.assertIs(first, get())
+            self.assertEqual(1, mock_search.call_count)
+
+            # A different request is searched for
+            self.assertEqual([], get(os_traits.HW_CPU_X86_AVX2)
+                             .allocation_requests)
+            self.assertEqual(2, mock_search.call_count)
+
+            # Adding a trait changes the generation of the provider, so the
+            # cached results are not used any more
+            tb.set_traits(cn1, os_traits.HW_CPU_X86_AVX2)
+            self.assertEqual(
+                1, len(get(os_traits.HW_CPU_X86_AVX2).allocation_requests))
+            self.assertIsNot(first, get())
+            self.assertEqual(4, mock_search.call_count)
+
+            # So does consuming the inventory
+            self.allocate_from_provider(cn1, orc.VCPU, 7)
+            self.assertEqual([], get().allocation_requests)
+            self.assertEqual(5, mock_search.call_count)
+
+            # And so does a new provider
+            cn2 = self._create_provider('cn2')
+            tb.add_inventory(cn2, orc.VCPU, 8)
+            self.assertEqual(1, len(get().allocation_requests))
+            self.assertEqual(6, mock_search.call_count)
+
+            # Cached results expire
+            for key, (cached_at, cands) in list(ac_obj._CACHE.items()):
+                ac_obj._CACHE[key] = (cached_at - 60, cands)
+            get()
+            self.assertEqual(7, mock_search.call_count)
+
+            # Randomized results are not cached
+            self.conf_fixture.config(
+                randomize_allocation_candidates=True, group='placement')
+            get()
+            get()
+            self.assertEqual(9, mock_search.call_count)
+
+    def test_result_cache_allocation_changes(self):
+        cn1 = self._create_provider('cn1')
+        cn2 = self._create_provider('cn2')
+        for cn in (cn1, cn2):
+            tb.add_inventory(cn, orc.VCPU, 8)
+        self.conf_fixture.config(
+            allocation_candidates_cache_ttl=60, group='placement')
+
+        def get():
+            cands = self._get_allocation_candidates(groups={
+                '': placement_lib.RequestGroup(
+                    use_same_provider=False, resources={orc.VCPU: 2})})
+            return sorted(
+                self.rp_uuid_to_name[ar.resource_requests[0]
+                                     .resource_provider.uuid]
+                for ar in cands.allocation_requests)
+
+        allocs = self.allocate_from_provider(cn1, orc.VCPU, 7)
+        self.assertEqual(['cn2'], get())
+
+        # Removing the allocations doesn't change the generation of any
+        # provider, but the cached results are not used any more
+        alloc_obj.delete_all(self.ctx, allocs)
+        self.assertEqual(['cn1', 'cn2'], get())
+
+        # Neither are they once the allocations of a consumer are moved
+        # from one provider to another
+        allocs = self.allocate_from_provider(cn1, orc.VCPU, 7)
+        self.assertEqual(['cn2'], get())
+        consumer = alloc_obj.get_all_by_consumer_id(
+            self.ctx, allocs[0].consumer.uuid)[0].consumer
+        tb.set_allocation(self.ctx, cn2, consumer, {orc.VCPU: 7})
+        self.assertEqual(['cn1'], get())
+
+    def test_result_cache_size(self):
+        cn1 = self._create_provider('cn1')
+        tb.add_inventory(cn1, orc.VCPU, 8)
+        self.conf_fixture.config(
+            allocation_candidates_cache_ttl=60,
+            allocation_candidates_cache_size=2, group='placement')
+
+        def get(amount):
+            self._get_allocation_candidates(groups={
+                '': placement_lib.RequestGroup(
+                    use_same_provider=False, resources={orc.VCPU: amount})})
+
+        with mock.patch.object(
+                ac_obj.AllocationCandidates, '_search',
+                wraps=ac_obj.AllocationCandidates._search) as mock_search:
+            # Asking for 1 VCPU again makes it more recently used than the
+            # request for 2 VCPU, which is forgotten to make room for the
+            # request for 3 VCPU.
+            for amount in (1, 2, 1, 3, 1):
+                get(amount)
+            self.assertEqual(3, mock_search.call_count)
+            self.assertEqual(2, len(ac_obj._CACHE))
+            get(1)
+            get(3)
+            self.assertEqual(3, mock_search.call_count)
+            get(2)
+            self.assertEqual(4, mock_search.call_count)
+
     def test_local_with_shared_disk(self):
         """Create some resource providers that can satisfy the request for
         resources with local VCPU and MEMORY_MB but rely on a shared storage
@@ -2445,6 +2825,29 @@ class AllocationCandidatesTestCase(tb.PlacementDbBaseTestCase):
         }
         self._validate_provider_summary_resources(expected, alloc_cands)
 
+    def test_sharing_provider_anchors_looked_up_once(self):
+        cn1 = self._create_provider('cn1', uuids.agg1)
+        tb.add_inventory(cn1, orc.VCPU, 8)
+        for name in ('ss1', 'ss2', 'ss3'):
+            ss = self._create_provider(name, uuids.agg1)
+            tb.set_traits(ss, "MISC_SHARES_VIA_AGGREGATE")
+            tb.add_inventory(ss, orc.DISK_GB, 1600)
+
+        groups = {
+            suffix: placement_lib.RequestGroup(
+                use_same_provider=True, resources={'DISK_GB': 100})
+            for suffix in ('1', '2')}
+        groups[''] = placement_lib.RequestGroup(
+            use_same_provider=False, resources={'VCPU': 1})
+        with mock.patch.object(
+                res_ctx, 'anchors_for_sharing_providers',
+                wraps=res_ctx.anchors_for_sharing_providers) as mock_anchors:
+            alloc_cands = self._get_allocation_candidates(groups)
+        # The anchors of all three sharing providers are looked up in one
+        # query for both granular groups.
+        self.assertEqual(1, mock_anchors.call_count)
+        self.assertEqual(9, len(alloc_cands.allocation_requests))
+
     def test_all_sharing_providers_no_rc_overlap(self):
         ss1 = self._create_provider('ss1', uuids.agg1)
         tb.set_traits(ss1, "MISC_SHARES_VIA_AGGREGATE")
@@ -3788,3 +4191,77 @@ class AllocationCandidatesTestCase(tb.PlacementDbBaseTestCase):
         self.assertEqual(8, len(alloc_cands.allocation_requests))
         self._validate_allocation_requests(
             expected, alloc_cands, expect_suffixes=True)
+
+
+class ConcurrentGroupSearchTestCase(tb.PlacementDbBaseTestCase):
+    """Searches for the providers of request groups with a real thread pool.
+
+    That needs a database which several connections can read at once, so the
+    tests use an SQLite database file rather than the usual in-memory one.
+    """
+
+    def setUp(self):
+        super(ConcurrentGroupSearchTestCase, self).setUp()
+        db_path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                               'placement.sqlite')
+        engine = engines.create_engine('sqlite:///%s' % db_path)
+        self.addCleanup(engine.dispose)
+        migration.create_schema(engine)
+        self.addCleanup(
+            db_api.placement_context_manager.patch_engine(engine))
+        # Let the searches still running finish before the database goes.
+        self.addCleanup(ac_obj.shutdown_group_executor)
+        self.placement_db.cleanup()
+        deploy.update_database(self.conf_fixture.conf)
+        self.ctx = self.context = context.RequestContext()
+        self.context.config = self.conf_fixture.conf
+
+    def test_real_executor(self):
+        for name in ('cn1', 'cn2'):
+            cn = self._create_provider(name)
+            tb.add_inventory(cn, orc.VCPU, 24)
+            for x in ('0', '1'):
+                pf = self._create_provider(name + '_pf' + x, parent=cn.uuid)
+                tb.add_inventory(pf, orc.SRIOV_NET_VF, 8)
+        groups = {
+            '': placement_lib.RequestGroup(
+                use_same_provider=False, resources={orc.VCPU: 2}),
+            '_NET1': placement_lib.RequestGroup(
+                resources={orc.SRIOV_NET_VF: 1}),
+            '_NET2': placement_lib.RequestGroup(
+                resources={orc.SRIOV_NET_VF: 1}),
+        }
+        rqparams = placement_lib.RequestWideParams(group_policy='isolate')
+        expected = ac_obj.AllocationCandidates.get_by_requests(
+            self.ctx, groups, rqparams)
+        self.assertEqual(4, len(expected.allocation_requests))
+
+        self.conf_fixture.config(
+            allocation_candidates_group_workers=3, group='placement')
+        threads = set()
+        search_group = ac_obj._search_group
+
+        def _search_group(*args):
+            threads.add(threading.get_ident())
+            return search_group(*args)
+
+        with mock.patch.object(
+                ac_obj, '_search_group', side_effect=_search_group):
+            alloc_cands = ac_obj.AllocationCandidates.get_by_requests(
+                self.ctx, groups, rqparams)
+        self.assertTrue(threads)
+        self.assertNotIn(threading.get_ident(), threads)
+        self.assertEqual(
+            expected.allocation_requests, alloc_cands.allocation_requests)
+        self.assertEqual(
+            [ps.resource_provider.uuid for ps in expected.provider_summaries],
+            [ps.resource_provider.uuid
+             for ps in alloc_cands.provider_summaries])
+
+        # A group without candidates makes the whole request fail, whether
+        # or not the searches of the other groups are still running.
+        groups['_NET3'] = placement_lib.RequestGroup(
+            resources={orc.SRIOV_NET_VF: 9})
+        alloc_cands = ac_obj.AllocationCandidates.get_by_requests(
+            self.ctx, groups, rqparams)
+        self.assertEqual([], alloc_cands.allocation_requests)
@@ -127,3 +127,91 @@ class TestResourceClassCache(base.TestCase):
                           cache.string_from_id, 99999999)
         self.assertRaises(exception.ResourceClassNotFound,
                           cache.id_from_string, 'UNKNOWN')
+
+    def test_rc_cache_shared(self):
+        """Test that the contents of the table are shared between caches and
+        only read again once the table changes.
+        """
+        cache = attribute_cache.ResourceClassCache(self.context)
+        self.assertEqual(0, cache.id_from_string('VCPU'))
+
+        # Another cache only checks the watermark of the table.
+        cache = attribute_cache.ResourceClassCache(self.context)
+        with mock.patch.object(
+                cache, '_get_watermark',
+                wraps=cache._get_watermark) as mock_watermark, \
+                mock.patch('sqlalchemy.select',
+                           wraps=attribute_cache.sa.select) as sel_mock:
+            self.assertEqual(0, cache.id_from_string('VCPU'))
+            self.assertEqual(1, sel_mock.call_count)
+            self.assertEqual(1, mock_watermark.call_count)
+
+        # A change to the table, even if not made through the cache, is seen.
+        with self.placement_db.get_engine().connect() as conn:
+            ins_stmt = attribute_cache._RC_TBL.insert().values(
+                id=1001,
+                name='IRON_NFV'
+            )
+            with conn.begin():
+                conn.execute(ins_stmt)
+        cache = attribute_cache.ResourceClassCache(self.context)
+        self.assertEqual(1001, cache.id_from_string('IRON_NFV'))
+
+        # Clearing a cache drops the shared copy.
+        cache.clear()
+        self.assertNotIn(
+            attribute_cache._RC_TBL.name, attribute_cache._SHARED_CACHES)
+
+    def test_rc_cache_miss_fetches_one_row(self):
+        """Test that a lookup missing a loaded cache only fetches the missing
+        row and that names not found are remembered for a while.
+        """
+        cache = attribute_cache.ResourceClassCache(self.context)
+        self.assertEqual(0, cache.id_from_string('VCPU'))
+        self.assertRaises(exception.ResourceClassNotFound,
+                          cache.id_from_string, 'IRON_NFV')
+
+        with self.placement_db.get_engine().connect() as conn:
+            ins_stmt = attribute_cache._RC_TBL.insert().values(
+                id=1001,
+                name='IRON_NFV'
+            )
+            with conn.begin():
+                conn.execute(ins_stmt)
+
+        # IRON_NFV is still known not to exist...
+        with mock.patch('sqlalchemy.select') as sel_mock:
+            self.assertRaises(exception.ResourceClassNotFound,
+                              cache.id_from_string, 'IRON_NFV')
+            self.assertFalse(sel_mock.called)
+
+        # ...until that is forgotten, when it is fetched on its own.
+        self.conf_fixture.config(
+            attribute_cache_not_found_ttl=0, group='placement')
+        with mock.patch.object(cache, '_refresh_from_db') as mock_refresh:
+            self.assertEqual(1001, cache.id_from_string('IRON_NFV'))
+            self.assertEqual('IRON_NFV', cache.string_from_id(1001))
+            mock_refresh.assert_not_called()
+        self.assertEqual(0, cache.id_from_string('VCPU'))
+
+
+class TestExternalIdCache(base.TestCase):
+
+    def test_least_recently_used_forgotten(self):
+        self.conf_fixture.config(external_id_cache_size=2, group='placement')
+        cache = attribute_cache.ExternalIdCache('test')
+        cache.set(self.context, 'a', 1)
+        cache.set(self.context, 'b', 2)
+        self.assertEqual(1, cache.get('a'))
+        cache.set(self.context, 'c', 3)
+        self.assertEqual(1, cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(3, cache.get('c'))
+        cache.clear()
+        self.assertIsNone(cache.get('a'))
+
+    def test_disabled(self):
+        self.conf_fixture.config(external_id_cache_size=0, group='placement')
+        cache = attribute_cache.ExternalIdCache('test')
+        cache.set(self.context, 'a', 1)
+        self.assertIsNone(cache.get('a'))
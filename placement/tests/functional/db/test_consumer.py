@@ -83,6 +83,42 @@ class ConsumerTestCase(tb.PlacementDbBaseTestCase):
         self.assertEqual(another_proj.id, c.project.id)
         self.assertEqual(another_user.id, c.user.id)
 
+    def test_create_all_and_get_all_by_uuids(self):
+        c1 = consumer_obj.Consumer(
+            self.ctx, uuid=uuids.consumer1, user=self.user_obj,
+            project=self.project_obj)
+        c2 = consumer_obj.Consumer(
+            self.ctx, uuid=uuids.consumer2, user=self.user_obj,
+            project=self.project_obj)
+        consumer_obj.create_all(self.ctx, [c1, c2])
+        self.assertEqual(0, c1.generation)
+        self.assertNotEqual(c1.id, c2.id)
+
+        consumers = consumer_obj.get_all_by_uuids(
+            self.ctx, [uuids.consumer1, uuids.consumer2, uuids.missing])
+        self.assertEqual({uuids.consumer1, uuids.consumer2}, set(consumers))
+        for c in (c1, c2):
+            self.assertEqual(c.id, consumers[c.uuid].id)
+            self.assertIsNotNone(c.created_at)
+            self.assertEqual(c.created_at, consumers[c.uuid].created_at)
+            self.assertIsNone(consumers[c.uuid].updated_at)
+            self.assertEqual(
+                self.project_obj.external_id,
+                consumers[c.uuid].project.external_id)
+            self.assertEqual(
+                self.user_obj.external_id, consumers[c.uuid].user.external_id)
+
+        # None of the consumers are created if any of them exists
+        c3 = consumer_obj.Consumer(
+            self.ctx, uuid=uuids.consumer3, user=self.user_obj,
+            project=self.project_obj)
+        self.assertRaises(
+            exception.ConsumerExists,
+            consumer_obj.create_all, self.ctx, [c3, c1])
+        self.assertRaises(
+            exception.ConsumerNotFound,
+            consumer_obj.Consumer.get_by_uuid, self.ctx, uuids.consumer3)
+
 
 @db_api.placement_context_manager.reader
 def _get_allocs_with_no_consumer_relationship(ctx):
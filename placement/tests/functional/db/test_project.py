@@ -9,6 +9,8 @@
 #    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 #    License for the specific language governing permissions and limitations
 #    under the License.
+from unittest import mock
+
 from oslo_utils.fixture import uuidsentinel as uuids
 
 from placement import exception
@@ -29,3 +31,56 @@ class ProjectTestCase(tb.PlacementDbBaseTestCase):
         # Project ID == 1 is fake-project created in setup
         self.assertEqual(2, p.id)
         self.assertRaises(exception.ProjectExists, p.create)
+
+    def test_get_or_create_all_by_external_ids(self):
+        projects = project_obj.get_or_create_all_by_external_ids(
+            self.ctx, ['fake-project', 'new-project', 'new-project'])
+        self.assertEqual({'fake-project', 'new-project'}, set(projects))
+        self.assertEqual(self.project_obj.id, projects['fake-project'].id)
+        p = project_obj.Project.get_by_external_id(self.ctx, 'new-project')
+        self.assertEqual(p.id, projects['new-project'].id)
+
+    def test_get_or_create_all_by_external_ids_race(self):
+        """Tests that the missing projects are created one at a time when
+        another thread created some of them in the meantime.
+        """
+        project_obj.ID_CACHE.clear()
+        real_get = project_obj._get_projects_by_external_ids
+        lookups = []
+
+        def fake_get(ctx, external_ids):
+            lookups.append(sorted(external_ids))
+            # The first lookup misses fake-project, as if another thread
+            # had created it right after.
+            if len(lookups) == 1:
+                return []
+            return real_get(ctx, external_ids)
+
+        with mock.patch.object(
+                project_obj, '_get_projects_by_external_ids',
+                side_effect=fake_get):
+            projects = project_obj.get_or_create_all_by_external_ids(
+                self.ctx, ['fake-project', 'new-project'])
+        self.assertEqual([['fake-project', 'new-project']] * 2, lookups)
+        self.assertEqual(self.project_obj.id, projects['fake-project'].id)
+        p = project_obj.Project.get_by_external_id(self.ctx, 'new-project')
+        self.assertEqual(p.id, projects['new-project'].id)
+
+    def test_get_id_by_external_id(self):
+        self.assertIsNone(
+            project_obj.get_id_by_external_id(self.ctx, 'new-project'))
+        p = project_obj.Project(self.ctx, external_id='new-project')
+        p.create()
+        # The id of the created project is remembered
+        with mock.patch.object(
+                project_obj, '_get_project_by_external_id') as mock_get, \
+                mock.patch.object(
+                    project_obj, '_get_projects_by_external_ids') as mock_gets:
+            self.assertEqual(
+                p.id,
+                project_obj.get_id_by_external_id(self.ctx, 'new-project'))
+            projects = project_obj.get_or_create_all_by_external_ids(
+                self.ctx, ['new-project'])
+            self.assertEqual(p.id, projects['new-project'].id)
+        mock_get.assert_not_called()
+        mock_gets.assert_not_called()
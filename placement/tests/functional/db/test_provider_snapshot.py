@@ -0,0 +1,182 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os_resource_classes as orc
+import os_traits
+from oslo_utils.fixture import uuidsentinel as uuids
+import sqlalchemy as sa
+
+from placement import context
+from placement import lib as placement_lib
+from placement.objects import allocation as alloc_obj
+from placement.objects import allocation_candidate as ac_obj
+from placement.objects import provider_snapshot
+from placement.tests.functional.db import test_allocation_candidates
+from placement.tests.functional.db import test_base as tb
+
+
+class AllocationCandidatesSnapshotTestCase(
+        test_allocation_candidates.AllocationCandidatesTestCase):
+    """Runs every allocation candidates scenario against a provider snapshot
+    that is rebuilt for each request, to prove that the snapshot answers
+    exactly like the database does.
+    """
+
+    def setUp(self):
+        super(AllocationCandidatesSnapshotTestCase, self).setUp()
+        self.conf_fixture.config(
+            allocation_candidates_snapshot=True,
+            allocation_candidates_snapshot_refresh_interval=0,
+            allocation_candidates_snapshot_max_age=0,
+            group='placement')
+
+
+class ProviderSnapshotTestCase(tb.PlacementDbBaseTestCase):
+
+    def setUp(self):
+        super(ProviderSnapshotTestCase, self).setUp()
+        self.conf_fixture.config(
+            allocation_candidates_snapshot=True,
+            allocation_candidates_snapshot_refresh_interval=0,
+            allocation_candidates_snapshot_max_age=3600,
+            group='placement')
+        self.resources = {orc.VCPU: 2, orc.DISK_GB: 100}
+
+    def _get_rp_names(self, resources=None, **kwargs):
+        groups = {'': placement_lib.RequestGroup(
+            use_same_provider=False,
+            resources=resources or self.resources, **kwargs)}
+        cands = ac_obj.AllocationCandidates.get_by_requests(
+            self.ctx, groups, placement_lib.RequestWideParams())
+        return sorted(
+            set(self.rp_uuid_to_name[arr.resource_provider.uuid]
+                for areq in cands.allocation_requests
+                for arr in areq.resource_requests))
+
+    def _create_compute(self, name, *aggs, **kwargs):
+        cn = self._create_provider(name, *aggs, **kwargs)
+        tb.add_inventory(cn, orc.VCPU, 8)
+        tb.add_inventory(cn, orc.DISK_GB, 1000)
+        return cn
+
+    def test_refresh_sees_generation_changes(self):
+        cn1 = self._create_compute('cn1')
+        self._create_compute('cn2')
+        self.assertEqual(['cn1', 'cn2'], self._get_rp_names())
+        built_at = provider_snapshot._SNAPSHOT.built_at
+
+        # Consuming capacity bumps the provider generation, which the next
+        # refresh notices without rebuilding the snapshot.
+        self.allocate_from_provider(cn1, orc.VCPU, 7)
+        self.assertEqual(['cn2'], self._get_rp_names())
+        self.assertEqual(built_at, provider_snapshot._SNAPSHOT.built_at)
+
+        # So does new inventory and a new provider in a tree.
+        tb.add_inventory(cn1, orc.MEMORY_MB, 1024)
+        cn3 = self._create_provider('cn3')
+        child = self._create_provider('child', parent=cn3.uuid)
+        tb.add_inventory(child, orc.VCPU, 8)
+        tb.add_inventory(child, orc.DISK_GB, 1000)
+        self.assertEqual(
+            ['child', 'cn1', 'cn2'],
+            self._get_rp_names(resources={orc.VCPU: 1, orc.DISK_GB: 100}))
+        self.assertEqual(
+            ['cn1'], self._get_rp_names(resources={orc.MEMORY_MB: 512}))
+        self.assertTrue(provider_snapshot._SNAPSHOT.has_trees)
+
+    def test_refresh_sees_trait_and_aggregate_changes(self):
+        cn1 = self._create_compute('cn1')
+        cn2 = self._create_compute('cn2')
+        self.assertEqual(
+            [], self._get_rp_names(member_of=[[uuids.agg1]]))
+
+        cn1.set_aggregates([uuids.agg1])
+        self.assertEqual(
+            ['cn1'], self._get_rp_names(member_of=[[uuids.agg1]]))
+        cn1.set_aggregates([uuids.agg2])
+        cn2.set_aggregates([uuids.agg1])
+        self.assertEqual(
+            ['cn2'], self._get_rp_names(member_of=[[uuids.agg1]]))
+
+        tb.set_traits(cn1, os_traits.HW_CPU_X86_AVX2)
+        self.assertEqual(
+            ['cn1'],
+            self._get_rp_names(
+                required_traits=[{os_traits.HW_CPU_X86_AVX2}]))
+
+    def test_refresh_sees_removed_allocations(self):
+        cn1 = self._create_compute('cn1')
+        allocs = self.allocate_from_provider(cn1, orc.VCPU, 8)
+        self.assertEqual([], self._get_rp_names())
+        built_at = provider_snapshot._SNAPSHOT.built_at
+
+        # Deleting allocations does not bump the provider generation, but
+        # the refresh notices the allocations table has changed.
+        alloc_obj.delete_all(self.ctx, allocs)
+        snap = provider_snapshot.get_snapshot(self.ctx)
+        vcpu_id = self.ctx.rc_cache.id_from_string(orc.VCPU)
+        self.assertEqual(
+            {(cn1.id, cn1.id, vcpu_id)},
+            snap.get_providers_with_resources({vcpu_id: 1}))
+        self.assertEqual(built_at, snap.built_at)
+
+    def test_refresh_sees_moved_allocations(self):
+        cn1 = self._create_compute('cn1')
+        cn2 = self._create_compute('cn2')
+        self.allocate_from_provider(
+            cn1, orc.VCPU, 8, consumer_id=uuids.instance)
+        self.assertEqual(['cn2'], self._get_rp_names())
+
+        # Only the generation of cn2, which the allocation is moved to, is
+        # bumped.
+        self.allocate_from_provider(
+            cn2, orc.VCPU, 8, consumer_id=uuids.instance)
+        self.assertEqual(['cn1'], self._get_rp_names())
+
+    def test_refresh_without_changes(self):
+        self._create_compute('cn1')
+        self.assertEqual(['cn1'], self._get_rp_names())
+        snap = provider_snapshot._SNAPSHOT
+        synced_at = snap.synced_at
+
+        # The snapshot in use by other requests is left alone.
+        new_snap = provider_snapshot.get_snapshot(self.ctx)
+        self.assertIsNot(snap, new_snap)
+        self.assertEqual(synced_at, snap.synced_at)
+        self.assertEqual(snap.built_at, new_snap.built_at)
+        self.assertEqual(['cn1'], self._get_rp_names())
+
+    def test_no_refresh_within_interval(self):
+        self._create_compute('cn1')
+        self.conf_fixture.config(
+            allocation_candidates_snapshot_refresh_interval=3600,
+            group='placement')
+        self.assertEqual(['cn1'], self._get_rp_names())
+        snap = provider_snapshot._SNAPSHOT
+
+        self._create_compute('cn2')
+        # Not even the resource class and trait caches of a new request
+        # context look in the database.
+        self.ctx = context.RequestContext(config=self.ctx.config)
+        queries = []
+
+        def _record_query(conn, cursor, statement, *args):
+            if statement.lstrip().upper().startswith('SELECT'):
+                queries.append(statement)
+
+        engine = self.placement_db.get_engine()
+        sa.event.listen(engine, 'before_cursor_execute', _record_query)
+        self.addCleanup(
+            sa.event.remove, engine, 'before_cursor_execute', _record_query)
+        self.assertEqual(['cn1'], self._get_rp_names())
+        self.assertEqual([], queries)
+        self.assertIs(snap, provider_snapshot._SNAPSHOT)
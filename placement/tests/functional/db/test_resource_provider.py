@@ -11,13 +11,16 @@
 #    under the License.
 
 
+import time
 from unittest import mock
 
 import os_resource_classes as orc
+import os_traits
 from oslo_db import exception as db_exc
 from oslo_utils.fixture import uuidsentinel
 
 from placement.db.sqlalchemy import models
+from placement import db_api
 from placement import exception
 from placement import lib as placement_lib
 from placement.objects import allocation as alloc_obj
@@ -509,6 +512,66 @@ class ResourceProviderTestCase(tb.PlacementDbBaseTestCase):
         # OK, now we've got a parent, so should be True
         self.assertTrue(res_ctx._has_provider_trees(self.ctx))
 
+    def test_topology_cache(self):
+        """has_provider_trees() and get_all_sharing_providers() remember
+        their answer until a provider is (re)parented or the sharing trait is
+        added to or removed from a provider.
+        """
+        self.conf_fixture.config(
+            provider_topology_cache_ttl=5, group='placement')
+        cn = self._create_provider('cn')
+        ss = self._create_provider('ss')
+        self.assertFalse(res_ctx.has_provider_trees(self.ctx))
+        self.assertEqual(
+            frozenset(), res_ctx.get_all_sharing_providers(self.ctx))
+
+        with mock.patch.object(res_ctx, '_has_provider_trees') as mock_trees:
+            with mock.patch.object(
+                    res_ctx, 'get_sharing_providers') as mock_sharing:
+                self.assertFalse(res_ctx.has_provider_trees(self.ctx))
+                self.assertEqual(
+                    frozenset(), res_ctx.get_all_sharing_providers(self.ctx))
+        mock_trees.assert_not_called()
+        mock_sharing.assert_not_called()
+
+        numa0 = self._create_provider('numa0', parent=cn.uuid)
+        self.assertTrue(res_ctx.has_provider_trees(self.ctx))
+        numa0.parent_provider_uuid = None
+        numa0.save(allow_reparenting=True)
+        self.assertFalse(res_ctx.has_provider_trees(self.ctx))
+
+        tb.set_traits(ss, os_traits.MISC_SHARES_VIA_AGGREGATE)
+        self.assertEqual(
+            frozenset([ss.id]), res_ctx.get_all_sharing_providers(self.ctx))
+        tb.set_traits(ss)
+        self.assertEqual(
+            frozenset(), res_ctx.get_all_sharing_providers(self.ctx))
+
+        # With a TTL of 0, the database is always queried.
+        self.conf_fixture.config(
+            provider_topology_cache_ttl=0, group='placement')
+        self._create_provider('numa1', parent=ss.uuid)
+        with mock.patch.object(
+                res_ctx, '_has_provider_trees',
+                return_value=True) as mock_trees:
+            self.assertTrue(res_ctx.has_provider_trees(self.ctx))
+            self.assertTrue(res_ctx.has_provider_trees(self.ctx))
+        self.assertEqual(2, mock_trees.call_count)
+
+    def test_topology_cache_cleared_on_commit(self):
+        """A search running while a provider is parented caches what it read
+        before the commit. That is forgotten once the commit is done.
+        """
+        self.conf_fixture.config(
+            provider_topology_cache_ttl=5, group='placement')
+        cn = self._create_provider('cn')
+        self.assertFalse(res_ctx.has_provider_trees(self.ctx))
+
+        with db_api.placement_context_manager.writer.using(self.ctx):
+            self._create_provider('numa0', parent=cn.uuid)
+            res_ctx._TOPOLOGY['has_trees'] = (False, time.monotonic())
+        self.assertTrue(res_ctx.has_provider_trees(self.ctx))
+
     def test_destroy_resource_provider(self):
         created_resource_provider = self._create_provider(
             uuidsentinel.fake_resource_name,
@@ -900,6 +963,23 @@ class ResourceProviderListTestCase(tb.PlacementDbBaseTestCase):
         expected_rps = ['rp_2']
         self._run_get_all_by_filters(expected_rps, filters=filters)
 
+    def test_get_all_by_uuids(self):
+        root = self._create_provider('root')
+        child = self._create_provider('child', parent=root.uuid)
+        self._create_provider('other')
+
+        rps, missing = rp_obj.get_all_by_uuids(
+            self.ctx, [child.uuid, root.uuid, uuidsentinel.missing])
+        self.assertEqual({root.uuid, child.uuid}, set(rps))
+        self.assertEqual({uuidsentinel.missing}, missing)
+        self.assertEqual('child', rps[child.uuid].name)
+        self.assertEqual(child.generation, rps[child.uuid].generation)
+        self.assertEqual(root.uuid, rps[child.uuid].root_provider_uuid)
+        self.assertEqual(root.uuid, rps[child.uuid].parent_provider_uuid)
+        self.assertIsNone(rps[root.uuid].parent_provider_uuid)
+
+        self.assertEqual(({}, set()), rp_obj.get_all_by_uuids(self.ctx, []))
+
     def test_get_all_by_filters_with_resources(self):
         for rp_i in ['1', '2']:
             rp = self._create_provider('rp_' + rp_i)
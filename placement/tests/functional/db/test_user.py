@@ -29,3 +29,11 @@ class UserTestCase(tb.PlacementDbBaseTestCase):
         # User ID == 1 is fake-user created in setup
         self.assertEqual(2, u.id)
         self.assertRaises(exception.UserExists, u.create)
+
+    def test_get_or_create_all_by_external_ids(self):
+        users = user_obj.get_or_create_all_by_external_ids(
+            self.ctx, ['fake-user', 'new-user', 'new-user'])
+        self.assertEqual({'fake-user', 'new-user'}, set(users))
+        self.assertEqual(self.user_obj.id, users['fake-user'].id)
+        u = user_obj.User.get_by_external_id(self.ctx, 'new-user')
+        self.assertEqual(u.id, users['new-user'].id)
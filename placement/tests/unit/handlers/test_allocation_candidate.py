@@ -0,0 +1,137 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Unit tests for code in the allocation candidate handler that gabbi cannot
+easily cover.
+"""
+
+import microversion_parse
+from oslo_serialization import jsonutils
+from oslo_utils.fixture import uuidsentinel as uuids
+import testtools
+
+from placement.handlers import allocation_candidate
+from placement import lib as placement_lib
+from placement.objects import allocation_candidate as ac_obj
+
+
+class TestSerializeAllocationCandidates(testtools.TestCase):
+
+    def setUp(self):
+        super(TestSerializeAllocationCandidates, self).setUp()
+        root = ac_obj.CandidateProvider(
+            id=1, uuid=uuids.root, root_provider_uuid=uuids.root)
+        child = ac_obj.CandidateProvider(
+            id=2, uuid=uuids.child, root_provider_uuid=uuids.root,
+            parent_provider_uuid=uuids.root)
+        self.cands = ac_obj.AllocationCandidates(
+            allocation_requests=[
+                ac_obj.AllocationRequest(
+                    resource_requests=[
+                        ac_obj.AllocationRequestResource(
+                            resource_provider=root, resource_class='VCPU',
+                            amount=1),
+                        ac_obj.AllocationRequestResource(
+                            resource_provider=child,
+                            resource_class='CUSTOM_MAGIC', amount=2)],
+                    mappings={'': {uuids.root}, '_MAGIC': {uuids.child}})],
+            provider_summaries=[
+                ac_obj.ProviderSummary(
+                    resource_provider=root,
+                    resources=[ac_obj.ProviderSummaryResource(
+                        resource_class='VCPU', capacity=8, used=0)],
+                    traits=['HW_CPU_X86_AVX2']),
+                ac_obj.ProviderSummary(
+                    resource_provider=child,
+                    resources=[
+                        ac_obj.ProviderSummaryResource(
+                            resource_class='CUSTOM_MAGIC', capacity=4,
+                            used=1),
+                        ac_obj.ProviderSummaryResource(
+                            resource_class='DISK_GB', capacity=100,
+                            used=0)])])
+        self.groups = {
+            '': placement_lib.RequestGroup(resources={'VCPU': 1}),
+            '_MAGIC': placement_lib.RequestGroup(
+                resources={'CUSTOM_MAGIC': 2})}
+
+    def _serialize(self, version, chunk_size=1):
+        parse_version = microversion_parse.parse_version_string
+        want_version = parse_version(version)
+        want_version.max_version = parse_version('9.99')
+        want_version.min_version = parse_version('1.0')
+        chunks = list(allocation_candidate._encode_chunks(
+            allocation_candidate._serialize_allocation_candidates(
+                self.cands, self.groups, want_version),
+            chunk_size=chunk_size))
+        for chunk in chunks:
+            self.assertIsInstance(chunk, bytes)
+        return chunks
+
+    def _assert_body(self, expected, version):
+        body = b''.join(self._serialize(version))
+        self.assertEqual(jsonutils.dump_as_bytes(expected), body)
+
+    def test_serialize_1_10(self):
+        self._assert_body({
+            'allocation_requests': [
+                {'allocations': [
+                    {'resource_provider': {'uuid': uuids.root},
+                     'resources': {'VCPU': 1}},
+                    {'resource_provider': {'uuid': uuids.child},
+                     'resources': {'CUSTOM_MAGIC': 2}}]}],
+            'provider_summaries': {
+                uuids.root: {
+                    'resources': {'VCPU': {'capacity': 8, 'used': 0}}},
+                uuids.child: {
+                    'resources': {
+                        'CUSTOM_MAGIC': {'capacity': 4, 'used': 1}}}},
+        }, '1.10')
+
+    def test_serialize_1_29(self):
+        self._assert_body({
+            'allocation_requests': [
+                {'allocations': {
+                    uuids.root: {'resources': {'VCPU': 1}},
+                    uuids.child: {'resources': {'CUSTOM_MAGIC': 2}}}}],
+            'provider_summaries': {
+                uuids.root: {
+                    'resources': {'VCPU': {'capacity': 8, 'used': 0}},
+                    'traits': ['HW_CPU_X86_AVX2'],
+                    'parent_provider_uuid': None,
+                    'root_provider_uuid': uuids.root},
+                uuids.child: {
+                    'resources': {
+                        'CUSTOM_MAGIC': {'capacity': 4, 'used': 1},
+                        'DISK_GB': {'capacity': 100, 'used': 0}},
+                    'traits': [],
+                    'parent_provider_uuid': uuids.root,
+                    'root_provider_uuid': uuids.root}},
+        }, '1.29')
+
+    def test_serialize_1_34(self):
+        body = jsonutils.loads(b''.join(self._serialize('1.34')))
+        self.assertEqual(
+            {'': [uuids.root], '_MAGIC': [uuids.child]},
+            body['allocation_requests'][0]['mappings'])
+
+    def test_serialize_empty(self):
+        self.cands = ac_obj.AllocationCandidates(
+            allocation_requests=[], provider_summaries=[])
+        self._assert_body(
+            {'allocation_requests': [], 'provider_summaries': {}}, '1.29')
+
+    def test_encode_chunks(self):
+        self.assertEqual(1, len(self._serialize('1.29', chunk_size=65536)))
+        chunks = self._serialize('1.29', chunk_size=100)
+        self.assertGreater(len(chunks), 1)
+        for chunk in chunks[:-1]:
+            self.assertGreaterEqual(len(chunk), 100)
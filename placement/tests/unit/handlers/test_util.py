@@ -283,3 +283,76 @@ class TestEnsureConsumer(base.ContextTestCase):
         self.assertEqual(
             self.ctx.ct_cache.id_from_string.return_value,
             consumer.consumer_type_id)
+
+    def _mock_bulk_ensure(self):
+        self.proj = project_obj.Project(
+            self.ctx, id=1, external_id=self.project_id)
+        self.user = user_obj.User(self.ctx, id=1, external_id=self.user_id)
+        self.mock_projects_get = self.useFixture(fixtures.MockPatch(
+            'placement.objects.project.get_or_create_all_by_external_ids',
+            return_value={self.project_id: self.proj})).mock
+        self.mock_users_get = self.useFixture(fixtures.MockPatch(
+            'placement.objects.user.get_or_create_all_by_external_ids',
+            return_value={self.user_id: self.user})).mock
+        self.mock_consumers_get = self.useFixture(fixtures.MockPatch(
+            'placement.objects.consumer.get_all_by_uuids')).mock
+        self.mock_consumers_create = self.useFixture(fixtures.MockPatch(
+            'placement.objects.consumer.create_all')).mock
+        self.existing = consumer_obj.Consumer(
+            self.ctx, id=1, uuid=uuidsentinel.existing, project=self.proj,
+            user=self.user, generation=2)
+        self.mock_consumers_get.return_value = {
+            uuidsentinel.existing: self.existing}
+
+    def _data(self, existing_gen=2, new_gen=None):
+        return {
+            uuidsentinel.existing: {
+                'project_id': self.project_id, 'user_id': self.user_id,
+                'consumer_generation': existing_gen},
+            uuidsentinel.new: {
+                'project_id': self.project_id, 'user_id': self.user_id,
+                'consumer_generation': new_gen},
+        }
+
+    def test_ensure_consumers(self):
+        self._mock_bulk_ensure()
+        consumers, created, request_attrs = util.ensure_consumers(
+            self.ctx, self._data(), self.after_version)
+
+        self.mock_projects_get.assert_called_once()
+        self.mock_users_get.assert_called_once()
+        self.mock_consumers_get.assert_called_once_with(
+            self.ctx, self._data())
+        self.mock_consumers_create.assert_called_once_with(
+            self.ctx, [consumers[uuidsentinel.new]])
+        self.assertIs(self.existing, consumers[uuidsentinel.existing])
+        self.assertEqual([consumers[uuidsentinel.new]], created)
+        self.assertEqual(self.proj, consumers[uuidsentinel.new].project)
+        self.assertEqual(
+            util.RequestAttr(self.proj, self.user, None),
+            request_attrs[uuidsentinel.new])
+        self.mock_consumer_create.assert_not_called()
+
+    def test_ensure_consumers_gen_fail(self):
+        """Tests that a generation conflict on any consumer is raised before
+        any consumer is created.
+        """
+        self._mock_bulk_ensure()
+        for data in (self._data(existing_gen=1), self._data(new_gen=0)):
+            self.assertRaises(
+                webob.exc.HTTPConflict,
+                util.ensure_consumers, self.ctx, data, self.after_version)
+        self.mock_consumers_create.assert_not_called()
+
+    def test_ensure_consumers_create_exists(self):
+        """Tests that the new consumers are created one at a time when
+        another thread created some of them in the meantime.
+        """
+        self._mock_bulk_ensure()
+        self.mock_consumers_create.side_effect = exception.ConsumerExists(
+            uuid=uuidsentinel.new)
+        consumers, created, request_attrs = util.ensure_consumers(
+            self.ctx, self._data(), self.after_version)
+
+        self.mock_consumer_create.assert_called_once_with()
+        self.assertEqual([consumers[uuidsentinel.new]], created)
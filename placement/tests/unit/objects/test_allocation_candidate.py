@@ -10,6 +10,8 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import copy
+import itertools
 from unittest import mock
 
 from placement import lib as placement_lib
@@ -19,7 +21,7 @@ from placement.tests.unit.objects import base
 
 
 class TestAllocationCandidatesNoDB(base.TestCase):
-    @mock.patch('placement.objects.research_context._has_provider_trees',
+    @mock.patch('placement.objects.research_context.has_provider_trees',
                 new=mock.Mock(return_value=True))
     def test_limit_results(self):
         # Results are limited based on their root provider uuid, not uuid.
@@ -43,19 +45,148 @@ class TestAllocationCandidatesNoDB(base.TestCase):
                         root_provider_uuid=uuid))
                     for uuid in (1, 7, 6, 4, 8, 5)]),
         ]
-        sum1 = mock.Mock(resource_provider=mock.Mock(root_provider_uuid=1))
-        sum0 = mock.Mock(resource_provider=mock.Mock(root_provider_uuid=0))
-        sum4 = mock.Mock(resource_provider=mock.Mock(root_provider_uuid=4))
-        sum8 = mock.Mock(resource_provider=mock.Mock(root_provider_uuid=8))
-        sum5 = mock.Mock(resource_provider=mock.Mock(root_provider_uuid=5))
-        sum7 = mock.Mock(resource_provider=mock.Mock(root_provider_uuid=7))
-        sum6 = mock.Mock(resource_provider=mock.Mock(root_provider_uuid=6))
-        sum_in = [sum1, sum0, sum4, sum8, sum5, sum7, sum6]
         rw_ctx = res_ctx.RequestWideSearchContext(
             self.context, placement_lib.RequestWideParams(limit=2), True)
-        aro, sum = rw_ctx.limit_results(aro_in, sum_in)
+        rw_ctx.providers_by_id = {
+            i: mock.Mock(root_provider_uuid=uuid)
+            for i, uuid in enumerate((1, 0, 4, 8, 5, 7, 6))}
+        aro = rw_ctx.limit_results(aro_in)
         self.assertEqual(aro_in[:2], aro)
-        self.assertEqual(set([sum1, sum0, sum4, sum8, sum5]), set(sum))
+        # Summaries are only built for the providers in the trees of the
+        # allocation requests that survived the limit.
+        self.assertEqual({0, 1, 2, 3, 4}, rw_ctx.provider_ids_for(aro))
+
+    @mock.patch('placement.objects.research_context.has_provider_trees',
+                new=mock.Mock(return_value=False))
+    def test_limit_results_stops_early(self):
+        consumed = []
+
+        def gen():
+            for i in range(10):
+                consumed.append(i)
+                yield i
+
+        rw_ctx = res_ctx.RequestWideSearchContext(
+            self.context, placement_lib.RequestWideParams(limit=3), True)
+        self.assertEqual([0, 1, 2], rw_ctx.limit_results(gen()))
+        self.assertEqual([0, 1, 2], consumed)
+
+    @mock.patch('placement.objects.research_context.has_provider_trees',
+                new=mock.Mock(return_value=False))
+    def test_limit_results_randomized(self):
+        self.conf_fixture.config(
+            randomize_allocation_candidates=True, group='placement')
+        rw_ctx = res_ctx.RequestWideSearchContext(
+            self.context, placement_lib.RequestWideParams(limit=3), True)
+        aro = rw_ctx.limit_results(iter(range(10)))
+        self.assertEqual(3, len(aro))
+        self.assertEqual(3, len(set(aro)))
+        self.assertTrue(set(aro).issubset(range(10)))
+
+        # Fewer candidates than the limit are all returned.
+        aro = rw_ctx.limit_results(iter(range(2)))
+        self.assertEqual([0, 1], sorted(aro))
+
+    @mock.patch('placement.objects.research_context.has_provider_trees',
+                new=mock.Mock(return_value=False))
+    def test_limit_results_sorted(self):
+        # Sorting takes precedence over randomizing.
+        self.conf_fixture.config(
+            randomize_allocation_candidates=True, group='placement')
+        rp1 = ac_obj.CandidateProvider(id=1, uuid='rp1')
+        rp2 = ac_obj.CandidateProvider(id=2, uuid='rp2')
+        rp3 = ac_obj.CandidateProvider(id=3, uuid='rp3')
+        capacity_by_rp_rc = {
+            (1, 'VCPU'): res_ctx.ProviderCapacity(10, 8, 10),
+            (1, 'MEMORY_MB'): res_ctx.ProviderCapacity(100, 0, 100),
+            (2, 'VCPU'): res_ctx.ProviderCapacity(10, 0, 10),
+            (2, 'MEMORY_MB'): res_ctx.ProviderCapacity(100, 90, 100),
+            (3, 'VCPU'): res_ctx.ProviderCapacity(10, 4, 10),
+            (3, 'MEMORY_MB'): res_ctx.ProviderCapacity(100, 40, 100),
+        }
+        areqs = [
+            ac_obj.AllocationRequest(
+                anchor_root_provider_uuid=rp.uuid,
+                resource_requests=[
+                    ac_obj.AllocationRequestResource(
+                        resource_provider=rp, resource_class='VCPU',
+                        amount=1),
+                    ac_obj.AllocationRequestResource(
+                        resource_provider=rp, resource_class='MEMORY_MB',
+                        amount=10)])
+            for rp in (rp1, rp2, rp3)]
+
+        def run(sort, limit, expected):
+            rw_ctx = res_ctx.RequestWideSearchContext(
+                self.context,
+                placement_lib.RequestWideParams(limit=limit, sort=sort), True)
+            rw_ctx.capacity_by_rp_rc = capacity_by_rp_rc
+            self.assertEqual(
+                expected,
+                [areq.anchor_root_provider_uuid
+                 for areq in rw_ctx.limit_results(iter(areqs))])
+
+        # Free ratios: rp1 (0.1 + 0.9) / 2, rp2 (0.9 + 0) / 2,
+        # rp3 (0.5 + 0.5) / 2. Ties keep the order of the candidates.
+        run(('pack', None), 2, ['rp2', 'rp1'])
+        run(('spread', None), 2, ['rp1', 'rp3'])
+        run(('spread', None), None, ['rp1', 'rp3', 'rp2'])
+        run(('pack', {'VCPU': 1}), 1, ['rp1'])
+        run(('spread', {'VCPU': 1, 'MEMORY_MB': 3}), None,
+            ['rp1', 'rp3', 'rp2'])
+
+    @mock.patch('placement.objects.research_context.has_provider_trees',
+                new=mock.Mock(return_value=False))
+    @mock.patch.object(res_ctx, 'LOG')
+    def test_exceeds_capacity(self, mock_log):
+        rw_ctx = res_ctx.RequestWideSearchContext(
+            self.context, placement_lib.RequestWideParams(), True)
+        rw_ctx.capacity_by_rp_rc[(1, 'VCPU')] = res_ctx.ProviderCapacity(
+            capacity=10, used=6, max_unit=3)
+        rw_ctx.headroom_by_rp_rc[(1, 'VCPU')] = 3
+        rp = ac_obj.CandidateProvider(id=1, uuid='rp1')
+
+        def areq(amount):
+            return ac_obj.AllocationRequest(resource_requests=[
+                ac_obj.AllocationRequestResource(
+                    resource_provider=rp, resource_class='VCPU',
+                    amount=amount)])
+
+        mock_log.isEnabledFor.return_value = False
+        self.assertFalse(rw_ctx.exceeds_capacity(areq(3)))
+        self.assertTrue(rw_ctx.exceeds_capacity(areq(4)))
+        self.assertTrue(
+            rw_ctx.exceeds_capacity(areq(2), {(1, 'VCPU'): 2}))
+        mock_log.debug.assert_not_called()
+
+        mock_log.isEnabledFor.return_value = True
+        self.assertTrue(rw_ctx.exceeds_capacity(areq(4)))
+        self.assertIn('max_unit', mock_log.debug.call_args[0][0])
+
+    def test_request_key(self):
+        def key(member_of, sort):
+            groups = {'': placement_lib.RequestGroup(
+                resources={'VCPU': 1}, member_of=member_of)}
+            rqparams = placement_lib.RequestWideParams(sort=sort)
+            return ac_obj._request_key(groups, rqparams, True)
+
+        # The order of the member_of lists doesn't matter
+        self.assertEqual(
+            key([{'a1'}, {'a2', 'a3'}], None),
+            key([{'a3', 'a2'}, {'a1'}], None))
+        # The order of tuples, like the (strategy, weights) of sort, does
+        self.assertEqual(
+            key([], ('pack', {'VCPU': 1.0})),
+            key([], ('pack', {'VCPU': 1.0})))
+        self.assertNotEqual(
+            key([], ('pack', 'spread')), key([], ('spread', 'pack')))
+
+    def test_reservoir_sample(self):
+        with mock.patch('random.randint', side_effect=[0, 4, 1]):
+            # The 4th item replaces the 1st, the 5th is dropped and the 6th
+            # replaces the 2nd.
+            self.assertEqual(
+                [3, 5, 2], res_ctx._reservoir_sample(range(6), 3))
 
     def test_check_same_subtree(self):
         # Construct a tree that look like this
@@ -90,10 +221,126 @@ class TestAllocationCandidatesNoDB(base.TestCase):
             set(["0", "1"]),
         ]
 
+        span_by_rp = {}
+        ac_obj._index_subtrees(parent_by_rp, span_by_rp)
+
         for group in same_subtree:
             self.assertTrue(
-                ac_obj._check_same_subtree(group, parent_by_rp))
+                ac_obj._check_same_subtree(group, span_by_rp))
 
         for group in different_subtree:
             self.assertFalse(
-                ac_obj._check_same_subtree(group, parent_by_rp))
+                ac_obj._check_same_subtree(group, span_by_rp))
+
+    def test_index_subtrees(self):
+        span_by_rp = {}
+        ac_obj._index_subtrees(
+            {"0": None, "00": "0", "000": "00", "01": "0"}, span_by_rp)
+        self.assertEqual(
+            {"0": (0, 7), "00": (1, 4), "000": (2, 3), "01": (5, 6)},
+            span_by_rp)
+        # Trees indexed later are numbered after the earlier ones.
+        ac_obj._index_subtrees({"1": None, "10": "1"}, span_by_rp)
+        self.assertEqual((8, 11), span_by_rp["1"])
+        self.assertEqual((9, 10), span_by_rp["10"])
+        self.assertFalse(
+            ac_obj._check_same_subtree({"0", "10"}, span_by_rp))
+
+    def test_consolidate_allocation_requests(self):
+        rp1 = ac_obj.CandidateProvider(id=1, uuid='rp1')
+        rp2 = ac_obj.CandidateProvider(id=2, uuid='rp2')
+        vcpu1 = ac_obj.AllocationRequestResource(
+            resource_provider=rp1, resource_class='VCPU', amount=1)
+        vcpu2 = ac_obj.AllocationRequestResource(
+            resource_provider=rp1, resource_class='VCPU', amount=2)
+        disk = ac_obj.AllocationRequestResource(
+            resource_provider=rp2, resource_class='DISK_GB', amount=10)
+        areq1 = ac_obj.AllocationRequest(
+            anchor_root_provider_uuid='rp1', resource_requests=[vcpu1],
+            mappings={'': {'rp1'}})
+        areq2 = ac_obj.AllocationRequest(
+            anchor_root_provider_uuid='rp1', resource_requests=[vcpu2, disk],
+            mappings={'_X': {'rp1', 'rp2'}})
+        hash1 = hash(areq1)
+
+        areq = ac_obj._consolidate_allocation_requests([areq1, areq2])
+        self.assertEqual(
+            {(1, 'VCPU', 3), (2, 'DISK_GB', 10)},
+            set((arr.resource_provider.id, arr.resource_class, arr.amount)
+                for arr in areq.resource_requests))
+        self.assertEqual({'': {'rp1'}, '_X': {'rp1', 'rp2'}}, areq.mappings)
+        # The consolidated amounts are added to copies, leaving the
+        # AllocationRequestResources of the inputs, which may be part of
+        # other results, untouched.
+        self.assertEqual(1, vcpu1.amount)
+        self.assertEqual(2, vcpu2.amount)
+        self.assertIs(disk, areq.resource_requests[1])
+        self.assertEqual(hash1, hash(areq1))
+        self.assertEqual(hash1, hash(copy.copy(areq1)))
+
+    def test_areq_combinations_isolate(self):
+        def areqs(suffix, rp_uuids):
+            return [
+                ac_obj.AllocationRequest(
+                    anchor_root_provider_uuid='cn', use_same_provider=True,
+                    mappings={suffix: {rp_uuid}})
+                for rp_uuid in rp_uuids]
+
+        rw_ctx = mock.Mock(same_subtrees=[], group_policy='isolate')
+        rw_ctx.exceeds_capacity.return_value = False
+        areq_lists_by_suffix = {
+            '_A': areqs('_A', ['pf1', 'pf2']),
+            '_B': areqs('_B', ['pf1', 'pf2', 'pf3']),
+            '_C': areqs('_C', ['pf1', 'pf2']),
+        }
+        combos = list(ac_obj._areq_combinations(areq_lists_by_suffix, rw_ctx))
+        self.assertEqual(
+            [['pf1', 'pf3', 'pf2'], ['pf2', 'pf3', 'pf1']],
+            [[next(iter(areq.mappings.values())).copy().pop()
+              for areq in combo]
+             for combo in combos])
+        # Picking pf1 for _A leaves pf2 alone for _B and _C, so the search
+        # backtracks before checking the capacity of anything.
+        rw_ctx.exceeds_capacity.reset_mock()
+        areq_lists_by_suffix = {
+            '_A': areqs('_A', ['pf1']),
+            '_B': areqs('_B', ['pf1', 'pf2']),
+            '_C': areqs('_C', ['pf1', 'pf2']),
+        }
+        self.assertEqual(
+            [], list(ac_obj._areq_combinations(areq_lists_by_suffix, rw_ctx)))
+        rw_ctx.exceeds_capacity.assert_not_called()
+
+    def test_resource_request_combinations(self):
+        # Three providers, each able to provide either of two resource
+        # classes.
+        traits_by_rp_id = {
+            1: ['CUSTOM_FOO'],
+            2: ['CUSTOM_BAR'],
+            3: ['CUSTOM_FOO', 'CUSTOM_BAZ']}
+        request_groups = [
+            [ac_obj.AllocationRequestResource(
+                resource_provider=mock.Mock(id=rp_id),
+                resource_class=rc, amount=1)
+             for rp_id in (1, 2, 3)]
+            for rc in ('VCPU', 'MEMORY_MB')]
+
+        def run(required_traits, forbidden_traits, expected):
+            combos = ac_obj._resource_request_combinations(
+                request_groups, traits_by_rp_id, required_traits,
+                forbidden_traits)
+            self.assertEqual(
+                sorted(expected),
+                sorted(tuple(arr.resource_provider.id for arr in combo)
+                       for combo in combos))
+
+        # No constraints yields the whole product
+        run([], set(), itertools.product((1, 2, 3), repeat=2))
+        # Providers with forbidden traits are never used
+        run([], {'CUSTOM_BAZ'}, itertools.product((1, 2), repeat=2))
+        # Required traits are fulfilled collectively
+        run([{'CUSTOM_BAR'}, {'CUSTOM_BAZ'}], set(), [(2, 3), (3, 2)])
+        run([{'CUSTOM_BAR', 'CUSTOM_BAZ'}], {'CUSTOM_FOO'}, [(2, 2)])
+        # Nothing left to choose from
+        run([], {'CUSTOM_FOO', 'CUSTOM_BAR'}, [])
+        run([{'CUSTOM_QUX'}], set(), [])
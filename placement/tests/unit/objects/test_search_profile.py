@@ -0,0 +1,171 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import threading
+from unittest import mock
+
+import fixtures
+
+from placement.objects import search_profile
+from placement.tests.unit.objects import base
+
+
+class TestSearchProfile(base.TestCase):
+
+    def setUp(self):
+        super(TestSearchProfile, self).setUp()
+        patcher = mock.patch.object(search_profile, '_WINDOW', new=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.now = 100.0
+        self.useFixture(fixtures.MockPatchObject(
+            search_profile, 'time', mock.Mock(monotonic=lambda: self.now)))
+        self.profile = search_profile.SearchProfile()
+        self.context.search_profile = self.profile
+
+    def _tick(self, seconds):
+        self.now += seconds
+
+    def test_not_profiled(self):
+        self.context.search_profile = None
+        with search_profile.phase(self.context, 'foo') as phase:
+            phase.rows += 3
+        self.assertEqual(0, phase.rows)
+        items = [1, 2]
+        self.assertIs(items, search_profile.iterate(
+            self.context, 'foo', items))
+
+    def test_nested_phases(self):
+        with search_profile.phase(self.context, 'outer') as outer:
+            self._tick(1)
+            with search_profile.phase(self.context, 'inner') as inner:
+                self._tick(2)
+                self.profile._count_query()
+                inner.rows += 5
+            self._tick(3)
+            self.profile._count_query()
+        self.assertEqual(['outer', 'inner'], list(self.profile.phases))
+        self.assertEqual(4, outer.seconds)
+        self.assertEqual(1, outer.queries)
+        self.assertEqual(0, outer.rows)
+        self.assertEqual(2, inner.seconds)
+        self.assertEqual(1, inner.queries)
+        self.assertEqual(5, inner.rows)
+        self.assertIsNone(search_profile._ACTIVE.profile)
+
+    def test_iterate(self):
+        def produce():
+            for x in range(3):
+                self._tick(1)
+                yield x
+
+        def consume(items):
+            for item in items:
+                self._tick(10)
+                yield item
+
+        items = search_profile.iterate(
+            self.context, 'consume',
+            consume(search_profile.iterate(self.context, 'produce',
+                                           produce())))
+        with search_profile.phase(self.context, 'limit'):
+            self.assertEqual([0, 1, 2], list(items))
+        phases = self.profile.phases
+        self.assertEqual(3, phases['produce'].seconds)
+        self.assertEqual(3, phases['produce'].rows)
+        self.assertEqual(30, phases['consume'].seconds)
+        self.assertEqual(3, phases['consume'].rows)
+        self.assertEqual(0, phases['limit'].seconds)
+
+    def test_threads(self):
+        def search():
+            with search_profile.phase(self.context, 'providers') as phase:
+                self._tick(2)
+                phase.rows += 1
+
+        with search_profile.phase(self.context, 'group_wait'):
+            with search_profile.phase(self.context, 'providers') as phase:
+                self._tick(1)
+                phase.rows += 1
+            thread = threading.Thread(target=search)
+            thread.start()
+            thread.join()
+        phases = self.profile.phases
+        self.assertEqual(['group_wait', 'providers'], list(phases))
+        self.assertEqual(3, phases['providers'].seconds)
+        self.assertEqual(2, phases['providers'].rows)
+        # The time of the other thread is also seen by the waiting thread
+        self.assertEqual(2, phases['group_wait'].seconds)
+
+    def test_server_timing(self):
+        with search_profile.phase(self.context, 'foo') as phase:
+            self._tick(0.0125)
+            phase.rows += 2
+        with search_profile.phase(self.context, 'bar'):
+            self.profile._count_query()
+        self.assertEqual(
+            'foo;dur=12.500;desc="queries=0 rows=2", '
+            'bar;dur=0.000;desc="queries=1 rows=0"',
+            self.profile.server_timing())
+
+    def test_percentile(self):
+        counts = [0] * (len(search_profile._BUCKET_BOUNDS) + 1)
+        counts[search_profile._bucket(0.1)] = 50
+        counts[search_profile._bucket(3)] = 49
+        counts[search_profile._bucket(100000)] = 1
+        self.assertEqual(0.25, search_profile._percentile(counts, 0.5))
+        self.assertEqual(4, search_profile._percentile(counts, 0.9))
+        self.assertEqual(4, search_profile._percentile(counts, 0.99))
+        self.assertEqual('inf', search_profile._percentile(counts, 1.0))
+
+    @mock.patch.object(search_profile.LOG, 'info')
+    def test_record(self, mock_info):
+        self.conf_fixture.config(
+            allocation_candidates_profiling_report_interval=60,
+            group='placement')
+        with search_profile.phase(self.context, 'foo'):
+            self._tick(0.003)
+            self.profile._count_query()
+        search_profile.record(self.context, self.profile)
+        search_profile.record(self.context, self.profile)
+        mock_info.assert_not_called()
+        self.assertEqual(2, search_profile.summary()[0])
+
+        self._tick(61)
+        search_profile.record(self.context, self.profile)
+        self.assertEqual(2, mock_info.call_count)
+        expected = {'count': 3, 'p50': 4, 'p90': 4, 'p99': 4, 'max': 4,
+                    'queries': 1.0}
+        self.assertEqual(dict(expected, name='foo'),
+                         mock_info.call_args[0][1])
+        # Reporting doesn't reset the histogram
+        self.assertEqual((3, {'foo': expected}), search_profile.summary())
+
+    def test_rolling_window(self):
+        self.conf_fixture.config(
+            allocation_candidates_profiling_report_interval=60,
+            group='placement')
+        for _ in range(3):
+            search_profile.record(self.context, self.profile)
+            self._tick(30)
+        # The first search is more than an interval old
+        self.assertEqual(2, search_profile.summary()[0])
+        self._tick(60)
+        self.assertEqual((0, {}), search_profile.summary())
+
+    def test_record_disabled(self):
+        self.conf_fixture.config(
+            allocation_candidates_profiling_report_interval=0,
+            group='placement')
+        search_profile.record(self.context, self.profile)
+        self.assertIsNone(search_profile._WINDOW)
+        self.assertEqual((0, {}), search_profile.summary())